@@ -0,0 +1,3 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
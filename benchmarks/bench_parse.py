@@ -0,0 +1,99 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Microbenchmark for the webhook hot path: signature verification, JSON
+decoding and model construction, per messaging event.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_parse
+"""
+import argparse
+import asyncio
+import json
+import timeit
+
+from fbemissary import models
+from fbemissary import webhook
+
+from benchmarks import webhookgen
+
+
+def make_body(events_per_entry):
+    messaging = [
+        webhookgen.make_message_event(
+            'PAGE_ID', str(1000 + n), 'mid.{0}'.format(n), 'hello ' * 5,
+            variant=n)
+        for n in range(events_per_entry)
+    ]
+    structure = {
+        'object': 'page',
+        'entry': [{'id': 'PAGE_ID', 'time': 1, 'messaging': messaging}],
+    }
+    return json.dumps(structure).encode('utf-8')
+
+
+class BenchRequest:
+    def __init__(self, content):
+        self._content = content
+        self.headers = {'X-Hub-Signature': webhookgen.sign(content)}
+
+    async def read(self):
+        return self._content
+
+    async def json(self):
+        return json.loads(self._content.decode('utf-8'))
+
+
+def bench_models(body, number):
+    structures = json.loads(body.decode('utf-8'))['entry'][0]['messaging']
+
+    def parse_all():
+        for structure in structures:
+            models.model_from_entry_structure(structure)
+
+    seconds = min(timeit.repeat(parse_all, number=number, repeat=5))
+    return seconds / (number * len(structures))
+
+
+def bench_receive_update(body, number, events_per_entry):
+    loop = asyncio.new_event_loop()
+
+    async def events_received(page_id, events):
+        pass
+
+    wrangler = webhook.WebhookWrangler(events_received)
+    receiver = webhook.WebhookReceiver(
+        webhookgen.TEST_APP_SECRET, 'verify', wrangler, loop=loop)
+    request = BenchRequest(body)
+
+    async def receive_many():
+        for _ in range(number):
+            await receiver.receive_update(request)
+
+    def run():
+        loop.run_until_complete(receive_many())
+
+    seconds = min(timeit.repeat(run, number=1, repeat=5))
+    loop.close()
+    return seconds / (number * events_per_entry)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--events-per-entry', type=int, default=20)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+    body = make_body(args.events_per_entry)
+    model_cost = bench_models(body, args.number)
+    receive_cost = bench_receive_update(
+        body, args.number, args.events_per_entry)
+    print('model construction:        {0:8.2f} us/event'.format(
+        model_cost * 1e6))
+    print('receive_update end to end: {0:8.2f} us/event'.format(
+        receive_cost * 1e6))
+
+
+if __name__ == '__main__':
+    main()
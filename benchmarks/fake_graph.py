@@ -0,0 +1,76 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+A local stand-in for the Graph API Send endpoints, on aiohttp
+"""
+import json
+import asyncio
+import itertools
+import urllib.parse
+
+import aiohttp.web
+
+
+class FakeGraphAPI:
+    """
+    Answers ``POST /me/messages`` and batch requests like the Send API,
+    after ``latency`` seconds, and hands every received message payload
+    to ``on_message``.
+    """
+    def __init__(self, *, latency=0.0, on_message=None):
+        self._latency = latency
+        self._on_message = on_message or (lambda payload: None)
+        self._message_ids = itertools.count()
+        self._runner = None
+        self.requests = 0
+        self.messages = 0
+        self.base_url = None
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.router.add_post('/me/messages', self._send_message)
+        app.router.add_post('/', self._batch)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = aiohttp.web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = 'http://{0}:{1}/'.format(host, port)
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _send_message(self, request):
+        self.requests += 1
+        payload = await request.json()
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        return aiohttp.web.json_response(self._reply(payload))
+
+    async def _batch(self, request):
+        self.requests += 1
+        form = await request.post()
+        items = []
+        for item in json.loads(form['batch']):
+            body = urllib.parse.parse_qs(item['body'])
+            payload = {k: json.loads(v[0]) for k, v in body.items()}
+            items.append({
+                'code': 200,
+                'body': json.dumps(self._reply(payload)),
+            })
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        return aiohttp.web.json_response(items)
+
+    def _reply(self, payload):
+        self.messages += 1
+        self._on_message(payload)
+        return {
+            'recipient_id': payload['recipient']['id'],
+            'message_id': 'mid.fake.{0}'.format(next(self._message_ids)),
+        }
@@ -0,0 +1,266 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Load test for the webhook-to-reply pipeline
+
+Runs a bot with an echoing conversationalist against a local stand-in
+Graph API, posts signed synthetic webhooks to it over HTTP, and
+reports throughput, webhook acknowledgement time, reply latency,
+memory per conversation and the number of live tasks.
+
+Run from the repository root::
+
+    python -m benchmarks.loadtest [--scenario NAME ...] [--json]
+"""
+import gc
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+import aiohttp
+import aiohttp.web
+import attr
+
+import fbemissary
+from fbemissary import conversation
+
+from benchmarks import webhookgen
+from benchmarks import fake_graph
+
+
+@attr.s(frozen=True)
+class Scenario:
+    name = attr.ib()
+    pages = attr.ib(default=1)
+    senders = attr.ib(default=100)
+    events_per_entry = attr.ib(default=1)
+    requests = attr.ib(default=2000)
+    concurrency = attr.ib(default=50)
+    #: Seconds the conversationalist spends on each event before replying
+    handler_latency = attr.ib(default=0.0)
+    #: Seconds the stand-in Graph API takes to answer
+    graph_latency = attr.ib(default=0.0)
+    #: Keyword arguments for FacebookPageMessengerBot
+    bot_options = attr.ib(default=attr.Factory(dict))
+
+
+SCENARIOS = [
+    Scenario('baseline'),
+    Scenario('many-senders', senders=5000),
+    Scenario('many-pages', pages=50, senders=100),
+    Scenario('batched-entries', events_per_entry=20, requests=200),
+    Scenario('slow-handler', handler_latency=0.02),
+    Scenario('slow-graph', graph_latency=0.05),
+    Scenario('ingest-queue', handler_latency=0.02,
+             bot_options={'ingest_queue_size': 1000}),
+]
+
+
+@attr.s
+class Result:
+    scenario = attr.ib()
+    events = attr.ib()
+    replies = attr.ib()
+    events_per_second = attr.ib()
+    ack_p50_ms = attr.ib()
+    ack_p99_ms = attr.ib()
+    reply_p50_ms = attr.ib()
+    reply_p99_ms = attr.ib()
+    conversations = attr.ib()
+    tasks = attr.ib()
+    bytes_per_conversation = attr.ib()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def all_tasks(loop):
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)
+
+
+def make_conversationalist_class(handler_latency):
+    class EchoConversationalist(fbemissary.SerialConversationalist):
+        async def event_received(self, event):
+            if handler_latency:
+                await asyncio.sleep(handler_latency)
+            await self.replier.send_text_message(event.text)
+    return EchoConversationalist
+
+
+class IdleConversationalist(fbemissary.SerialConversationalist):
+    async def event_received(self, event):
+        pass
+
+
+async def measure_memory_per_conversation(loop, count=2000):
+    """
+    Return the bytes allocated per conversation, including its
+    conversationalist and task, for ``count`` new conversations.
+    """
+    demuxer = conversation.MessagingEventDemuxer()
+    factory = fbemissary.ConversationalistFactory(IdleConversationalist)
+    demuxer.add_conversationalist_factory('PAGE', 'TOKEN', factory, ())
+    await demuxer.start(None, loop=loop)
+    # One message from each of ``count`` senders, made before tracing
+    # starts so only what the conversations keep is counted
+    events = [
+        fbemissary.ReceivedMessage(
+            str(n), 'PAGE', 0, 'mid.{0}'.format(n), 'hi', [], None)
+        for n in range(count)
+    ]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    await demuxer.add_messaging_events('PAGE', events)
+    del events
+    # Let every conversation handle its message
+    for _ in range(3):
+        await asyncio.sleep(0)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    await demuxer.close()
+    return (after - before) / count
+
+
+async def run_scenario(scenario, loop):
+    reply_latencies = []
+
+    def on_message(payload):
+        sent_at = float(payload['message']['text'])
+        reply_latencies.append(time.perf_counter() - sent_at)
+
+    graph = fake_graph.FakeGraphAPI(
+        latency=scenario.graph_latency, on_message=on_message)
+    graph_url = await graph.start()
+
+    generator = webhookgen.WebhookGenerator(
+        pages=scenario.pages,
+        senders=scenario.senders,
+        events_per_entry=scenario.events_per_entry,
+        text_factory=lambda: repr(time.perf_counter()),
+    )
+    bot = fbemissary.FacebookPageMessengerBot(
+        webhookgen.TEST_APP_SECRET, 'verify',
+        graph_api_base_url=graph_url, **scenario.bot_options)
+    factory = fbemissary.ConversationalistFactory(
+        make_conversationalist_class(scenario.handler_latency))
+    for page_id in generator.page_ids:
+        bot.add_conversationalist_factory(
+            page_id, 'TOKEN-' + page_id, factory)
+    webapp = aiohttp.web.Application()
+    await bot.start('/webhook', webapp.router, loop=loop)
+    runner = aiohttp.web.AppRunner(webapp)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    webhook_url = 'http://127.0.0.1:{0}/webhook'.format(
+        runner.addresses[0][1])
+
+    expected_events = scenario.requests * scenario.events_per_entry
+    ack_times = []
+    remaining = iter(range(scenario.requests))
+
+    async def post_webhooks(session):
+        for _ in remaining:
+            body, headers = generator.make_request()
+            start = time.perf_counter()
+            async with session.post(
+                    webhook_url, data=body, headers=headers) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(
+                        'Webhook answered {0}'.format(response.status))
+            ack_times.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=scenario.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[
+            post_webhooks(session) for _ in range(scenario.concurrency)])
+    deadline = time.perf_counter() + 60
+    while graph.messages < expected_events:
+        if time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    tasks = len(all_tasks(loop))
+    conversations = bot.conversation_table_stats().size
+
+    await bot.stop()
+    await runner.cleanup()
+    await graph.stop()
+
+    return Result(
+        scenario=scenario.name,
+        events=expected_events,
+        replies=graph.messages,
+        events_per_second=graph.messages / elapsed,
+        ack_p50_ms=percentile(ack_times, 0.5) * 1000,
+        ack_p99_ms=percentile(ack_times, 0.99) * 1000,
+        reply_p50_ms=percentile(reply_latencies, 0.5) * 1000,
+        reply_p99_ms=percentile(reply_latencies, 0.99) * 1000,
+        conversations=conversations,
+        tasks=tasks,
+        bytes_per_conversation=None,
+    )
+
+
+def format_result(result):
+    return (
+        '{r.scenario:<16} {r.events_per_second:9.0f} ev/s  '
+        'ack p50 {r.ack_p50_ms:7.2f}ms p99 {r.ack_p99_ms:7.2f}ms  '
+        'reply p50 {r.reply_p50_ms:7.2f}ms p99 {r.reply_p99_ms:7.2f}ms  '
+        'convos {r.conversations:6d}  tasks {r.tasks:6d}  '
+        'replies {r.replies}/{r.events}'
+    ).format(r=result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--scenario', action='append',
+        choices=[s.name for s in SCENARIOS],
+        help='Scenario to run; may be repeated. Runs all by default.')
+    parser.add_argument(
+        '--requests', type=int,
+        help='Override the number of webhook requests per scenario.')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='Print results as JSON lines.')
+    args = parser.parse_args()
+    scenarios = [
+        s for s in SCENARIOS
+        if args.scenario is None or s.name in args.scenario
+    ]
+    if args.requests is not None:
+        scenarios = [attr.evolve(s, requests=args.requests) for s in scenarios]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    memory = loop.run_until_complete(measure_memory_per_conversation(loop))
+    for scenario in scenarios:
+        result = loop.run_until_complete(run_scenario(scenario, loop))
+        result.bytes_per_conversation = memory
+        if args.json:
+            print(json.dumps(attr.asdict(result)))
+        else:
+            print(format_result(result))
+        sys.stdout.flush()
+    if not args.json:
+        print('memory per conversation: {0:.0f} bytes'.format(memory))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Synthetic Messenger webhook payloads, signed with a test app secret
+"""
+import hmac
+import json
+import random
+import itertools
+
+
+TEST_APP_SECRET = 'benchmark-app-secret'
+
+
+def sign(content, app_secret=TEST_APP_SECRET):
+    """
+    Return the ``X-Hub-Signature`` header value for ``content``.
+    """
+    digest = hmac.new(
+        app_secret.encode('ascii'), msg=content, digestmod='sha1')
+    return 'sha1=' + digest.hexdigest()
+
+
+def make_message_event(page_id, sender_id, mid, text,
+                       timestamp=1458692752478, variant=0):
+    """
+    Return a message event structure. ``variant`` picks between a
+    plain text message, one with a quick reply payload, one with an
+    image and one with a location.
+    """
+    message = {'mid': mid, 'text': text}
+    variant %= 4
+    if variant == 1:
+        message['quick_reply'] = {'payload': 'PAYLOAD'}
+    elif variant == 2:
+        message['attachments'] = [
+            {'type': 'image', 'payload': {'url': 'https://example/y.png'}}]
+    elif variant == 3:
+        message['attachments'] = [{
+            'type': 'location',
+            'payload': {'coordinates': {'lat': 1.5, 'long': 2.5}},
+        }]
+    return {
+        'sender': {'id': sender_id},
+        'recipient': {'id': page_id},
+        'timestamp': timestamp,
+        'message': message,
+    }
+
+
+class WebhookGenerator:
+    """
+    Generates signed webhook request bodies spread over ``pages`` page
+    IDs and ``senders`` sender IDs per page, each with
+    ``events_per_entry`` message events.
+
+    ``text_factory`` is called with no arguments for the text of each
+    message, which lets load tests embed a send timestamp.
+    """
+    def __init__(self, *, pages=1, senders=100, events_per_entry=1,
+                 app_secret=TEST_APP_SECRET, seed=0, text_factory=None,
+                 variants=False):
+        self.page_ids = ['PAGE{0}'.format(n) for n in range(pages)]
+        self.sender_ids = [str(10000 + n) for n in range(senders)]
+        self._events_per_entry = events_per_entry
+        self._app_secret = app_secret
+        self._random = random.Random(seed)
+        self._text_factory = text_factory or (lambda: 'hello, world!')
+        self._variants = variants
+        self._mids = itertools.count()
+
+    def make_structure(self):
+        page_id = self._random.choice(self.page_ids)
+        messaging = []
+        for _ in range(self._events_per_entry):
+            n = next(self._mids)
+            messaging.append(make_message_event(
+                page_id,
+                self._random.choice(self.sender_ids),
+                'mid.bench.{0}'.format(n),
+                self._text_factory(),
+                variant=n if self._variants else 0,
+            ))
+        return {
+            'object': 'page',
+            'entry': [{'id': page_id, 'time': 1, 'messaging': messaging}],
+        }
+
+    def make_request(self):
+        """
+        Return a ``(body, headers)`` pair for a webhook POST request.
+        """
+        body = json.dumps(self.make_structure()).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Hub-Signature': sign(body, self._app_secret),
+        }
+        return body, headers
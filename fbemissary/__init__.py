@@ -7,10 +7,20 @@ fbemissary - A bot framework for the Facebook Messenger platform
 from .core import FacebookPageMessengerBot
 from .conversation import (
     ConversationalistFactory,
-    SerialConversationalist
+    SerialConversationalist,
+    PooledConversationalistFactory,
+    PooledConversationalist,
+    OverflowPolicy
 )
 from .models import (
+    EventKind,
     ReceivedMessage,
+    Echo,
+    Postback,
+    DeliveryReceipt,
+    ReadReceipt,
+    Optin,
+    Referral,
     AttachmentType,
     MediaAttachment,
     LocationAttachment
@@ -0,0 +1,430 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Downloading and caching received media
+
+An :class:`AttachmentService` downloads the media of
+:class:`fbemissary.models.MediaAttachment` objects over the bot's
+shared HTTP session. Downloads start when the event is dispatched, so
+by the time the conversationalist gets to the event they are usually
+done, and each URL is downloaded once even when several handlers ask
+for it. Results are kept in content-addressed LRU caches: small media
+in memory, and large media, such as video and audio, streamed to files
+in a directory.
+
+Conversationalists get the service as their ``attachments``
+attribute::
+
+    downloaded = await self.attachments.fetch(attachment)
+    if downloaded.data is not None:
+        ...  # bytes in memory
+    else:
+        ...  # a file at downloaded.path
+"""
+import os
+import asyncio
+import logging
+import hashlib
+import tempfile
+import functools
+import collections
+import concurrent.futures
+
+import aiohttp
+import attr
+
+from fbemissary import models
+
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+# Names of the files a DiskAttachmentCache writes, so it only ever
+# removes its own
+_FILE_PREFIX = 'att-'
+_TEMPORARY_PREFIX = '.download-'
+
+DEFAULT_STREAM_TYPES = frozenset({
+    models.AttachmentType.audio,
+    models.AttachmentType.video,
+    models.AttachmentType.file,
+})
+DEFAULT_PREFETCH_TYPES = frozenset({
+    models.AttachmentType.image,
+    models.AttachmentType.audio,
+    models.AttachmentType.video,
+    models.AttachmentType.file,
+})
+
+
+class AttachmentError(Exception):
+    """
+    An attachment could not be downloaded.
+    """
+
+
+class AttachmentTooLarge(AttachmentError):
+    pass
+
+
+@attr.s(frozen=True, slots=True)
+class DownloadedAttachment:
+    """
+    Attributes:
+        url (str):
+            Where the media was downloaded from.
+        digest (str):
+            The hex SHA-256 of the content.
+        size (int):
+            The content size in bytes.
+        content_type (str or None):
+            The media type the server gave.
+        data (bytes or None):
+            The content, if it is held in memory.
+        path (str or None):
+            The file holding the content, if it was streamed to disk.
+            The file may be removed once it falls out of the cache.
+    """
+    url = attr.ib()
+    digest = attr.ib()
+    size = attr.ib()
+    content_type = attr.ib()
+    data = attr.ib(default=None)
+    path = attr.ib(default=None)
+
+
+@attr.s(frozen=True)
+class AttachmentConfig:
+    """
+    How a bot downloads and caches received media.
+
+    Attributes:
+        max_concurrency (int):
+            The most downloads running at once.
+        max_size (int):
+            Downloads larger than this many bytes fail with
+            :class:`AttachmentTooLarge`.
+        memory_cache_bytes (int):
+            The size of the in-memory cache.
+        disk_cache_directory (str or None):
+            If given, media of the ``stream_types`` are streamed to
+            files in this directory instead of being read into
+            memory.
+        disk_cache_bytes (int):
+            The total size of the files kept in the directory.
+        stream_types
+                (frozenset of :class:`fbemissary.models.AttachmentType`):
+            The media types streamed to disk.
+        prefetch_types
+                (frozenset of :class:`fbemissary.models.AttachmentType`):
+            The media types downloaded as soon as an event carrying
+            them is dispatched.
+    """
+    max_concurrency = attr.ib(default=8)
+    max_size = attr.ib(default=25 * 1024 * 1024)
+    memory_cache_bytes = attr.ib(default=64 * 1024 * 1024)
+    disk_cache_directory = attr.ib(default=None)
+    disk_cache_bytes = attr.ib(default=1024 * 1024 * 1024)
+    stream_types = attr.ib(default=DEFAULT_STREAM_TYPES)
+    prefetch_types = attr.ib(default=DEFAULT_PREFETCH_TYPES)
+
+    def make_service(self, session, *, loop):
+        if self.disk_cache_directory is not None:
+            disk_cache = DiskAttachmentCache(
+                self.disk_cache_directory, max_bytes=self.disk_cache_bytes)
+        else:
+            disk_cache = None
+        return AttachmentService(
+            session,
+            loop=loop,
+            memory_cache=MemoryAttachmentCache(
+                max_bytes=self.memory_cache_bytes),
+            disk_cache=disk_cache,
+            max_concurrency=self.max_concurrency,
+            max_size=self.max_size,
+            stream_types=self.stream_types,
+            prefetch_types=self.prefetch_types,
+        )
+
+
+class _ContentAddressedCache:
+    """
+    LRU cache of content by digest, with an index of URL to digest so
+    different URLs for the same content share one copy.
+    """
+    def __init__(self, max_bytes, max_urls=100000):
+        self._max_bytes = max_bytes
+        self._max_urls = max_urls
+        # Map of URL -> digest
+        self._urls = collections.OrderedDict()
+        # Map of digest -> DownloadedAttachment
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, url):
+        digest = self._urls.get(url)
+        if digest is None:
+            return None
+        entry = self._entries.get(digest)
+        if entry is None:
+            del self._urls[url]
+            return None
+        self._urls.move_to_end(url)
+        self._entries.move_to_end(digest)
+        if entry.url != url:
+            entry = attr.evolve(entry, url=url)
+        return entry
+
+    def put(self, downloaded):
+        """
+        Cache ``downloaded`` and return the cached entry for its URL.
+        If the content is already cached under another URL, that
+        entry is kept and returned with the new URL.
+        """
+        self._urls[downloaded.url] = downloaded.digest
+        self._urls.move_to_end(downloaded.url)
+        while len(self._urls) > self._max_urls:
+            self._urls.popitem(last=False)
+        existing = self._entries.get(downloaded.digest)
+        if existing is not None:
+            self._entries.move_to_end(downloaded.digest)
+            # The same content on disk is the same file
+            if downloaded.path != existing.path:
+                self._discard(downloaded)
+            if existing.url != downloaded.url:
+                existing = attr.evolve(existing, url=downloaded.url)
+            return existing
+        self._entries[downloaded.digest] = downloaded
+        self._size += downloaded.size
+        while self._size > self._max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+            self._discard(evicted)
+        return downloaded
+
+    def _discard(self, downloaded):
+        pass
+
+
+class MemoryAttachmentCache(_ContentAddressedCache):
+    """
+    Keeps downloaded content in memory, up to ``max_bytes`` in total.
+    """
+    def __init__(self, *, max_bytes=64 * 1024 * 1024, max_urls=100000):
+        super().__init__(max_bytes, max_urls)
+
+
+class DiskAttachmentCache(_ContentAddressedCache):
+    """
+    Keeps downloaded content in files named by digest in
+    ``directory``, up to ``max_bytes`` in total. Cache files left from
+    a previous run are removed; other files in the directory are left
+    alone.
+    """
+    def __init__(self, directory, *, max_bytes=1024 * 1024 * 1024,
+                 max_urls=100000):
+        super().__init__(max_bytes, max_urls)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if (name.startswith((_FILE_PREFIX, _TEMPORARY_PREFIX))
+                    and os.path.isfile(path)):
+                os.unlink(path)
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, _FILE_PREFIX + digest)
+
+    def _discard(self, downloaded):
+        try:
+            os.unlink(downloaded.path)
+        except FileNotFoundError:
+            pass
+
+
+class AttachmentService:
+    """
+    Downloads received media with bounded concurrency, at most once
+    per URL at a time, caching the results.
+
+    Arguments:
+        session (:class:`aiohttp.ClientSession`):
+            The HTTP session to download with.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        memory_cache (:class:`MemoryAttachmentCache`):
+            Where content downloaded into memory is kept.
+        disk_cache (:class:`DiskAttachmentCache` or None):
+            Where content of the ``stream_types`` is streamed to. If
+            ``None``, everything is downloaded into memory.
+        max_concurrency (int):
+            The most downloads running at once.
+        max_size (int):
+            The largest download allowed, in bytes.
+        stream_types, prefetch_types:
+            As for :class:`AttachmentConfig`.
+    """
+    def __init__(self, session, *, loop, memory_cache=None, disk_cache=None,
+                 max_concurrency=8, max_size=25 * 1024 * 1024,
+                 stream_types=DEFAULT_STREAM_TYPES,
+                 prefetch_types=DEFAULT_PREFETCH_TYPES):
+        self._session = session
+        self._loop = loop
+        self._memory_cache = memory_cache or MemoryAttachmentCache()
+        self._disk_cache = disk_cache
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_size = max_size
+        self._stream_types = stream_types
+        self._prefetch_types = prefetch_types
+        # Map of URL -> download task
+        self._downloads = {}
+        self._executor = None
+        if disk_cache is not None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+
+    def prefetch_event(self, event):
+        """
+        Start downloading the media of the prefetch types attached to
+        a messaging event.
+        """
+        for attachment in event.attachments or ():
+            if attachment.type in self._prefetch_types:
+                self._download(attachment.url, attachment.type)
+
+    async def fetch(self, attachment):
+        """
+        Return a :class:`DownloadedAttachment` for the
+        :class:`fbemissary.models.MediaAttachment`, downloading it
+        unless it is cached or already being downloaded.
+
+        Raises :class:`AttachmentError` if the download fails.
+        """
+        return await self.fetch_url(attachment.url, attachment.type)
+
+    async def fetch_url(self, url, attachment_type=None):
+        cached = self._cached(url)
+        if cached is not None:
+            return cached
+        # Shielded so one cancelled handler doesn't cancel the
+        # download for the others waiting on it.
+        return await asyncio.shield(self._download(url, attachment_type))
+
+    async def close(self):
+        for task in list(self._downloads.values()):
+            task.cancel()
+        if self._downloads:
+            await asyncio.wait(list(self._downloads.values()))
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _cached(self, url):
+        cached = self._memory_cache.get(url)
+        if cached is None and self._disk_cache is not None:
+            cached = self._disk_cache.get(url)
+        return cached
+
+    def _download(self, url, attachment_type):
+        task = self._downloads.get(url)
+        if task is None:
+            task = self._loop.create_task(
+                self._download_once(url, attachment_type))
+            self._downloads[url] = task
+            task.add_done_callback(
+                functools.partial(self._download_done, url))
+        return task
+
+    def _download_done(self, url, task):
+        del self._downloads[url]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                'Failed to download attachment %r: %s', url, task.exception())
+
+    async def _download_once(self, url, attachment_type):
+        cached = self._cached(url)
+        if cached is not None:
+            return cached
+        stream = (
+            self._disk_cache is not None
+            and attachment_type in self._stream_types)
+        async with self._semaphore:
+            try:
+                async with self._session.get(url) as response:
+                    if response.status != 200:
+                        raise AttachmentError(
+                            'Attachment download returned HTTP {0}'.format(
+                                response.status))
+                    if (response.content_length is not None
+                            and response.content_length > self._max_size):
+                        raise AttachmentTooLarge(
+                            'Attachment is {0} bytes, limit is {1}'.format(
+                                response.content_length, self._max_size))
+                    if stream:
+                        downloaded = await self._stream_to_disk(
+                            url, response)
+                    else:
+                        downloaded = await self._read_into_memory(
+                            url, response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                raise AttachmentError(
+                    'Attachment download failed: {0!r}'.format(exc)) from exc
+        if stream:
+            return self._disk_cache.put(downloaded)
+        return self._memory_cache.put(downloaded)
+
+    async def _read_into_memory(self, url, response):
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+            size += len(chunk)
+            self._check_size(size)
+            chunks.append(chunk)
+        data = b''.join(chunks)
+        return DownloadedAttachment(
+            url=url,
+            digest=hashlib.sha256(data).hexdigest(),
+            size=size,
+            content_type=response.content_type,
+            data=data,
+        )
+
+    async def _stream_to_disk(self, url, response):
+        hasher = hashlib.sha256()
+        size = 0
+        fd, temporary_path = tempfile.mkstemp(
+            dir=self._disk_cache.directory, prefix=_TEMPORARY_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+                    size += len(chunk)
+                    self._check_size(size)
+                    hasher.update(chunk)
+                    await self._loop.run_in_executor(
+                        self._executor, f.write, chunk)
+            digest = hasher.hexdigest()
+            path = self._disk_cache.path_for(digest)
+            os.replace(temporary_path, path)
+        except BaseException:
+            try:
+                os.unlink(temporary_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return DownloadedAttachment(
+            url=url,
+            digest=digest,
+            size=size,
+            content_type=response.content_type,
+            path=path,
+        )
+
+    def _check_size(self, size):
+        if size > self._max_size:
+            raise AttachmentTooLarge(
+                'Attachment exceeds the {0} byte limit'.format(
+                    self._max_size))
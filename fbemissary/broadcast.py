@@ -0,0 +1,258 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Sending one message to many recipients
+
+A :class:`Broadcaster` sends a message through a
+:class:`fbemissary.client.PageMessagingAPIClient` to every recipient
+from an iterable, such as a generator or :func:`recipients_from_file`.
+Recipients are consumed as they are sent to, so memory use does not
+grow with their number. Progress is checkpointed to a file so an
+interrupted broadcast can be resumed where it stopped.
+"""
+import os
+import json
+import asyncio
+import logging
+
+import attr
+
+from fbemissary import client
+
+
+logger = logging.getLogger(__name__)
+
+
+def recipients_from_file(path):
+    """
+    Yield the recipient IDs in the file at ``path``, one per line.
+    Blank lines are skipped.
+    """
+    with open(path, 'r', encoding='utf-8') as lines:
+        for line in lines:
+            recipient_id = line.strip()
+            if recipient_id:
+                yield recipient_id
+
+
+@attr.s(slots=True)
+class BroadcastResult:
+    """
+    The outcome of sending to one recipient.
+
+    Attributes:
+        index (int):
+            The recipient's position in the recipient iterable.
+        recipient_id (str):
+            The recipient's page-scoped ID.
+        structure (dict or None):
+            The Send API response, if the message was sent.
+        error (Exception or None):
+            Why the message wasn't sent, usually a
+            :class:`fbemissary.client.SendAPIError`.
+    """
+    index = attr.ib()
+    recipient_id = attr.ib()
+    structure = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@attr.s
+class BroadcastStats:
+    sent = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    #: Recipients skipped because the checkpoint showed them done
+    skipped = attr.ib(default=0)
+    elapsed = attr.ib(default=0.0)
+
+
+class Broadcaster:
+    """
+    Sends ``message_payload`` to many recipients.
+
+    Arguments:
+        page_messaging_client
+                (:class:`fbemissary.client.PageMessagingAPIClient`):
+            The client of the page to send as. Its retry policy and
+            send dispatch configuration apply.
+        message_payload (dict or callable):
+            The Send API ``message`` object, or a callable returning
+            it for a given recipient ID.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        concurrency (int):
+            The most messages in flight at once.
+        rate (float or None):
+            If given, the most messages sent per second on average by
+            all the page's broadcasts together; see
+            :meth:`fbemissary.client.PageMessagingAPIClient.broadcast_bucket`.
+        burst (int or None):
+            How many messages may be sent at once before ``rate``
+            applies. Defaults to ``concurrency``.
+        checkpoint_path (str or None):
+            If given, the number of leading recipients that are done
+            is saved to this file as the broadcast progresses, and a
+            broadcast started with an existing checkpoint skips them.
+        checkpoint_interval (float):
+            Seconds between checkpoint writes.
+        result_sink (callable or None):
+            Called with a :class:`BroadcastResult` for each recipient,
+            as soon as its send finishes, in no particular order.
+    """
+    def __init__(self, page_messaging_client, message_payload, *, loop,
+                 concurrency=16, rate=None, burst=None,
+                 checkpoint_path=None, checkpoint_interval=5.0,
+                 result_sink=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self._client = page_messaging_client
+        if callable(message_payload):
+            self._make_payload = message_payload
+        else:
+            self._make_payload = lambda recipient_id: message_payload
+        self._loop = loop
+        self._concurrency = concurrency
+        if rate is not None:
+            self._bucket = page_messaging_client.broadcast_bucket(
+                rate, burst or concurrency, loop=loop)
+        else:
+            self._bucket = None
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = checkpoint_interval
+        self._result_sink = result_sink
+        # Every recipient before this index is done
+        self._watermark = 0
+        # Runs of done indexes past the watermark, as maps of run
+        # start -> end and end -> start (exclusive). There is a run
+        # per gap left by a send still in flight, so however long one
+        # is stuck retrying there are at most about ``concurrency``.
+        self._done_starts = {}
+        self._done_ends = {}
+        self._last_checkpoint = None
+        self._saver = None
+        self._unsaved = False
+        self._stats = None
+
+    async def run(self, recipients):
+        """
+        Send to every recipient ID from the iterable ``recipients`` and
+        return a :class:`BroadcastStats`.
+
+        To resume, pass the same recipients in the same order.
+        """
+        started = self._loop.time()
+        self._stats = BroadcastStats()
+        self._watermark = await self._loop.run_in_executor(
+            None, self._load_checkpoint)
+        self._done_starts = {}
+        self._done_ends = {}
+        self._last_checkpoint = started
+        numbered = enumerate(recipients)
+        workers = [
+            self._loop.create_task(self._work(numbered))
+            for _ in range(self._concurrency)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._request_save()
+            if self._saver is not None:
+                await self._saver
+        self._stats.elapsed = self._loop.time() - started
+        logger.info(
+            'Broadcast finished: %d sent, %d failed, %d skipped in %.1fs',
+            self._stats.sent, self._stats.failed, self._stats.skipped,
+            self._stats.elapsed)
+        return self._stats
+
+    async def _work(self, numbered):
+        # Workers share the iterator, each taking the next recipient
+        # when it's free.
+        for index, recipient_id in numbered:
+            if index < self._watermark:
+                self._stats.skipped += 1
+                continue
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            result = await self._send(index, recipient_id)
+            if result.ok:
+                self._stats.sent += 1
+            else:
+                self._stats.failed += 1
+            if self._result_sink is not None:
+                self._result_sink(result)
+            self._mark_done(index)
+
+    async def _send(self, index, recipient_id):
+        try:
+            structure = await self._client.send_message(
+                recipient_id, self._make_payload(recipient_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            if not isinstance(exc, client.SendAPIError):
+                logger.exception(
+                    'Unexpected error broadcasting to %r', recipient_id)
+            return BroadcastResult(index, recipient_id, error=exc)
+        return BroadcastResult(index, recipient_id, structure=structure)
+
+    def _mark_done(self, index):
+        start, end = index, index + 1
+        if start in self._done_ends:
+            start = self._done_ends.pop(start)
+            del self._done_starts[start]
+        if end in self._done_starts:
+            end = self._done_starts.pop(end)
+            del self._done_ends[end]
+        if start == self._watermark:
+            self._watermark = end
+        else:
+            self._done_starts[start] = end
+            self._done_ends[end] = start
+        now = self._loop.time()
+        if now - self._last_checkpoint >= self._checkpoint_interval:
+            self._last_checkpoint = now
+            self._request_save()
+
+    def _load_checkpoint(self):
+        if self._checkpoint_path is None:
+            return 0
+        try:
+            with open(self._checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)['completed']
+        except FileNotFoundError:
+            return 0
+
+    def _request_save(self):
+        if self._checkpoint_path is None:
+            return
+        self._unsaved = True
+        if self._saver is None:
+            self._saver = self._loop.create_task(self._save_unsaved())
+
+    async def _save_unsaved(self):
+        try:
+            while self._unsaved:
+                self._unsaved = False
+                await self._loop.run_in_executor(
+                    None, self._save_checkpoint, self._watermark)
+        except Exception:
+            logger.exception(
+                'Failed to save broadcast checkpoint to %r',
+                self._checkpoint_path)
+        finally:
+            self._saver = None
+
+    def _save_checkpoint(self, completed):
+        # Write then rename, so a crash never leaves a torn checkpoint
+        temporary_path = self._checkpoint_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({'completed': completed}, f)
+        os.replace(temporary_path, self._checkpoint_path)
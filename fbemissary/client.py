@@ -6,40 +6,1252 @@ Facebook Messenger Platform API clients
 """
 import urllib.parse
 import logging
+import asyncio
+import random
+import enum
+import time
+import functools
+import collections
+
+import aiohttp
+import attr
+
+from fbemissary import jsoncodec
 
 
 logger = logging.getLogger(__name__)
 
+# The most requests the Graph API accepts in a single batch request.
+MAX_GRAPH_BATCH_SIZE = 50
+
+GRAPH_API_BASE_URL = 'https://graph.facebook.com/v2.8/'
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class ErrorKind(enum.Enum):
+    #: Worth retrying after a short delay
+    transient = 'transient'
+    #: Rate limited, worth retrying after a longer delay
+    throttled = 'throttled'
+    #: Retrying will not help
+    permanent = 'permanent'
+
+
+# Graph API error codes, see
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+TRANSIENT_ERROR_CODES = frozenset({
+    1,     # API Unknown
+    2,     # API Service
+    1200,  # Temporary send message failure
+})
+THROTTLED_ERROR_CODES = frozenset({
+    4,    # Application request limit reached
+    17,   # User request limit reached
+    32,   # Page request limit reached
+    613,  # Calls within one hour exceeded
+})
+
+
+class SendAPIError(Exception):
+    """
+    A Send API request failed.
+
+    Attributes:
+        kind (:class:`ErrorKind`):
+            Whether retrying the request could help.
+        code (int or None):
+            The Graph API error code, if Facebook gave one.
+        subcode (int or None):
+            The Graph API error subcode, if Facebook gave one.
+        status (int or None):
+            The HTTP status of the response, if there was one.
+        structure (dict or None):
+            The decoded error response, if there was one.
+    """
+    def __init__(self, message, kind, *, code=None, subcode=None,
+                 status=None, structure=None):
+        super().__init__(message)
+        self.kind = kind
+        self.code = code
+        self.subcode = subcode
+        self.status = status
+        self.structure = structure
+
+
+class CircuitOpenError(SendAPIError):
+    """
+    The circuit breaker for the page is open, so the request was not
+    attempted.
+    """
+    def __init__(self, message):
+        super().__init__(message, ErrorKind.transient)
+
+
+def classify_error(status, structure):
+    """
+    Return the :class:`ErrorKind` of a Graph API response with the
+    HTTP ``status`` and decoded body ``structure`` (``None`` if the
+    body was not JSON), or ``None`` if the response is a success.
+    """
+    error = None
+    if isinstance(structure, dict):
+        error = structure.get('error')
+    if error is None:
+        if status < 400:
+            return None
+        if status == 429:
+            return ErrorKind.throttled
+        if status >= 500:
+            return ErrorKind.transient
+        return ErrorKind.permanent
+    code = error.get('code')
+    if code in THROTTLED_ERROR_CODES or status == 429:
+        return ErrorKind.throttled
+    if (
+            code in TRANSIENT_ERROR_CODES
+            or error.get('is_transient')
+            or status >= 500
+        ):
+        return ErrorKind.transient
+    return ErrorKind.permanent
+
+
+def error_from_response(status, structure):
+    """
+    Return a :class:`SendAPIError` for a failed Graph API response, or
+    ``None`` if the response is a success.
+    """
+    kind = classify_error(status, structure)
+    if kind is None:
+        return None
+    error = {}
+    if isinstance(structure, dict):
+        error = structure.get('error') or {}
+    message = error.get('message') or 'HTTP status {0}'.format(status)
+    return SendAPIError(
+        message, kind,
+        code=error.get('code'),
+        subcode=error.get('error_subcode'),
+        status=status,
+        structure=structure,
+    )
+
+
+@attr.s(frozen=True)
+class RetryPolicy:
+    """
+    How a :class:`PageMessagingAPIClient` retries failed sends.
+
+    Delays grow exponentially from ``base_delay`` (or
+    ``throttled_base_delay`` when rate limited) up to ``max_delay``,
+    and are fully jittered so callers don't retry in lockstep.
+
+    After ``failure_threshold`` consecutive requests failing
+    transiently or throttled (a batch request counting once, however
+    many messages it carried) the page's circuit breaker opens, and
+    sends fail fast with :class:`CircuitOpenError` for
+    ``reset_timeout`` seconds, after which a single trial request is
+    let through.
+
+    Attributes:
+        max_attempts (int):
+            The most times a message is tried, including the first.
+        base_delay (float):
+            The upper bound in seconds of the first retry delay.
+        throttled_base_delay (float):
+            Like ``base_delay``, for rate limiting errors.
+        max_delay (float):
+            The largest upper bound in seconds for a retry delay.
+        failure_threshold (int):
+            Consecutive failures that open the circuit breaker.
+        reset_timeout (float):
+            Seconds the circuit breaker stays open.
+    """
+    max_attempts = attr.ib(default=4)
+    base_delay = attr.ib(default=0.5)
+    throttled_base_delay = attr.ib(default=5.0)
+    max_delay = attr.ib(default=30.0)
+    failure_threshold = attr.ib(default=10)
+    reset_timeout = attr.ib(default=30.0)
+
+    def delay(self, kind, attempt):
+        """
+        Return the seconds to wait before retry number ``attempt``
+        (starting at 1) after an error of :class:`ErrorKind` ``kind``.
+        """
+        if kind is ErrorKind.throttled:
+            base = self.throttled_base_delay
+        else:
+            base = self.base_delay
+        ceiling = min(self.max_delay, base * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Stops sends for a page while Facebook keeps failing them.
+    """
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout, *,
+                 clock=time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.closed
+        if self._clock() - self._opened_at >= self._reset_timeout:
+            return self.half_open
+        return self.open
+
+    def before_request(self):
+        """
+        Raise :class:`CircuitOpenError` if a request may not be made
+        now.
+        """
+        state = self.state
+        if state == self.closed:
+            return
+        if state == self.half_open and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        raise CircuitOpenError('Circuit breaker open, not sending')
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._trial_in_flight or self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                logger.warning(
+                    'Opening circuit breaker after %d failures',
+                    self._failures)
+            self._opened_at = self._clock()
+        self._trial_in_flight = False
+
+    def record_neutral(self):
+        """
+        Record a request that failed for reasons that don't reflect on
+        Facebook's health, such as a permanent error.
+        """
+        if self._trial_in_flight:
+            self.record_success()
+
+    def record_abandoned(self):
+        """
+        Record a request that ended without an outcome, for example
+        because it was cancelled. A half-open breaker lets the next
+        request through as its trial.
+        """
+        self._trial_in_flight = False
+
+
+def _record_outcome(breaker, results):
+    """
+    Record the outcome of one Graph API request with ``breaker``, given
+    the response structure or :class:`SendAPIError` for each message
+    it carried. The request succeeded if any message did, and failed
+    if none did and one failed transiently or was throttled.
+    """
+    errors = [
+        result for result in results if isinstance(result, SendAPIError)]
+    if len(errors) < len(results):
+        breaker.record_success()
+    elif any(error.kind is not ErrorKind.permanent for error in errors):
+        breaker.record_failure()
+    else:
+        breaker.record_neutral()
+
+
+@attr.s(frozen=True)
+class ConnectionPoolConfig:
+    """
+    Configuration for the outbound HTTP connection pool shared by all
+    page clients.
+
+    Attributes:
+        limit (int):
+            The most connections open at once, or 0 for no limit.
+        limit_per_host (int):
+            The most connections open at once to a single host
+            (in practice graph.facebook.com), or 0 for no limit.
+        keepalive_timeout (float):
+            Seconds an idle connection is kept open for reuse.
+        ttl_dns_cache (int or None):
+            Seconds DNS lookups are cached, or ``None`` to cache them
+            forever.
+        total_timeout (float or None):
+            Seconds allowed for a whole request, including reading
+            the response.
+        connect_timeout (float or None):
+            Seconds allowed for acquiring and establishing a
+            connection.
+    """
+    limit = attr.ib(default=100)
+    limit_per_host = attr.ib(default=0)
+    keepalive_timeout = attr.ib(default=30.0)
+    ttl_dns_cache = attr.ib(default=300)
+    total_timeout = attr.ib(default=30.0)
+    connect_timeout = attr.ib(default=5.0)
+
+    def make_session(self):
+        """
+        Return a new :class:`aiohttp.ClientSession` using a connector
+        set up according to this configuration. Must be called from a
+        coroutine.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.total_timeout, connect=self.connect_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@attr.s
+class ConnectionPoolStats:
+    limit = attr.ib()
+    limit_per_host = attr.ib()
+    #: Connections currently serving a request
+    acquired = attr.ib()
+    #: Open connections waiting to be reused
+    idle = attr.ib()
+    #: Requests waiting for a connection to become available
+    waiting = attr.ib()
+    #: Map of host name to the number of connections serving requests
+    acquired_per_host = attr.ib()
+
+
+def connection_pool_stats(connector):
+    """
+    Return a :class:`ConnectionPoolStats` for an
+    :class:`aiohttp.BaseConnector`.
+
+    aiohttp does not expose these numbers publicly, so they are read
+    from the connector's internals, defaulting to zero if those change.
+    """
+    acquired_per_host = {}
+    for key, protocols in getattr(connector, '_acquired_per_host', {}).items():
+        if protocols:
+            host = getattr(key, 'host', str(key))
+            acquired_per_host[host] = (
+                acquired_per_host.get(host, 0) + len(protocols))
+    return ConnectionPoolStats(
+        limit=connector.limit,
+        limit_per_host=connector.limit_per_host,
+        acquired=len(getattr(connector, '_acquired', ())),
+        idle=sum(len(c) for c in getattr(connector, '_conns', {}).values()),
+        waiting=sum(
+            len(w) for w in getattr(connector, '_waiters', {}).values()),
+        acquired_per_host=acquired_per_host,
+    )
+
+
+@attr.s
+class SendDispatchConfig:
+    """
+    Configuration for queueing outbound Send API messages per page.
+
+    Attributes:
+        max_batch_size (int):
+            The most messages coalesced into a single Graph API batch
+            request, at most 50. With 1, every message is sent with
+            its own request.
+        batch_window (float):
+            Seconds to wait for more messages to fill a batch after
+            the first one arrives.
+        rate (float or None):
+            The sustained number of messages per second allowed for
+            the page, or ``None`` for no limit.
+        burst (int or None):
+            How many messages may be sent at once before ``rate``
+            applies. Defaults to ``max_batch_size``.
+        max_in_flight (int):
+            The most HTTP requests outstanding at once for the page.
+    """
+    max_batch_size = attr.ib(default=MAX_GRAPH_BATCH_SIZE)
+    batch_window = attr.ib(default=0.01)
+    rate = attr.ib(default=None)
+    burst = attr.ib(default=None)
+    max_in_flight = attr.ib(default=4)
+
+    @max_batch_size.validator
+    def _check_max_batch_size(self, attribute, value):
+        if not 1 <= value <= MAX_GRAPH_BATCH_SIZE:
+            raise ValueError(
+                'max_batch_size must be between 1 and {0}'.format(
+                    MAX_GRAPH_BATCH_SIZE))
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing ``rate`` tokens per second on average, with
+    bursts of up to ``capacity`` tokens.
+
+    Acquiring more tokens than are available puts the bucket into
+    debt, so concurrent callers are paced one after the other.
+    """
+    def __init__(self, rate, capacity, *, loop):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self._rate = rate
+        self._capacity = capacity
+        self._loop = loop
+        self._tokens = capacity
+        self._updated = loop.time()
+
+    async def acquire(self, tokens=1):
+        now = self._loop.time()
+        self._tokens = min(
+            self._capacity,
+            self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= tokens
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class SendDispatcher:
+    """
+    Queue of outbound messages for one page, sent by a
+    :class:`PageMessagingAPIClient` in batches while respecting the
+    rate and concurrency limits in a :class:`SendDispatchConfig`.
+
+    Every submitted message gets its own response back.
+    """
+    def __init__(self, page_messaging_client, config, *, loop):
+        self._client = page_messaging_client
+        self._config = config
+        self._loop = loop
+        self._pending = asyncio.Queue()
+        self._in_flight = asyncio.Semaphore(config.max_in_flight)
+        self._sending = set()
+        if config.rate is not None:
+            burst = config.burst
+            if burst is None:
+                burst = config.max_batch_size
+            self._bucket = TokenBucket(config.rate, burst, loop=loop)
+        else:
+            self._bucket = None
+        self._runner = None
+
+    async def submit(self, payload):
+        """
+        Queue the Send API ``payload`` and wait for its response
+        structure.
+        """
+        if self._runner is None:
+            self._runner = self._loop.create_task(self._run())
+        future = self._loop.create_future()
+        self._pending.put_nowait((payload, future))
+        return await future
+
+    async def close(self):
+        """
+        Wait for every queued message to be sent, then stop.
+        """
+        if self._runner is None:
+            return
+        await self._pending.join()
+        if self._sending:
+            await asyncio.wait(list(self._sending))
+        self._runner.cancel()
+        try:
+            await self._runner
+        except asyncio.CancelledError:
+            pass
+        self._runner = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._pending.get()]
+            if self._config.max_batch_size > 1:
+                self._take_pending(batch)
+                if len(batch) < self._config.max_batch_size:
+                    await asyncio.sleep(self._config.batch_window)
+                    self._take_pending(batch)
+            batch = self._drop_abandoned(batch)
+            if not batch:
+                continue
+            if self._bucket is not None:
+                await self._bucket.acquire(len(batch))
+            await self._in_flight.acquire()
+            task = self._loop.create_task(self._send_batch(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _take_pending(self, batch):
+        while len(batch) < self._config.max_batch_size:
+            try:
+                batch.append(self._pending.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    def _drop_abandoned(self, batch):
+        kept = []
+        for item in batch:
+            if item[1].cancelled():
+                self._pending.task_done()
+            else:
+                kept.append(item)
+        return kept
+
+    async def _send_batch(self, batch):
+        page_client = self._client
+        try:
+            # One outcome per request for the circuit breaker, however
+            # many messages it carried
+            results = await page_client._guarded(
+                functools.partial(
+                    page_client._post_messages,
+                    [payload for payload, _ in batch]),
+                batch=True)
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._in_flight.release()
+            for _ in batch:
+                self._pending.task_done()
+
 
 class PageMessagingAPIClient:
     """
     Client for Facebook Messenger's Send API.
+
+    If a ``dispatch_config`` (a :class:`SendDispatchConfig`) is given,
+    messages are queued and sent through a :class:`SendDispatcher`
+    instead of each with its own request. The ``loop`` must then be
+    given too.
+
+    Failed sends are retried according to ``retry_policy`` (a
+    :class:`RetryPolicy`, by default with its default settings), and
+    raise :class:`SendAPIError` once retrying is exhausted or can't
+    help. Pass ``retry_policy=None`` to disable retries and the
+    circuit breaker.
+
+    ``graph_api_base_url`` can point the client at a stand-in for the
+    Graph API, such as the one in the benchmark suite.
+
+    If an ``instrumentation`` (a
+    :class:`fbemissary.metrics.Instrumentation`) is given, the latency
+    of each Send API and attachment upload request is recorded by
+    HTTP status, and each request is traced.
+
+    Request bodies are encoded with ``json_dumps``, by default
+    :func:`fbemissary.jsoncodec.dumps`, and the responses within batch
+    requests decoded with ``json_loads``, by default
+    :func:`fbemissary.jsoncodec.loads`.
+
+    ``page_id`` identifies the page the client sends as, for callers
+    keeping per-page data such as uploaded attachment IDs.
     """
-    def __init__(self, session, page_access_token):
-        graph_api_version = 'v2.8'
-        self._base_url = 'https://graph.facebook.com/{ver}/'.format(
-            ver=graph_api_version)
-        self._page_access_token = page_access_token
+    def __init__(self, session, page_access_token, *,
+                 dispatch_config=None, retry_policy=RetryPolicy(),
+                 graph_api_base_url=GRAPH_API_BASE_URL, instrumentation=None,
+                 json_dumps=None, json_loads=None, page_id=None,
+                 loop=None):
+        if dispatch_config is not None and loop is None:
+            raise ValueError('loop must be given with dispatch_config')
+        self.page_id = page_id
+        self._base_url = graph_api_base_url
+        self._instrumentation = instrumentation
+        self._json_dumps = json_dumps or jsoncodec.dumps
+        self._json_loads = json_loads or jsoncodec.loads
+        self._endpoints = PageEndpoints.for_page(
+            graph_api_base_url, page_access_token)
         self._session = session
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._retry_policy = retry_policy
+        if retry_policy is not None:
+            self._breaker = CircuitBreaker(
+                retry_policy.failure_threshold, retry_policy.reset_timeout)
+        else:
+            self._breaker = None
+        if dispatch_config is not None:
+            self._dispatcher = SendDispatcher(
+                self, dispatch_config, loop=loop)
+        else:
+            self._dispatcher = None
+        self._broadcast_bucket = None
+
+    def broadcast_bucket(self, rate, capacity, *, loop):
+        """
+        Return the :class:`TokenBucket` pacing every
+        :class:`fbemissary.broadcast.Broadcaster` sending as this page,
+        so concurrent broadcasts share one rate limit. It is created
+        with ``rate`` and ``capacity`` by the first broadcaster asking
+        for it; later ones with other limits share it as it is.
+        """
+        bucket = self._broadcast_bucket
+        if bucket is None:
+            bucket = self._broadcast_bucket = TokenBucket(
+                rate, capacity, loop=loop)
+        elif (bucket._rate, bucket._capacity) != (rate, capacity):
+            logger.warning(
+                'Broadcast rate limit for page %r is already %r/s with '
+                'bursts of %r, ignoring %r/s with bursts of %r',
+                self.page_id, bucket._rate, bucket._capacity, rate,
+                capacity)
+        return bucket
 
-    def _make_url(self, components):
-        escaped_components = [urllib.parse.quote(c) for c in components]
-        url = self._base_url + '/'.join(escaped_components)
-        query = urllib.parse.urlencode({
-            'access_token': self._page_access_token,
-        })
-        return '{url}?{query}'.format(url=url, query=query)
+    def rotate_access_token(self, page_access_token):
+        """
+        Send with ``page_access_token`` from now on. Requests already
+        made finish with the old token; retries and queued messages
+        use the new one.
+        """
+        # Swapped as a whole, so a request never mixes the two tokens
+        self._endpoints = PageEndpoints.for_page(
+            self._base_url, page_access_token)
 
     async def send_message(self, recipient_id, message_payload):
         payload = {
             'recipient': {'id': recipient_id},
             'message': message_payload,
         }
-        url = self._make_url(['me', 'messages'])
-        async with self._session.post(url, json=payload) as response:
-            structure = await response.json()
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            if self._retry_policy is None:
+                return await self._send_once(payload)
+            return await self._with_retries(
+                functools.partial(self._send_once, payload))
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def upload_attachment(self, attachment_type, *, url=None,
+                                data=None, filename=None,
+                                content_type=None):
+        """
+        Upload media with the Attachment Upload API and return its
+        reusable attachment ID, which can be sent any number of times
+        with :meth:`send_message`.
+
+        Arguments:
+            attachment_type (str):
+                One of ``'image'``, ``'audio'``, ``'video'`` or
+                ``'file'``.
+            url (str or None):
+                A URL Facebook fetches the media from.
+            data (bytes or None):
+                The media itself, if no ``url`` is given.
+            filename (str or None):
+                The file name sent along with ``data``.
+            content_type (str or None):
+                The media type of ``data``.
+
+        Uploads are retried, and count towards the circuit breaker,
+        like sends.
+        """
+        if (url is None) == (data is None):
+            raise ValueError('Exactly one of url and data must be given')
+        attachment = {
+            'type': attachment_type,
+            'payload': {'is_reusable': True},
+        }
+        if url is not None:
+            attachment['payload']['url'] = url
+        upload = functools.partial(
+            self._guarded, functools.partial(
+                self._post_attachment, attachment, data, filename,
+                content_type))
+        if self._retry_policy is None:
+            structure = await upload()
+        else:
+            structure = await self._with_retries(upload)
+        return structure['attachment_id']
+
+    async def fetch_user_profiles(self, user_ids, fields):
+        """
+        Fetch the ``fields`` of several users' profiles with a single
+        Graph API request, returning a dict of user ID to profile
+        structure.
+        """
+        endpoints = self._endpoints
+        url = '{0}?{1}'.format(self._base_url, urllib.parse.urlencode({
+            'ids': ','.join(user_ids),
+            'fields': ','.join(fields),
+            'access_token': endpoints.access_token,
+        }))
+        try:
+            async with self._session.get(url) as response:
+                status = response.status
+                structure = await _decode_json_body(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise SendAPIError(
+                'User profile request failed: {0!r}'.format(exc),
+                ErrorKind.transient) from exc
+        error = error_from_response(status, structure)
+        if error is not None:
+            raise error
+        return structure
+
+    @property
+    def in_flight(self):
+        """
+        The number of :meth:`send_message` calls not yet finished.
+        """
+        return self._in_flight
+
+    async def drain(self):
+        """
+        Wait until no :meth:`send_message` calls are in flight.
+        """
+        await self._idle.wait()
+
+    async def close(self):
+        """
+        Wait for queued messages to be sent.
+        """
+        if self._dispatcher is not None:
+            await self._dispatcher.close()
+
+    @property
+    def circuit_breaker(self):
+        """
+        The :class:`CircuitBreaker` for this page, or ``None`` if
+        retries are disabled.
+        """
+        return self._breaker
+
+    async def _with_retries(self, request):
+        """
+        Await ``request()``, which makes Graph API requests through
+        :meth:`_guarded`, retrying it as the retry policy allows.
+        """
+        policy = self._retry_policy
+        attempt = 1
+        while True:
+            try:
+                return await request()
+            except SendAPIError as exc:
+                error = exc
+            if (error.kind is ErrorKind.permanent
+                    or isinstance(error, CircuitOpenError)):
+                raise error
+            if attempt >= policy.max_attempts:
+                raise error
+            delay = policy.delay(error.kind, attempt)
+            logger.info(
+                'Graph API request failed (%s: %s), retrying in %.2fs',
+                error.kind.value, error, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _send_once(self, payload):
+        if self._dispatcher is not None:
+            return await self._dispatcher.submit(payload)
+        return await self._guarded(
+            functools.partial(self._post_message, payload))
+
+    async def _guarded(self, request, *, batch=False):
+        """
+        Await ``request()``, a single Graph API request, recording its
+        outcome with the circuit breaker if there is one. With
+        ``batch``, the request returns a result for each message it
+        carried, as :meth:`_post_messages` does.
+        """
+        breaker = self._breaker
+        if breaker is None:
+            return await request()
+        breaker.before_request()
+        try:
+            result = await request()
+        except SendAPIError as exc:
+            _record_outcome(breaker, [exc])
+            raise
+        except BaseException:
+            breaker.record_abandoned()
+            raise
+        _record_outcome(breaker, result if batch else [result])
+        return result
+
+    async def _post_message(self, payload):
+        instr = self._instrumentation
+        if instr is None:
+            return await self._request_message(payload, None)
+        with instr.span('fbemissary.send_message', page_id=self.page_id):
+            return await self._request_message(payload, instr)
+
+    async def _request_message(self, payload, instr):
+        url = self._endpoints.messages_url
+        body = self._json_dumps(payload)
+        if instr is not None:
+            started = instr.clock()
+        status = 'error'
+        try:
+            async with self._session.post(
+                    url, data=body, headers=_JSON_HEADERS) as response:
+                status = response.status
+                structure = await _decode_json_body(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise SendAPIError(
+                'Send API request failed: {0!r}'.format(exc),
+                ErrorKind.transient) from exc
+        finally:
+            if instr is not None:
+                instr.send_seconds.observe(
+                    instr.clock() - started, labels=(str(status),))
+        error = error_from_response(status, structure)
+        if error is not None:
+            raise error
+        return structure
+
+    async def _post_attachment(self, attachment, data, filename,
+                               content_type):
+        instr = self._instrumentation
+        if instr is None:
+            return await self._request_attachment(
+                attachment, data, filename, content_type, None)
+        with instr.span('fbemissary.upload_attachment',
+                        page_id=self.page_id):
+            return await self._request_attachment(
+                attachment, data, filename, content_type, instr)
+
+    async def _request_attachment(self, attachment, data, filename,
+                                  content_type, instr):
+        if data is None:
+            request_kwargs = {
+                'data': self._json_dumps({'message': {
+                    'attachment': attachment}}),
+                'headers': _JSON_HEADERS,
+            }
+        else:
+            # Built for each attempt, since a form can only be sent once
+            form = aiohttp.FormData()
+            form.add_field(
+                'message',
+                self._json_dumps({'attachment': attachment}).decode('utf-8'))
+            form.add_field(
+                'filedata', data,
+                filename=filename or 'attachment',
+                content_type=content_type or 'application/octet-stream')
+            request_kwargs = {'data': form}
+        if instr is not None:
+            started = instr.clock()
+        status = 'error'
+        try:
+            async with self._session.post(
+                    self._endpoints.attachments_url,
+                    **request_kwargs) as response:
+                status = response.status
+                structure = await _decode_json_body(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise SendAPIError(
+                'Attachment upload failed: {0!r}'.format(exc),
+                ErrorKind.transient) from exc
+        finally:
+            if instr is not None:
+                instr.upload_seconds.observe(
+                    instr.clock() - started, labels=(str(status),))
+        error = error_from_response(status, structure)
+        if error is not None:
+            raise error
         return structure
 
+    async def _post_messages(self, payloads):
+        """
+        Send several Send API payloads, returning a list with either a
+        response structure or a :class:`SendAPIError` for each, in the
+        same order.
+        """
+        if len(payloads) == 1:
+            try:
+                return [await self._post_message(payloads[0])]
+            except SendAPIError as exc:
+                return [exc]
+        dumps = self._json_dumps
+        batch = [
+            {
+                'method': 'POST',
+                'relative_url': 'me/messages',
+                'body': urllib.parse.urlencode({
+                    key: dumps(value).decode('utf-8')
+                    for key, value in payload.items()
+                }),
+            }
+            for payload in payloads
+        ]
+        endpoints = self._endpoints
+        form = {
+            'access_token': endpoints.access_token,
+            'batch': dumps(batch).decode('utf-8'),
+        }
+        instr = self._instrumentation
+        if instr is None:
+            status, items = await self._request_batch(
+                endpoints.batch_url, form, None)
+        else:
+            with instr.span('fbemissary.send_batch', page_id=self.page_id,
+                            size=len(payloads)):
+                status, items = await self._request_batch(
+                    endpoints.batch_url, form, instr)
+        error = error_from_response(status, items)
+        if error is not None:
+            raise error
+        results = []
+        for item in items:
+            if item is None:
+                # Facebook gave up on this request within the batch
+                results.append(SendAPIError(
+                    'Batched request timed out', ErrorKind.transient))
+                continue
+            try:
+                structure = self._json_loads(item['body'].encode('utf-8'))
+            except ValueError:
+                structure = None
+            error = error_from_response(item['code'], structure)
+            results.append(structure if error is None else error)
+        return results
+
+    async def _request_batch(self, url, form, instr):
+        if instr is not None:
+            started = instr.clock()
+        status = 'error'
+        try:
+            async with self._session.post(url, data=form) as response:
+                status = response.status
+                items = await _decode_json_body(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise SendAPIError(
+                'Batch request failed: {0!r}'.format(exc),
+                ErrorKind.transient) from exc
+        finally:
+            if instr is not None:
+                instr.send_seconds.observe(
+                    instr.clock() - started, labels=(str(status),))
+        return status, items
+
+
+@attr.s(frozen=True)
+class PageEndpoints:
+    """
+    The precomputed URLs a :class:`PageMessagingAPIClient` posts to,
+    with the page access token they embed. Replaced as a whole, never
+    modified.
+    """
+    access_token = attr.ib()
+    messages_url = attr.ib()
+    attachments_url = attr.ib()
+    batch_url = attr.ib()
+
+    @classmethod
+    def for_page(cls, base_url, access_token):
+        return cls(
+            access_token=access_token,
+            messages_url=_make_url(
+                base_url, ('me', 'messages'), access_token),
+            attachments_url=_make_url(
+                base_url, ('me', 'message_attachments'), access_token),
+            batch_url=base_url,
+        )
+
+
+def _make_url(base_url, components, access_token):
+    escaped_components = [urllib.parse.quote(c) for c in components]
+    url = base_url + '/'.join(escaped_components)
+    query = urllib.parse.urlencode({
+        'access_token': access_token,
+    })
+    return '{url}?{query}'.format(url=url, query=query)
+
+
+@functools.lru_cache(maxsize=256)
+def quick_replies(button_labels):
+    """
+    Return the Send API ``quick_replies`` list for a tuple of text
+    button labels, each label doubling as its payload.
+
+    Results are cached, so don't modify them.
+    """
+    return tuple(
+        {'content_type': 'text', 'title': label, 'payload': label}
+        for label in button_labels
+    )
+
+
+#: The profile fields a :class:`UserProfileService` fetches by default
+DEFAULT_PROFILE_FIELDS = (
+    'first_name', 'last_name', 'profile_pic', 'locale', 'timezone')
+
+
+@attr.s(frozen=True, slots=True)
+class UserProfile:
+    """
+    A user's public profile, as seen by a page.
+
+    Attributes:
+        id (str):
+            The page-scoped user ID.
+        first_name, last_name, profile_pic, locale (str or None):
+            The profile fields, ``None`` if not fetched or not
+            available.
+        timezone (float or None):
+            The user's offset from UTC in hours.
+        fields (dict):
+            Every fetched field, including any not listed above.
+    """
+    id = attr.ib()
+    first_name = attr.ib()
+    last_name = attr.ib()
+    profile_pic = attr.ib()
+    locale = attr.ib()
+    timezone = attr.ib()
+    fields = attr.ib(repr=False)
+
+    @classmethod
+    def from_structure(cls, user_id, structure):
+        return cls(
+            user_id,
+            structure.get('first_name'),
+            structure.get('last_name'),
+            structure.get('profile_pic'),
+            structure.get('locale'),
+            structure.get('timezone'),
+            structure,
+        )
+
+
+class UserProfileService:
+    """
+    Looks up user profiles through the Graph API, caching them.
+
+    Profiles are kept in memory for ``ttl`` seconds, for at most the
+    ``max_entries`` most recently used users. If a ``store`` (a
+    :class:`fbemissary.state.StateStore`, such as a
+    :class:`fbemissary.state.SQLiteStateStore` of its own) is given,
+    fetched profiles are also written to it and looked up there before
+    asking the Graph API, so they survive restarts.
+
+    Concurrent lookups of the same user share one request, and lookups
+    arriving within ``batch_window`` seconds of each other are fetched
+    together, up to ``max_batch_size`` users per request.
+
+    Pass it to a conversationalist factory to give every
+    conversationalist it makes a ``user_profiles`` attribute, and to
+    start fetching each counterpart's profile as soon as their
+    conversation is created.
+
+    Arguments:
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        fields (sequence of str):
+            The profile fields to fetch.
+    """
+    def __init__(self, *, loop, fields=DEFAULT_PROFILE_FIELDS,
+                 ttl=24 * 60 * 60, max_entries=10000, store=None,
+                 batch_window=0.01, max_batch_size=MAX_GRAPH_BATCH_SIZE):
+        self._loop = loop
+        self._fields = tuple(fields)
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._store = store
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        # Map of (page_id, user_id) -> (expiry loop time, UserProfile)
+        self._profiles = collections.OrderedDict()
+        # Map of (page_id, user_id) -> future of the lookup in progress
+        self._lookups = {}
+        # Map of page_id -> (page client, list of user IDs to fetch)
+        self._queued = {}
+        self._fetchers = set()
+
+    async def get_profile(self, page_messaging_client, user_id):
+        """
+        Return the :class:`UserProfile` of the user ``user_id`` as seen
+        by the page of the :class:`PageMessagingAPIClient`.
+
+        Raises :class:`SendAPIError` if it can't be fetched.
+        """
+        key = (page_messaging_client.page_id, user_id)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        return await asyncio.shield(
+            self._lookup(page_messaging_client, key))
+
+    def prefetch(self, page_messaging_client, user_id):
+        """
+        Start looking up a profile without waiting for it.
+        """
+        key = (page_messaging_client.page_id, user_id)
+        if self._cached(key) is None:
+            self._lookup(page_messaging_client, key)
+
+    async def close(self):
+        """
+        Cancel the lookups in progress. Safe to call more than once.
+        """
+        for fetcher in list(self._fetchers):
+            fetcher.cancel()
+        if self._fetchers:
+            await asyncio.wait(list(self._fetchers))
+        for future in self._lookups.values():
+            future.cancel()
+        self._lookups.clear()
+        self._queued.clear()
+
+    def _cached(self, key):
+        entry = self._profiles.get(key)
+        if entry is None:
+            return None
+        expires, profile = entry
+        if expires <= self._loop.time():
+            del self._profiles[key]
+            return None
+        self._profiles.move_to_end(key)
+        return profile
+
+    def _remember(self, key, profile, age=0):
+        self._profiles[key] = (self._loop.time() + self._ttl - age, profile)
+        self._profiles.move_to_end(key)
+        while len(self._profiles) > self._max_entries:
+            self._profiles.popitem(last=False)
+
+    def _lookup(self, page_messaging_client, key):
+        future = self._lookups.get(key)
+        if future is not None:
+            return future
+        future = self._lookups[key] = self._loop.create_future()
+        future.add_done_callback(_retrieve_exception)
+        page_id, user_id = key
+        queued = self._queued.get(page_id)
+        if queued is None:
+            queued = self._queued[page_id] = (page_messaging_client, [])
+            fetcher = self._loop.create_task(self._fetch_queued(page_id))
+            self._fetchers.add(fetcher)
+            fetcher.add_done_callback(self._fetchers.discard)
+        queued[1].append(user_id)
+        return future
+
+    async def _fetch_queued(self, page_id):
+        await asyncio.sleep(self._batch_window)
+        page_messaging_client, user_ids = self._queued.pop(page_id)
+        for start in range(0, len(user_ids), self._max_batch_size):
+            batch = user_ids[start:start + self._max_batch_size]
+            try:
+                await self._fetch_batch(page_messaging_client, page_id, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.exception('Unexpected error fetching user profiles')
+                for user_id in batch:
+                    self._resolve((page_id, user_id), exception=exc)
+
+    async def _fetch_batch(self, page_messaging_client, page_id, user_ids):
+        if self._store is not None:
+            user_ids = await self._load_stored(page_id, user_ids)
+        if not user_ids:
+            return
+        try:
+            structures = await page_messaging_client.fetch_user_profiles(
+                user_ids, self._fields)
+        except SendAPIError as exc:
+            if exc.kind is ErrorKind.permanent and len(user_ids) > 1:
+                # One bad ID fails the whole request; find out which
+                for user_id in user_ids:
+                    await self._fetch_batch(
+                        page_messaging_client, page_id, [user_id])
+                return
+            for user_id in user_ids:
+                self._resolve((page_id, user_id), exception=exc)
+            return
+        fetched = []
+        for user_id in user_ids:
+            structure = structures.get(user_id)
+            if structure is None:
+                self._resolve((page_id, user_id), exception=SendAPIError(
+                    'No profile returned for user', ErrorKind.permanent))
+                continue
+            self._resolve(
+                (page_id, user_id),
+                UserProfile.from_structure(user_id, structure))
+            fetched.append(((page_id, user_id), {
+                'fetched_at': time.time(), 'profile': structure}))
+        if self._store is not None and fetched:
+            try:
+                await self._store.save_many(fetched)
+            except Exception:
+                logger.exception('Failed to store user profiles')
+
+    async def _load_stored(self, page_id, user_ids):
+        """
+        Resolve the lookups the store has fresh profiles for, returning
+        the user IDs still to fetch.
+        """
+        missing = []
+        for user_id in user_ids:
+            key = (page_id, user_id)
+            try:
+                stored = await self._store.load(key)
+            except Exception:
+                logger.exception('Failed to load stored user profile')
+                stored = None
+            if stored is not None:
+                age = time.time() - stored['fetched_at']
+                if age < self._ttl:
+                    self._resolve(
+                        key,
+                        UserProfile.from_structure(
+                            user_id, stored['profile']),
+                        age=age)
+                    continue
+            missing.append(user_id)
+        return missing
+
+    def _resolve(self, key, profile=None, *, exception=None, age=0):
+        future = self._lookups.pop(key, None)
+        if exception is None:
+            self._remember(key, profile, age)
+        if future is None or future.done():
+            return
+        if exception is None:
+            future.set_result(profile)
+        else:
+            future.set_exception(exception)
+
+
+def _retrieve_exception(future):
+    # Prefetched lookups have nobody awaiting them
+    if not future.cancelled():
+        future.exception()
+
+
+async def _decode_json_body(response):
+    try:
+        return await response.json()
+    except (aiohttp.ContentTypeError, ValueError):
+        return None
+
 
 class ConversationReplierAPIClient:
     """
@@ -47,10 +1259,23 @@ class ConversationReplierAPIClient:
     for sending replies back to a specific user in a conversation.
 
     Passed into the conversationalist factory.
+
+    Media is sent by reusable attachment ID. If an
+    ``attachment_ids`` registry (a
+    :class:`fbemissary.uploads.AttachmentIdRegistry`) is given, each
+    file or URL is uploaded once and its ID reused for later sends;
+    without one, URLs are sent as they are and local files can't be
+    sent.
     """
-    def __init__(self, page_messaging_client, recipient_id):
+    def __init__(self, page_messaging_client, recipient_id,
+                 attachment_ids=None):
         self._client = page_messaging_client
         self._recipient_id = recipient_id
+        self._attachment_ids = attachment_ids
+
+    @property
+    def page_messaging_client(self):
+        return self._client
 
     async def send_text_message(self, message_text):
         message_payload = {'text': message_text}
@@ -64,13 +1289,9 @@ class ConversationReplierAPIClient:
 
     async def send_text_message_with_quickreplies(
             self, message_text, button_labels):
-        quick_replies = [
-            {'content_type': 'text', 'title': label, 'payload': label}
-            for label in button_labels
-        ]
         message_payload = {
             'text': message_text,
-            'quick_replies': quick_replies,
+            'quick_replies': quick_replies(tuple(button_labels)),
         }
         structure = await self._client.send_message(
             self._recipient_id, message_payload)
@@ -79,3 +1300,49 @@ class ConversationReplierAPIClient:
             'got API response %r',
             message_text, button_labels, self._recipient_id, structure)
         return structure
+
+    async def send_attachment(self, attachment_type, *, path=None, url=None,
+                              attachment_id=None):
+        """
+        Send media of ``attachment_type`` (``'image'``, ``'audio'``,
+        ``'video'`` or ``'file'``) from exactly one of a local file
+        ``path``, a ``url``, or an already uploaded ``attachment_id``.
+        """
+        if sum(x is not None for x in (path, url, attachment_id)) != 1:
+            raise ValueError(
+                'Exactly one of path, url and attachment_id must be given')
+        if attachment_id is None and self._attachment_ids is not None:
+            attachment_id = await self._attachment_ids.attachment_id(
+                self._client, attachment_type, path=path, url=url)
+        if attachment_id is not None:
+            payload = {'attachment_id': attachment_id}
+        elif url is not None:
+            payload = {'url': url}
+        else:
+            raise ValueError(
+                'Sending a local file requires an attachment ID registry')
+        message_payload = {
+            'attachment': {'type': attachment_type, 'payload': payload},
+        }
+        structure = await self._client.send_message(
+            self._recipient_id, message_payload)
+        logger.debug(
+            'Sent %s attachment %r to ID %r, got API response %r',
+            attachment_type, payload, self._recipient_id, structure)
+        return structure
+
+    async def send_image(self, *, path=None, url=None, attachment_id=None):
+        return await self.send_attachment(
+            'image', path=path, url=url, attachment_id=attachment_id)
+
+    async def send_audio(self, *, path=None, url=None, attachment_id=None):
+        return await self.send_attachment(
+            'audio', path=path, url=url, attachment_id=attachment_id)
+
+    async def send_video(self, *, path=None, url=None, attachment_id=None):
+        return await self.send_attachment(
+            'video', path=path, url=url, attachment_id=attachment_id)
+
+    async def send_file(self, *, path=None, url=None, attachment_id=None):
+        return await self.send_attachment(
+            'file', path=path, url=url, attachment_id=attachment_id)
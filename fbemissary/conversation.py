@@ -1,85 +1,663 @@
 # Licensed under the Apache License:
 #     http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import enum
 import logging
 import collections
 import asyncio
 
+import attr
+
 from fbemissary import models
 from fbemissary import client
+from fbemissary import state
+from fbemissary import receipts
+from fbemissary import uploads
+from fbemissary import pages
 
 
 logger = logging.getLogger(__name__)
 
+#: The event kinds conversationalists receive unless they say otherwise
+DEFAULT_EVENT_KINDS = frozenset({models.EventKind.message})
+
 
 class MessagingEventDemuxer:
     """
     Split messaging events based on the sender's ID and give them
     to :class:`Conversation` instances.
+
+    Arguments:
+        max_conversations (int or None):
+            The maximum number of conversations kept in memory. When
+            exceeded, the least recently used conversation is evicted.
+        conversation_idle_timeout (float or None):
+            Seconds without messaging events after which an idle
+            conversation is evicted.
+        send_dispatch_config
+                (:class:`fbemissary.client.SendDispatchConfig` or None):
+            If given, outbound messages for each page are batched and
+            rate limited according to it.
+        retry_policy (:class:`fbemissary.client.RetryPolicy` or None):
+            How failed outbound messages are retried.
+        state_store (:class:`fbemissary.state.StateStore` or None):
+            If given, every conversationalist gets a
+            :class:`fbemissary.state.ConversationState` backed by it
+            as its ``state`` attribute.
+        state_flush_interval (float):
+            Seconds between writes of changed conversation state.
+        graph_api_base_url (str):
+            The Graph API URL the page clients send to.
+        receipt_aggregator
+                (:class:`fbemissary.receipts.ReceiptAggregator` or None):
+            If given, delivery and read receipts are folded into it
+            instead of being dispatched as events, and every
+            conversationalist gets a
+            :class:`fbemissary.receipts.ConversationReceipts` as its
+            ``receipts`` attribute.
+        attachment_config
+                (:class:`fbemissary.attachments.AttachmentConfig` or None):
+            If given, the media attached to received messages is
+            downloaded as they are dispatched, and every
+            conversationalist gets the
+            :class:`fbemissary.attachments.AttachmentService` as its
+            ``attachments`` attribute.
+        attachment_ids_path (str or None):
+            A JSON file where the IDs of media uploaded by the
+            repliers' ``send_image`` and similar methods are kept
+            across restarts. IDs are only kept in memory if ``None``.
+        page_client_class:
+            The class of the page clients, by default
+            :class:`fbemissary.client.PageMessagingAPIClient`.
+            Replays use :class:`fbemissary.replay.StubPageMessagingAPIClient`.
+        instrumentation
+                (:class:`fbemissary.metrics.Instrumentation` or None):
+            If given, conversation lookups and creation, queue depths,
+            handlers and sends are measured with it.
     """
-    def __init__(self):
+    def __init__(self, *, max_conversations=None,
+                 conversation_idle_timeout=None, send_dispatch_config=None,
+                 retry_policy=client.RetryPolicy(), state_store=None,
+                 state_flush_interval=1.0,
+                 graph_api_base_url=client.GRAPH_API_BASE_URL,
+                 receipt_aggregator=None, attachment_config=None,
+                 attachment_ids_path=None,
+                 page_client_class=client.PageMessagingAPIClient,
+                 instrumentation=None):
         self._loop = None
-        self._page_clients = {}
-        self._page_tokens = {}
-        self._factories = {}
+        self._session = None
+        self._pages = pages.PageRegistry()
         self._preinit_convo = {}
-        # Map of (page_id, counterpart_id) -> conversation
-        self._convos = {}
+        self._max_conversations = max_conversations
+        self._conversation_idle_timeout = conversation_idle_timeout
+        self._send_dispatch_config = send_dispatch_config
+        self._retry_policy = retry_policy
+        self._state_store = state_store
+        self._state_flush_interval = state_flush_interval
+        self._state = None
+        self._graph_api_base_url = graph_api_base_url
+        self._receipts = receipt_aggregator
+        self._attachment_config = attachment_config
+        self._attachments = None
+        self._attachment_ids_path = attachment_ids_path
+        self._attachment_ids = None
+        self._page_client_class = page_client_class
+        self._instrumentation = instrumentation
+        # Map of (page_id, counterpart_id) -> conversation, created
+        # in start()
+        self._convos = None
+        # Map of (page_id, counterpart_id) -> events buffered while the
+        # conversation is being created
+        self._creating = {}
+        # Map of (page_id, counterpart_id) -> creation task
+        self._creation_tasks = {}
+        # The profile services of every factory added, closed once
+        # each when the demuxer closes, since factories may share one
+        self._profile_services = set()
+        # Map of conversationalist factory -> number of pages using it,
+        # so a factory shared by several pages is closed with the last
+        self._factory_pages = collections.Counter()
 
     def add_conversationalist_factory(
             self, page_id, page_access_token, conversationalist_factory,
             preinit_conversations):
-        if page_id in self._factories:
-            raise ValueError(
-                'Page ID {0!r} already assigned factory'.format(page_id))
-        self._factories[page_id] = conversationalist_factory
-        self._page_tokens[page_id] = page_access_token
-        self._preinit_convo[page_id] = preinit_conversations
-
-    async def add_messaging_events(self, page_id, events):
+        """
+        Handle the page ``page_id`` with conversationalists from
+        ``conversationalist_factory``. Pages can be added before or
+        after :meth:`start`; when added after, the
+        ``preinit_conversations`` are created in the background.
+        """
+        self._pages.add(
+            page_id, page_access_token, conversationalist_factory,
+            getattr(conversationalist_factory, 'consumed_event_kinds',
+                    DEFAULT_EVENT_KINDS))
+        self._factory_pages[conversationalist_factory] += 1
+        profile_service = getattr(
+            conversationalist_factory, 'profile_service', None)
+        if profile_service is not None:
+            self._profile_services.add(profile_service)
+        if self._preinit_convo is not None:
+            self._preinit_convo[page_id] = preinit_conversations
+            return
+        for counterpart_id in preinit_conversations:
+            if (page_id, counterpart_id) not in self._creating:
+                task = self._start_creation(page_id, counterpart_id, [])
+                task.add_done_callback(_log_creation_failure)
+
+    async def remove_page(self, page_id):
+        """
+        Stop handling the page ``page_id``: later events for it raise
+        :class:`UnhandledPage`, its conversations are evicted and
+        closed, and its queued outbound messages are sent before its
+        client is closed. Its conversationalist factory is closed too,
+        unless another page still uses it.
+        """
+        try:
+            page = self._pages.remove(page_id)
+        except KeyError:
+            raise UnhandledPage(
+                'Page ID {0!r} is not configured'.format(page_id)) from None
+        if self._preinit_convo is not None:
+            self._preinit_convo.pop(page_id, None)
+            self._factory_pages[page.conversationalist_factory] -= 1
+            return
+        creations = [
+            task for (task_page_id, _), task in self._creation_tasks.items()
+            if task_page_id == page_id
+        ]
+        if creations:
+            await asyncio.wait(creations)
+        await self._convos.remove_page(page_id)
+        await self._close_page(page)
+        logger.info('Removed page %r', page_id)
+
+    def rotate_page_token(self, page_id, page_access_token):
+        """
+        Use ``page_access_token`` for every later send as page
+        ``page_id``, including retries of sends already in flight.
+        """
+        try:
+            self._pages.rotate_token(page_id, page_access_token)
+        except KeyError:
+            raise UnhandledPage(
+                'Page ID {0!r} is not configured'.format(page_id)) from None
+
+    async def add_messaging_events(self, page_id, events, pending=None):
+        """
+        Give each event to the conversation with its sender.
+
+        Conversations that don't exist yet are created concurrently,
+        at most once per counterpart; events for a counterpart whose
+        conversation is still being created are buffered and handed
+        over in arrival order once it's ready. Returns when the
+        conversations started by this call have been created.
+
+        If the events came from a journaled webhook body, ``pending``
+        is its :class:`fbemissary.journal.PendingBody`, held until
+        each event has been handled.
+        """
+        if page_id not in self._pages:
+            raise UnhandledPage(
+                'Received messaging events for page ID {0} lacking '
+                'configured Conversationalist Factory'.format(page_id)
+            )
+        if self._receipts is not None:
+            events = self._receipts.fold(page_id, events)
+        creations = []
         for event in events:
-            convo = await self._get_or_create_conversation(
-                page_id, event.sender_id)
-            if convo is None:
-                raise UnhandledPage(
-                    'Received messaging events for page ID {0} lacking '
-                    'configured Conversationalist Factory'.format(page_id)
-                )
-            convo.add_messaging_event(event)
+            if (self._attachments is not None
+                    and isinstance(event, models.ReceivedMessage)):
+                self._attachments.prefetch_event(event)
+            creation = self._dispatch_event(
+                page_id, event.counterpart_id, event, pending)
+            if creation is not None:
+                creations.append(creation)
+        if creations:
+            await self._wait_for_creations(creations)
+
+    def wants_event(self, page_id, kind):
+        """
+        Whether the conversationalists for ``page_id`` consume events
+        of the :class:`fbemissary.models.EventKind` ``kind``. Usable
+        as the :class:`fbemissary.webhook.WebhookWrangler` event filter.
+        """
+        if self._receipts is not None and kind in receipts.RECEIPT_KINDS:
+            return True
+        page = self._pages.get(page_id)
+        # Let events for unknown pages through, to be reported
+        return page is None or kind in page.consumed_event_kinds
 
     async def start(self, session, *, loop):
         self._loop = loop
-        for page_id in self._factories:
-            self._page_clients[page_id] = client.PageMessagingAPIClient(
-                session, self._page_tokens[page_id])
-            preinit_conversations = self._preinit_convo[page_id]
-            for counterpart_id in preinit_conversations:
-                await self._get_or_create_conversation(page_id, counterpart_id)
+        self._session = session
+        self._pages.bind(self._make_page_client)
+        self._convos = ConversationTable(
+            max_size=self._max_conversations,
+            idle_timeout=self._conversation_idle_timeout,
+            loop=loop,
+        )
+        self._convos.start()
+        if self._receipts is not None:
+            self._receipts.start(loop=loop)
+        if self._attachment_config is not None:
+            self._attachments = self._attachment_config.make_service(
+                session, loop=loop)
+        self._attachment_ids = uploads.AttachmentIdRegistry(
+            self._attachment_ids_path, loop=loop)
+        if self._instrumentation is not None:
+            self._register_metrics(self._instrumentation.registry)
+        if self._state_store is not None:
+            self._state = state.StateManager(
+                self._state_store,
+                flush_interval=self._state_flush_interval,
+                loop=loop,
+            )
+            self._state.start()
+        creations = [
+            self._start_creation(page_id, counterpart_id, [])
+            for page_id, preinit_conversations in self._preinit_convo.items()
+            for counterpart_id in preinit_conversations
+            if self._convos.get((page_id, counterpart_id)) is None
+            and (page_id, counterpart_id) not in self._creating
+        ]
         self._preinit_convo = None
+        if creations:
+            await self._wait_for_creations(creations)
 
-    async def _get_or_create_conversation(self, page_id, counterpart_id):
-        try:
-            convo = self._convos[page_id, counterpart_id]
-        except KeyError:
+    async def close(self):
+        """
+        Evict every conversation, awaiting their teardown, then wait
+        for queued outbound messages to be sent and write any changed
+        conversation state. The factories' profile services are
+        closed too.
+        """
+        for task in self._creation_tasks.values():
+            task.cancel()
+        if self._creation_tasks:
+            await asyncio.wait(list(self._creation_tasks.values()))
+        await self._convos.close()
+        for page in self._pages:
+            await self._close_page(page)
+        for profile_service in self._profile_services:
+            await profile_service.close()
+        self._profile_services = set()
+        if self._attachment_ids is not None:
+            await self._attachment_ids.close()
+        if self._receipts is not None:
+            await self._receipts.close()
+        if self._attachments is not None:
+            await self._attachments.close()
+        if self._state is not None:
+            await self._state.close()
+
+    async def drain_conversations(self, poll_interval=0.05):
+        """
+        Wait until no conversation is being created or has events
+        queued or being handled.
+        """
+        while self._creating or self._convos.busy_count():
+            await asyncio.sleep(poll_interval)
+
+    def queued_events(self):
+        """
+        The number of events not yet handed to a conversationalist's
+        handler, including those waiting for their conversation to be
+        created.
+        """
+        buffered = sum(len(items) for items in self._creating.values())
+        return buffered + self._convos.queued_events()
+
+    def busy_conversations(self):
+        return self._convos.busy_count()
+
+    async def drain_sends(self):
+        """
+        Wait until no outbound messages are in flight for any page.
+        """
+        for page_client in self._pages.clients():
+            await page_client.drain()
+
+    def in_flight_sends(self):
+        return sum(c.in_flight for c in self._pages.clients())
+
+    def conversation_table_stats(self):
+        return self._convos.stats()
+
+    def _make_page_client(self, page_id, page_access_token):
+        return self._page_client_class(
+            self._session, page_access_token,
+            dispatch_config=self._send_dispatch_config,
+            retry_policy=self._retry_policy,
+            graph_api_base_url=self._graph_api_base_url,
+            instrumentation=self._instrumentation,
+            page_id=page_id,
+            loop=self._loop)
+
+    async def _close_page(self, page):
+        factory = page.conversationalist_factory
+        self._factory_pages[factory] -= 1
+        if self._factory_pages[factory] > 0:
+            aclose = None
+        else:
+            del self._factory_pages[factory]
+            aclose = getattr(factory, 'aclose', None)
+        if aclose is not None:
             try:
-                factory = self._factories[page_id]
-            except KeyError:
-                return None
+                await aclose()
+            except Exception:
+                logger.exception(
+                    'Error closing conversationalist factory for page %r',
+                    page.page_id)
+        if page.client is not None:
+            await page.client.close()
+
+    def _register_metrics(self, registry):
+        gauge = registry.gauge(
+            'fbemissary_conversation_table',
+            'Conversation table size and counters',
+            ['measure'])
+
+        def collect():
+            stats = self._convos.stats()
+            for measure in ('size', 'hits', 'misses', 'evictions',
+                            'idle_evictions', 'overshoots'):
+                gauge.set(getattr(stats, measure), labels=(measure,))
+            gauge.set(self.in_flight_sends(), labels=('in_flight_sends',))
+        registry.add_collector(collect)
+
+    def _dispatch_event(self, page_id, counterpart_id, event, pending):
+        """
+        Hand the event to its conversation, or buffer it if the
+        conversation is not ready. Returns the creation task if this
+        event started one, else ``None``.
+        """
+        key = (page_id, counterpart_id)
+        instr = self._instrumentation
+        if instr is not None:
+            started = instr.clock()
+        convo = self._convos.get(key)
+        if instr is not None:
+            instr.demux_lookup_seconds.observe(instr.clock() - started)
+        if convo is not None:
+            convo.add_messaging_event(event, pending)
+            return None
+        # Buffered events hold their body until they're handed over
+        if pending is not None:
+            pending.hold()
+        buffered = self._creating.get(key)
+        if buffered is not None:
+            buffered.append((event, pending))
+            return None
+        return self._start_creation(
+            page_id, counterpart_id, [(event, pending)])
+
+    def _start_creation(self, page_id, counterpart_id, items):
+        """
+        Start creating the conversation, buffering ``items``, a list
+        of ``(event, pending)`` pairs, until it is ready.
+        """
+        key = (page_id, counterpart_id)
+        self._creating[key] = items
+        task = self._loop.create_task(
+            self._create_conversation(page_id, counterpart_id))
+        self._creation_tasks[key] = task
+        task.add_done_callback(
+            lambda _: self._creation_tasks.pop(key, None))
+        return task
+
+    async def _wait_for_creations(self, creations):
+        # Let every creation finish even if one fails, then report the
+        # first failure to the caller.
+        results = await asyncio.gather(*creations, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def _create_conversation(self, page_id, counterpart_id):
+        key = (page_id, counterpart_id)
+        try:
+            page = self._pages.get(page_id)
+            if page is None:
+                raise UnhandledPage(
+                    'Page ID {0!r} was removed'.format(page_id))
+            factory = page.conversationalist_factory
             replier = client.ConversationReplierAPIClient(
-                self._page_clients[page_id], counterpart_id)
-            conversationalist = await factory.make_conversationalist(
-                replier, page_id, counterpart_id, self._loop)
-            convo = Conversation(
-                conversationalist, page_id, counterpart_id,
-                loop=self._loop)
-            self._convos[page_id, counterpart_id] = convo
+                self._pages.client_for(page), counterpart_id,
+                attachment_ids=self._attachment_ids)
+            if self._instrumentation is None:
+                conversationalist = await factory.make_conversationalist(
+                    replier, page_id, counterpart_id, self._loop)
+            else:
+                conversationalist = await self._make_conversationalist_timed(
+                    factory, replier, page_id, counterpart_id)
+            self._attach_services(conversationalist, page_id, counterpart_id)
+        except asyncio.CancelledError:
+            # Left pending, so journaled events are replayed
+            self._creating.pop(key)
+            raise
+        except BaseException:
+            items = self._creating.pop(key)
+            if items:
+                logger.warning(
+                    'Dropping %d messaging events for page ID %r, '
+                    'counterpart ID %r: conversation creation failed',
+                    len(items), page_id, counterpart_id)
+            _release_buffered(items)
+            raise
+        convo = Conversation(
+            conversationalist, page_id, counterpart_id, loop=self._loop)
+        if self._pages.get(page_id) is not page:
+            # The page was removed while the conversationalist was
+            # being made
+            items = self._creating.pop(key)
+            _release_buffered(items)
+            await convo.close()
+            raise UnhandledPage(
+                'Page ID {0!r} was removed, dropping {1} messaging '
+                'events'.format(page_id, len(items)))
+        self._convos.add(key, convo)
+        items = self._creating.pop(key)
+        for event, pending in items:
+            convo.add_messaging_event(event, pending)
+        _release_buffered(items)
         return convo
 
+    async def _make_conversationalist_timed(
+            self, factory, replier, page_id, counterpart_id):
+        instr = self._instrumentation
+        with instr.span('fbemissary.make_conversationalist',
+                        page_id=page_id, counterpart_id=counterpart_id):
+            started = instr.clock()
+            try:
+                return await factory.make_conversationalist(
+                    replier, page_id, counterpart_id, self._loop)
+            finally:
+                instr.conversationalist_create_seconds.observe(
+                    instr.clock() - started)
+
+    def _attach_services(self, conversationalist, page_id, counterpart_id):
+        if self._state is not None:
+            conversationalist.state = self._state.state_for(
+                page_id, counterpart_id)
+        if self._receipts is not None:
+            conversationalist.receipts = self._receipts.receipts_for(
+                page_id, counterpart_id)
+        if self._attachments is not None:
+            conversationalist.attachments = self._attachments
+        if self._instrumentation is not None:
+            conversationalist.instrumentation = self._instrumentation
+
 
 class UnhandledPage(Exception):
     pass
 
 
+def _release_buffered(items):
+    for _, pending in items:
+        if pending is not None:
+            pending.release()
+
+
+def _log_creation_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(
+            'Failed to create preinitialized conversation',
+            exc_info=task.exception())
+
+
+@attr.s
+class ConversationTableStats:
+    size = attr.ib()
+    max_size = attr.ib()
+    hits = attr.ib()
+    misses = attr.ib()
+    evictions = attr.ib()
+    idle_evictions = attr.ib()
+    #: Times the table was left over ``max_size`` because every
+    #: conversation it could evict was busy
+    overshoots = attr.ib()
+
+
+class ConversationTable:
+    """
+    Mapping of ``(page_id, counterpart_id)`` to :class:`Conversation`
+    that evicts the least recently used conversation when it grows
+    past ``max_size``, and conversations that have been idle for
+    ``idle_timeout`` seconds.
+
+    Busy conversations are never evicted. If every other one is busy
+    the table grows past ``max_size`` for a while, and shrinks back
+    as conversations are added once some have gone quiet.
+
+    Evicted conversations are closed in a background task, which
+    gives the conversationalist a chance to tear down.
+    """
+    def __init__(self, *, max_size=None, idle_timeout=None, loop):
+        if max_size is not None and max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._loop = loop
+        self._convos = collections.OrderedDict()
+        self._sweeper = None
+        self._closing = set()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._idle_evictions = 0
+        self._overshoots = 0
+
+    def __len__(self):
+        return len(self._convos)
+
+    def start(self):
+        if self._idle_timeout is not None:
+            self._sweeper = self._loop.create_task(self._sweep_idle())
+
+    def get(self, key):
+        try:
+            convo = self._convos[key]
+        except KeyError:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._convos.move_to_end(key)
+        return convo
+
+    def add(self, key, convo):
+        if key in self._convos:
+            raise ValueError('Conversation {0!r} already exists'.format(key))
+        self._convos[key] = convo
+        if self._max_size is not None and len(self._convos) > self._max_size:
+            self._evict_least_recently_used(key)
+
+    def evict_idle(self):
+        """
+        Evict every conversation that has been idle for at least
+        ``idle_timeout`` seconds.
+        """
+        deadline = self._loop.time() - self._idle_timeout
+        expired = []
+        # Conversations are kept in order of last use, so everything
+        # past the first recently active one is active too.
+        for key, convo in self._convos.items():
+            if convo.last_activity > deadline:
+                break
+            if not convo.busy:
+                expired.append(key)
+        for key in expired:
+            convo = self._convos.pop(key)
+            self._idle_evictions += 1
+            self._close_later(convo)
+        return len(expired)
+
+    def _evict_least_recently_used(self, added):
+        excess = len(self._convos) - self._max_size
+        evicted = []
+        for key, convo in self._convos.items():
+            if len(evicted) == excess:
+                break
+            if key != added and not convo.busy:
+                evicted.append(key)
+        for key in evicted:
+            self._evictions += 1
+            self._close_later(self._convos.pop(key))
+        if len(evicted) < excess:
+            self._overshoots += 1
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        while self._convos:
+            _, convo = self._convos.popitem(last=False)
+            self._close_later(convo)
+        if self._closing:
+            await asyncio.wait(list(self._closing))
+
+    async def remove_page(self, page_id):
+        """
+        Remove and close every conversation of the page ``page_id``.
+        """
+        keys = [key for key in self._convos if key[0] == page_id]
+        for key in keys:
+            self._close_later(self._convos.pop(key))
+        if self._closing:
+            await asyncio.wait(list(self._closing))
+
+    def busy_count(self):
+        return sum(1 for convo in self._convos.values() if convo.busy)
+
+    def queued_events(self):
+        return sum(convo.queued_events for convo in self._convos.values())
+
+    def stats(self):
+        return ConversationTableStats(
+            size=len(self._convos),
+            max_size=self._max_size,
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            idle_evictions=self._idle_evictions,
+            overshoots=self._overshoots,
+        )
+
+    def _close_later(self, convo):
+        task = self._loop.create_task(convo.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _sweep_idle(self):
+        interval = self._idle_timeout / 2
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+
 class Conversation:
     """
     A chat with a single user.
@@ -89,27 +667,122 @@ class Conversation:
         self._page_id = page_id
         self._counterpart_id = counterpart_id
         self._loop = loop
+        self.last_activity = loop.time()
 
-    def add_messaging_event(self, event):
+    @property
+    def busy(self):
+        """
+        Whether the conversationalist still has events to handle.
+        Conversationalists without a ``busy`` attribute are assumed
+        to never be busy.
+        """
+        return getattr(self._conversationalist, 'busy', False)
+
+    @property
+    def queued_events(self):
+        """
+        The number of events waiting in the conversationalist's queue,
+        or 0 if it doesn't have a ``queued_events`` attribute.
+        """
+        return getattr(self._conversationalist, 'queued_events', 0)
+
+    def add_messaging_event(self, event, pending=None):
+        """
+        Give the event to the conversationalist. The library's
+        conversationalists hold ``pending`` until the event has been
+        handled; other ones are only given the event.
+        """
+        self.last_activity = self._loop.time()
+        conversationalist = self._conversationalist
         try:
-            self._conversationalist.handle_messaging_event(event)
+            if pending is not None and isinstance(
+                    conversationalist,
+                    (SerialConversationalist, PooledConversationalist)):
+                conversationalist.handle_messaging_event(event, pending)
+            else:
+                conversationalist.handle_messaging_event(event)
+        except ConversationQueueFull:
+            logger.warning(
+                'Queue full, rejected messaging event for conversation '
+                'on page %r with counterpart %r',
+                self._page_id, self._counterpart_id)
         except Exception:
             logger.exception(
                 'Error in handle_messaging_event for conversation '
                 'on page %r with counterpart %r:',
-                self._counterpart_id)
+                self._page_id, self._counterpart_id)
+
+    async def close(self):
+        """
+        Tear down the conversationalist, awaiting its ``aclose``
+        coroutine method if it has one.
+        """
+        aclose = getattr(self._conversationalist, 'aclose', None)
+        if aclose is None:
+            return
+        try:
+            await aclose()
+        except Exception:
+            logger.exception(
+                'Error in conversationalist method aclose '
+                'on page %r with counterpart %r:',
+                self._page_id, self._counterpart_id)
+
+
+class OverflowPolicy(enum.Enum):
+    """
+    What a :class:`SerialConversationalist` does with an event that
+    arrives when its queue is full.
+    """
+    #: Discard the oldest queued event to make room
+    drop_oldest = 'drop_oldest'
+    #: Discard the arriving event
+    drop_newest = 'drop_newest'
+    #: Merge a text message into the newest queued one if that is a
+    #: text message too, otherwise discard the oldest queued event
+    coalesce = 'coalesce'
+    #: Raise :class:`ConversationQueueFull` for the arriving event
+    reject = 'reject'
+
+
+class ConversationQueueFull(Exception):
+    """
+    A conversationalist's queue was full and its overflow policy is
+    :attr:`OverflowPolicy.reject`.
+    """
 
 
 class ConversationalistFactory:
+    """
+    Makes conversationalists by calling ``conversationalist_class``.
+
+    If a ``profile_service`` (a
+    :class:`fbemissary.client.UserProfileService`) is given, every
+    conversationalist gets it as its ``user_profiles`` attribute, and
+    the counterpart's profile starts being fetched as soon as the
+    conversation is created. The service may be shared by several
+    factories; the demuxer closes it when the bot stops.
+    """
     conversationalist_class = None
 
-    def __init__(self, conversationalist_class):
-        self.conversationalist = conversationalist_class
+    def __init__(self, conversationalist_class, profile_service=None):
+        self.conversationalist_class = conversationalist_class
+        self.profile_service = profile_service
+
+    @property
+    def consumed_event_kinds(self):
+        return getattr(
+            self.conversationalist_class, 'consumed_event_kinds',
+            DEFAULT_EVENT_KINDS)
 
     async def make_conversationalist(
             self, page_messaging_client, page_id, counterpart_id, loop):
-        return self.conversationalist_class(
+        conversationalist = self.conversationalist_class(
             page_messaging_client, page_id, counterpart_id, loop)
+        _attach_profile_service(
+            conversationalist, self.profile_service, page_messaging_client,
+            counterpart_id)
+        return conversationalist
 
 
 class SerialConversationalist:
@@ -121,6 +794,21 @@ class SerialConversationalist:
 
     ``event_received`` will be called with the event, and awaited.
 
+    Set the ``batch_mode`` class attribute to ``True`` to have the
+    ``events_received`` coroutine method called instead, with a list
+    of every event queued at that point, for example to answer a burst
+    of messages with a single reply.
+
+    Only messages are received unless the ``consumed_event_kinds``
+    class attribute is set to a different set of
+    :class:`fbemissary.models.EventKind`; events of other kinds are
+    dropped before they are parsed.
+
+    The queue is unbounded unless the ``max_queue_length`` class
+    attribute is set. Events arriving while it is full are handled
+    according to the ``overflow_policy`` class attribute, an
+    :class:`OverflowPolicy`.
+
     Attributes:
         replier (:class:`fbemissary.client.PageMessagingAPIClient`):
             The page messaging API client to use for sending
@@ -132,14 +820,48 @@ class SerialConversationalist:
             conversation.
         loop (:class:`asyncio.AbstractEventLoop`):
             The event loop instance.
+        state (:class:`fbemissary.state.ConversationState` or None):
+            The persistent state of the conversation, if the bot has
+            a state store. It is loaded before the first event is
+            handled.
+        receipts
+                (:class:`fbemissary.receipts.ConversationReceipts` or None):
+            The latest delivery and read watermarks of the
+            conversation, if the bot aggregates receipts.
+        attachments
+                (:class:`fbemissary.attachments.AttachmentService` or None):
+            Downloads the media of received messages, if the bot is
+            configured to.
+        user_profiles
+                (:class:`fbemissary.client.UserProfileService` or None):
+            Set if the factory was given a profile service. See
+            :meth:`counterpart_profile`.
+        instrumentation
+                (:class:`fbemissary.metrics.Instrumentation` or None):
+            Set if the bot collects metrics.
+        overflowed (int):
+            The number of events dropped, merged or rejected because
+            the queue was full.
     """
+    state = None
+    receipts = None
+    attachments = None
+    user_profiles = None
+    instrumentation = None
+    consumed_event_kinds = DEFAULT_EVENT_KINDS
+    batch_mode = False
+    max_queue_length = None
+    overflow_policy = OverflowPolicy.drop_oldest
+
     def __init__(self, page_messaging_client, page_id, counterpart_id, loop):
         self.replier = page_messaging_client
         self.page_id = page_id
         self.counterpart_id = counterpart_id
         self.loop = loop
+        self.overflowed = 0
         self._events = collections.deque()
-        self._events_available = asyncio.Event(loop=loop)
+        self._waiter = None
+        self._handling = False
         self._task = loop.create_task(self._conversate())
 
     async def event_received(self, event):
@@ -148,26 +870,462 @@ class SerialConversationalist:
         """
         pass
 
-    def handle_messaging_event(self, event):
-        # Load the event...
-        self._events.appendleft(event)
-        # ...and inform the task it can continue.
-        self._events_available.set()
+    async def events_received(self, events):
+        """
+        Coroutine method called with a list of events in batch mode.
+        Calls :meth:`event_received` for each one by default.
+        """
+        for event in events:
+            await self.event_received(event)
+
+    async def counterpart_profile(self):
+        """
+        Return the counterpart's
+        :class:`fbemissary.client.UserProfile`, usually already
+        fetched when the conversation was created.
+        """
+        return await _counterpart_profile(self)
+
+    def handle_messaging_event(self, event, pending=None):
+        if self.instrumentation is not None:
+            self.instrumentation.conversation_queue_depth.observe(
+                len(self._events))
+        _enqueue_event(
+            self._events, event, pending, self.max_queue_length,
+            self.overflow_policy, self._record_overflow)
+        # Wake the task if it is waiting for events
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    @property
+    def busy(self):
+        """
+        Whether there are queued events or one is being handled.
+        """
+        return self._handling or bool(self._events)
+
+    @property
+    def queued_events(self):
+        """
+        The number of events waiting to be handled.
+        """
+        return len(self._events)
+
+    async def aclose(self):
+        """
+        Stop handling events, cancelling the conversation task. Events
+        still queued are discarded.
+        """
+        if self._events:
+            logger.warning(
+                'Discarding %d queued events for conversation on page %r '
+                'with counterpart %r',
+                len(self._events), self.page_id, self.counterpart_id)
+            self._events.clear()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def _record_overflow(self, policy):
+        self.overflowed += 1
+        if self.instrumentation is not None:
+            self.instrumentation.conversation_queue_overflows.inc(
+                labels=(policy.value,))
 
     async def _conversate(self):
         while True:
             await self._handle_events()
-            self._events_available.clear()
-            await self._events_available.wait()
-
+            if not self._events:
+                self._waiter = self.loop.create_future()
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
 
     async def _handle_events(self):
+        if self._events and self.state is not None:
+            await _load_state(self)
         while self._events:
-            event = self._events.pop()
+            handler, argument, pending = _next_work(self, self._events)
+            self._handling = True
+            try:
+                await _call_handler(self, handler, argument)
+            finally:
+                self._handling = False
+            _release_all(pending)
+
+
+class PooledConversationalist:
+    """
+    A conversationalist that handles its events serially, like
+    :class:`SerialConversationalist`, but without a task of its own.
+    When it has events it is put on the ready queue of a shared
+    :class:`ConversationWorkerPool`, whose workers handle one event
+    (or one batch) at a time before moving it to the back of the
+    queue. An idle conversationalist is just a small slotted object.
+
+    Use it with a :class:`PooledConversationalistFactory`. The
+    ``event_received``/``events_received`` methods and the
+    ``consumed_event_kinds``, ``batch_mode``, ``max_queue_length`` and
+    ``overflow_policy`` class attributes work as for
+    :class:`SerialConversationalist`, as do the ``replier``,
+    ``page_id``, ``counterpart_id``, ``loop``, ``state``,
+    ``receipts``, ``attachments``, ``user_profiles``,
+    ``instrumentation`` and ``overflowed`` attributes, and
+    :meth:`counterpart_profile`.
+
+    Closing the conversationalist discards its queued events; an
+    event being handled at the time is allowed to finish.
+    """
+    __slots__ = (
+        'replier', 'page_id', 'counterpart_id', 'loop', 'state',
+        'receipts', 'attachments', 'user_profiles', 'instrumentation',
+        'overflowed', '_pool', '_events', '_scheduled', '_closed',
+    )
+    consumed_event_kinds = DEFAULT_EVENT_KINDS
+    batch_mode = False
+    max_queue_length = None
+    overflow_policy = OverflowPolicy.drop_oldest
+
+    def __init__(self, page_messaging_client, page_id, counterpart_id, loop,
+                 pool):
+        self.replier = page_messaging_client
+        self.page_id = page_id
+        self.counterpart_id = counterpart_id
+        self.loop = loop
+        self.state = None
+        self.receipts = None
+        self.attachments = None
+        self.user_profiles = None
+        self.instrumentation = None
+        self.overflowed = 0
+        self._pool = pool
+        # Allocated when events arrive, dropped once they're handled
+        self._events = None
+        self._scheduled = False
+        self._closed = False
+
+    async def event_received(self, event):
+        """
+        Abstract coroutine method.
+        """
+        pass
+
+    async def events_received(self, events):
+        """
+        Coroutine method called with a list of events in batch mode.
+        Calls :meth:`event_received` for each one by default.
+        """
+        for event in events:
+            await self.event_received(event)
+
+    async def counterpart_profile(self):
+        """
+        Return the counterpart's
+        :class:`fbemissary.client.UserProfile`, usually already
+        fetched when the conversation was created.
+        """
+        return await _counterpart_profile(self)
+
+    def handle_messaging_event(self, event, pending=None):
+        if self._closed:
+            return
+        if self._events is None:
+            self._events = collections.deque()
+        if self.instrumentation is not None:
+            self.instrumentation.conversation_queue_depth.observe(
+                len(self._events))
+        if not self._scheduled:
+            # Before queueing, so nothing is queued if the pool is closed
+            self._pool.schedule(self)
+            self._scheduled = True
+        _enqueue_event(
+            self._events, event, pending, self.max_queue_length,
+            self.overflow_policy, self._record_overflow)
+
+    @property
+    def busy(self):
+        """
+        Whether there are queued events or one is being handled.
+        """
+        return self._scheduled
+
+    @property
+    def queued_events(self):
+        """
+        The number of events waiting to be handled.
+        """
+        return len(self._events) if self._events is not None else 0
+
+    async def aclose(self):
+        """
+        Stop handling events. Events still queued are discarded.
+        """
+        self._closed = True
+        if self._events:
+            logger.warning(
+                'Discarding %d queued events for conversation on page %r '
+                'with counterpart %r',
+                len(self._events), self.page_id, self.counterpart_id)
+        self._events = None
+
+    def _record_overflow(self, policy):
+        self.overflowed += 1
+        if self.instrumentation is not None:
+            self.instrumentation.conversation_queue_overflows.inc(
+                labels=(policy.value,))
+
+    async def _service(self):
+        """
+        Handle the next event or batch. Called by the pool's workers.
+        """
+        if self._events and self.state is not None:
+            await _load_state(self)
+        if self._events:
+            handler, argument, pending = _next_work(self, self._events)
+            await _call_handler(self, handler, argument)
+            _release_all(pending)
+        if self._events and not self._closed:
+            self._pool.schedule(self)
+        else:
+            self._events = None
+            self._scheduled = False
+
+
+class ConversationWorkerPool:
+    """
+    A fixed number of worker tasks handling events for
+    :class:`PooledConversationalist` instances, taken from a shared
+    ready queue. A conversationalist is on the queue at most once, so
+    its events are still handled one at a time and in order.
+
+    The workers are started when the first conversationalist is
+    scheduled. Once the pool is closed, scheduling raises
+    :class:`RuntimeError`.
+    """
+    def __init__(self, workers=16, *, loop):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self._worker_count = workers
+        self._loop = loop
+        self._ready = None
+        self._workers = []
+        self._closed = False
+
+    def schedule(self, conversationalist):
+        if self._closed:
+            raise RuntimeError('Conversation worker pool is closed')
+        if self._ready is None:
+            self._start()
+        self._ready.put_nowait(conversationalist)
+
+    async def close(self):
+        """
+        Cancel the worker tasks. Conversationalists still on the ready
+        queue are not serviced.
+        """
+        self._closed = True
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    def _start(self):
+        self._ready = asyncio.Queue()
+        for _ in range(self._worker_count):
+            self._workers.append(self._loop.create_task(self._work()))
+
+    async def _work(self):
+        while True:
+            conversationalist = await self._ready.get()
             try:
-                await self.event_received(event)
+                await conversationalist._service()
+            except asyncio.CancelledError:
+                raise
             except Exception:
                 logger.exception(
-                    'Error in conversationalist method event_received '
-                    'on page %r with counterpart %r:',
-                    self.page_id, self.counterpart_id)
+                    'Error servicing conversation on page %r with '
+                    'counterpart %r:',
+                    conversationalist.page_id,
+                    conversationalist.counterpart_id)
+
+
+class PooledConversationalistFactory:
+    """
+    Makes instances of ``conversationalist_class``, a
+    :class:`PooledConversationalist` subclass, sharing a
+    :class:`ConversationWorkerPool` of ``workers`` tasks. The pool is
+    closed when the bot stops, or the last page using the factory is
+    removed. ``profile_service`` works as for
+    :class:`ConversationalistFactory`.
+    """
+    conversationalist_class = None
+
+    def __init__(self, conversationalist_class, workers=16,
+                 profile_service=None):
+        self.conversationalist_class = conversationalist_class
+        self.profile_service = profile_service
+        self._workers = workers
+        self._pool = None
+
+    @property
+    def consumed_event_kinds(self):
+        return self.conversationalist_class.consumed_event_kinds
+
+    async def make_conversationalist(
+            self, page_messaging_client, page_id, counterpart_id, loop):
+        if self._pool is None:
+            self._pool = ConversationWorkerPool(self._workers, loop=loop)
+        conversationalist = self.conversationalist_class(
+            page_messaging_client, page_id, counterpart_id, loop,
+            self._pool)
+        _attach_profile_service(
+            conversationalist, self.profile_service, page_messaging_client,
+            counterpart_id)
+        return conversationalist
+
+    async def aclose(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+
+def _attach_profile_service(
+        conversationalist, profile_service, replier, counterpart_id):
+    if profile_service is None:
+        return
+    conversationalist.user_profiles = profile_service
+    profile_service.prefetch(replier.page_messaging_client, counterpart_id)
+
+
+async def _counterpart_profile(conversationalist):
+    if conversationalist.user_profiles is None:
+        raise RuntimeError(
+            'Conversationalist factory was given no profile service')
+    return await conversationalist.user_profiles.get_profile(
+        conversationalist.replier.page_messaging_client,
+        conversationalist.counterpart_id)
+
+
+def _next_work(conversationalist, queue):
+    """
+    Take the next event, or in batch mode every queued event, off
+    ``queue``. Returns the handler method to call, its argument and
+    the pending journal bodies to release once it has returned.
+    """
+    if conversationalist.batch_mode:
+        batch = [event for event, _ in queue]
+        pending = tuple(
+            body for _, bodies in queue for body in bodies)
+        queue.clear()
+        return conversationalist.events_received, batch, pending
+    event, pending = queue.popleft()
+    return conversationalist.event_received, event, pending
+
+
+def _release_all(pending):
+    for body in pending:
+        body.release()
+
+
+async def _call_handler(conversationalist, handler, argument):
+    instr = conversationalist.instrumentation
+    try:
+        if instr is None:
+            await handler(argument)
+        else:
+            with instr.span('fbemissary.' + handler.__name__,
+                            page_id=conversationalist.page_id,
+                            counterpart_id=conversationalist.counterpart_id):
+                started = instr.clock()
+                try:
+                    await handler(argument)
+                finally:
+                    instr.handler_seconds.observe(instr.clock() - started)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception(
+            'Error in conversationalist method %s '
+            'on page %r with counterpart %r:',
+            handler.__name__, conversationalist.page_id,
+            conversationalist.counterpart_id)
+
+
+async def _load_state(conversationalist):
+    try:
+        await conversationalist.state.load()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Handlers using the state fail until a later batch of
+        # events loads it successfully.
+        logger.exception(
+            'Failed to load state for conversation on page %r '
+            'with counterpart %r:',
+            conversationalist.page_id, conversationalist.counterpart_id)
+
+
+def _enqueue_event(queue, event, pending, max_length, policy,
+                   record_overflow):
+    """
+    Append ``event`` to the deque ``queue``, applying the overflow
+    ``policy`` if it already holds ``max_length`` events.
+    ``record_overflow`` is called with the policy on overflow.
+
+    Queue items are ``(event, pending)`` pairs, ``pending`` being a
+    tuple of the journal bodies held for the event. A stored event
+    holds ``pending`` if given; one the policy discards releases it.
+    """
+    bodies = ()
+    if pending is not None:
+        pending.hold()
+        bodies = (pending,)
+    if max_length is None or len(queue) < max_length:
+        queue.append((event, bodies))
+        return
+    record_overflow(policy)
+    if policy is OverflowPolicy.reject:
+        _release_all(bodies)
+        raise ConversationQueueFull(
+            'Conversation queue is full ({0} events)'.format(max_length))
+    if policy is OverflowPolicy.drop_newest:
+        _release_all(bodies)
+        return
+    if policy is OverflowPolicy.coalesce and queue:
+        earlier, earlier_bodies = queue[-1]
+        merged = _coalesce_text_messages(earlier, event)
+        if merged is not None:
+            queue[-1] = (merged, earlier_bodies + bodies)
+            return
+    if queue:
+        _, dropped = queue.popleft()
+        _release_all(dropped)
+    queue.append((event, bodies))
+
+
+def _is_plain_text_message(event):
+    return (
+        isinstance(event, models.ReceivedMessage)
+        and event.text is not None
+        and not event.attachments
+        and event.quick_reply is None
+    )
+
+
+def _coalesce_text_messages(earlier, later):
+    """
+    Return a message with the text of both plain text messages, or
+    ``None`` if either isn't one.
+    """
+    if not (_is_plain_text_message(earlier)
+            and _is_plain_text_message(later)):
+        return None
+    return attr.evolve(
+        later, text='{0}\n{1}'.format(earlier.text, later.text))
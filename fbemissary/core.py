@@ -2,18 +2,61 @@
 #     http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
 import logging
+import asyncio
 
-import aiohttp
 import attr
 
 from fbemissary import conversation
 from fbemissary import webhook
 from fbemissary import client
+from fbemissary import sharding
+from fbemissary import dedupe
+from fbemissary import metrics
+from fbemissary import journal
+from fbemissary import jsoncodec
+from fbemissary import receipts
 
 
 logger = logging.getLogger(__name__)
 
 
+@attr.s
+class ShutdownReport:
+    """
+    What :meth:`FacebookPageMessengerBot.stop` could not finish.
+
+    Attributes:
+        elapsed (float):
+            Seconds the shutdown took.
+        timed_out (list of str):
+            The stages that were still running at the deadline.
+        dropped_webhooks (int):
+            Queued webhook bodies that were never processed.
+        dropped_events (int):
+            Messaging events discarded from conversation queues.
+        interrupted_handlers (int):
+            Conversations whose handler was cancelled mid-event.
+        unsent_messages (int):
+            Outbound messages still in flight when the HTTP session
+            was closed.
+    """
+    elapsed = attr.ib(default=0.0)
+    timed_out = attr.ib(default=attr.Factory(list))
+    dropped_webhooks = attr.ib(default=0)
+    dropped_events = attr.ib(default=0)
+    interrupted_handlers = attr.ib(default=0)
+    unsent_messages = attr.ib(default=0)
+
+    @property
+    def clean(self):
+        """
+        Whether everything received was handled and sent.
+        """
+        return not (
+            self.timed_out or self.dropped_webhooks or self.dropped_events
+            or self.interrupted_handlers or self.unsent_messages)
+
+
 class FacebookPageMessengerBot:
     """
     Arguments:
@@ -27,13 +70,181 @@ class FacebookPageMessengerBot:
             subscription. Used by Facebook to verify your bot is
             actually yours.
 
+        ingest_queue_size (int or None):
+            If given, webhook requests are acknowledged as soon as
+            their signature is verified, and their bodies are put on
+            a queue of at most this many entries to be processed by
+            a pool of worker tasks. Requests arriving while the queue
+            is full are answered with a 503. If ``None`` (the
+            default), webhook requests are processed completely
+            before being acknowledged.
+
+        ingest_workers (int):
+            The number of worker tasks draining the ingest queue.
+            Ignored unless ``ingest_queue_size`` is given.
+
+        max_conversations (int or None):
+            The maximum number of conversations kept in memory. The
+            least recently used conversation that isn't busy handling
+            events is evicted beyond this. Unbounded if ``None`` (the
+            default).
+
+        conversation_idle_timeout (float or None):
+            Seconds after the last messaging event at which an idle
+            conversation is evicted. Never if ``None`` (the default).
+
+        send_dispatch_config
+                (:class:`fbemissary.client.SendDispatchConfig` or None):
+            If given, outbound messages are queued per page, coalesced
+            into Graph API batch requests and rate limited according
+            to it. Otherwise every message is sent right away with
+            its own request.
+
+        retry_policy (:class:`fbemissary.client.RetryPolicy` or None):
+            How outbound messages that fail for transient reasons are
+            retried, and when each page's circuit breaker opens. Pass
+            ``None`` to disable retries.
+
+        connection_pool_config
+                (:class:`fbemissary.client.ConnectionPoolConfig` or None):
+            Pool size, keep-alive, DNS caching and timeouts for the
+            outbound HTTP connections. Uses the defaults of
+            :class:`fbemissary.client.ConnectionPoolConfig` if
+            ``None``.
+
+        state_store (:class:`fbemissary.state.StateStore` or None):
+            If given, conversationalists get a persistent
+            :class:`fbemissary.state.ConversationState` as their
+            ``state`` attribute, stored in this backend, such as
+            :class:`fbemissary.state.SQLiteStateStore`.
+
+        state_flush_interval (float):
+            Seconds between batched writes of changed conversation
+            state to the ``state_store``.
+
+        dedupe_window (float or None):
+            If given, messages whose ID was seen within about this
+            many seconds are dropped as redeliveries. No
+            deduplication is done if ``None`` (the default).
+
+        dedupe_max_entries (int):
+            The most message IDs remembered per ``dedupe_window``,
+            bounding the memory used for deduplication.
+
+        graph_api_base_url (str):
+            The Graph API URL outbound messages are sent to. Only
+            useful for testing against a stand-in server.
+
+        receipt_window (float or None):
+            If given, delivery and read receipts are not passed to
+            conversationalists as events. Instead the latest
+            watermarks per conversation are kept, folding receipts
+            over windows of this many seconds, and conversationalists
+            read them through their ``receipts`` attribute (a
+            :class:`fbemissary.receipts.ConversationReceipts`).
+
+        receipt_max_conversations (int):
+            The most conversations whose receipt watermarks are kept.
+
+        journal_directory (str or None):
+            If given, verified webhook bodies are durably recorded in
+            an :class:`fbemissary.journal.IngestJournal` in this
+            directory before being acknowledged. Bodies with events
+            not yet handled by their conversationalist when the
+            process died are replayed on the next start, so every
+            webhook is handled at least once.
+
+        journal_segment_size (int):
+            The size in bytes of each journal segment file.
+
+        attachment_config
+                (:class:`fbemissary.attachments.AttachmentConfig` or None):
+            If given, media attached to received messages is
+            prefetched over the bot's HTTP session and cached, and
+            conversationalists await it through their ``attachments``
+            attribute (an
+            :class:`fbemissary.attachments.AttachmentService`).
+
+        attachment_ids_path (str or None):
+            A JSON file keeping the reusable IDs of media sent with
+            the repliers' ``send_image``, ``send_audio``,
+            ``send_video``, ``send_file`` and ``send_attachment``
+            methods, so each file or URL is uploaded once even across
+            restarts. IDs are kept in memory only if ``None``.
+
+        traffic_recorder
+                (:class:`fbemissary.replay.TrafficRecorder` or None):
+            If given, every webhook body acknowledged is recorded
+            with it, for replaying later with a
+            :class:`fbemissary.replay.TrafficReplayer`.
+
+        instrumentation
+                (:class:`fbemissary.metrics.Instrumentation` or None):
+            If given, the pipeline records Prometheus style metrics in
+            its registry and reports spans to its tracer. Pass
+            ``metrics_mountpoint`` to :meth:`start` to serve them.
+
+    Evicted conversations have their conversationalist's ``aclose``
+    coroutine method awaited, if it has one. A new conversationalist
+    is made if the counterpart sends another event later.
+
     """
-    def __init__(self, app_secret, verify_token):
+    def __init__(self, app_secret, verify_token, *,
+                 ingest_queue_size=None, ingest_workers=4,
+                 max_conversations=None, conversation_idle_timeout=None,
+                 send_dispatch_config=None,
+                 retry_policy=client.RetryPolicy(),
+                 connection_pool_config=None, state_store=None,
+                 state_flush_interval=1.0, dedupe_window=None,
+                 dedupe_max_entries=1000000,
+                 graph_api_base_url=client.GRAPH_API_BASE_URL,
+                 receipt_window=None, receipt_max_conversations=100000,
+                 journal_directory=None,
+                 journal_segment_size=64 * 1024 * 1024,
+                 attachment_config=None, attachment_ids_path=None,
+                 traffic_recorder=None, instrumentation=None):
+        if connection_pool_config is None:
+            connection_pool_config = client.ConnectionPoolConfig()
         self._app_secret = app_secret
         self._verify_token = verify_token
-        self._message_demuxer = conversation.MessagingEventDemuxer()
+        self._ingest_queue_size = ingest_queue_size
+        self._ingest_workers = ingest_workers
+        self._connection_pool_config = connection_pool_config
+        self._instrumentation = instrumentation
+        self._journal_directory = journal_directory
+        self._journal_segment_size = journal_segment_size
+        self._traffic_recorder = traffic_recorder
+        if dedupe_window is not None:
+            self._deduplicator = dedupe.MessageDeduplicator(
+                window=dedupe_window, max_entries=dedupe_max_entries)
+        else:
+            self._deduplicator = None
+        if receipt_window is not None:
+            self._receipt_aggregator = receipts.ReceiptAggregator(
+                window=receipt_window,
+                max_conversations=receipt_max_conversations)
+        else:
+            self._receipt_aggregator = None
+        self._message_demuxer = conversation.MessagingEventDemuxer(
+            max_conversations=max_conversations,
+            conversation_idle_timeout=conversation_idle_timeout,
+            send_dispatch_config=send_dispatch_config,
+            retry_policy=retry_policy,
+            state_store=state_store,
+            state_flush_interval=state_flush_interval,
+            graph_api_base_url=graph_api_base_url,
+            receipt_aggregator=self._receipt_aggregator,
+            attachment_config=attachment_config,
+            attachment_ids_path=attachment_ids_path,
+            instrumentation=instrumentation,
+        )
         # These are overwritten in start()
+        self._loop = None
+        self._session = None
         self._webhook_wrangler = None
+        self._ingest_queue = None
+        self._journal = None
+        self._shard_server = None
         self._receiver = None
         self._sender = None
         self._started = False
@@ -79,31 +290,238 @@ class FacebookPageMessengerBot:
         :mod:`fbemissary.models`) from a conversation with a single
         user and replies as needed.
 
+        Pages can be added while the bot is running; their
+        ``preinit_conversations`` are then created in the background.
+        See also :meth:`remove_page` and :meth:`rotate_page_token`.
+
+        Only messages are passed on unless the factory has a
+        ``consumed_event_kinds`` attribute, a set of
+        :class:`fbemissary.models.EventKind`. The included factories
+        take it from the conversationalist class.
+
         .. todo::
 
             Add documentation for the included concrete implementations
             of conversationalist factories.
         """
-        if self._started:
-            # TODO: Change this to a custom exception
-            raise RuntimeError('Cannot change config after start')
         self._message_demuxer.add_conversationalist_factory(
             page_id, page_access_token, conversationalist_factory,
             preinit_conversations)
 
-    async def start(self, webapp_mountpoint, webapp_router, *, loop):
-        if self._started:
-            # TODO: Change this to a custom exception
-            raise RuntimeError('Cannot start more than once')
-        self._session = aiohttp.ClientSession()
-        await self._message_demuxer.start(self._session, loop=loop)
-        self._webhook_wrangler = webhook.WebhookWrangler(
-            self._message_demuxer.add_messaging_events)
+    async def remove_page(self, page_id):
+        """
+        Stop handling the page ``page_id`` without restarting. Its
+        conversations are closed and its queued outbound messages
+        sent; webhook events for it are then reported as unhandled.
+        """
+        await self._message_demuxer.remove_page(page_id)
+
+    def rotate_page_token(self, page_id, page_access_token):
+        """
+        Replace the access token of the page ``page_id``. It takes
+        effect for every later send, including retries of sends
+        already in flight.
+        """
+        self._message_demuxer.rotate_page_token(page_id, page_access_token)
+
+    async def start(self, webapp_mountpoint, webapp_router, *, loop,
+                    metrics_mountpoint=None):
+        """
+        Start the bot, receiving webhooks at ``webapp_mountpoint`` on
+        the ``webapp_router``.
+
+        If ``metrics_mountpoint`` is given, the ``instrumentation``
+        registry is served there in the Prometheus text format.
+        """
+        if metrics_mountpoint is not None and self._instrumentation is None:
+            raise ValueError('metrics_mountpoint requires instrumentation')
+        await self._start_pipeline(loop)
+        if self._ingest_queue_size is not None:
+            self._ingest_queue = webhook.WebhookIngestQueue(
+                self._webhook_wrangler,
+                maxsize=self._ingest_queue_size,
+                workers=self._ingest_workers,
+                loop=loop,
+                instrumentation=self._instrumentation,
+            )
+            self._ingest_queue.start()
+        if self._traffic_recorder is not None:
+            self._traffic_recorder.start(loop=loop)
         self._receiver = webhook.WebhookReceiver(
             self._app_secret,
             self._verify_token,
             self._webhook_wrangler,
             loop=loop,
+            ingest_queue=self._ingest_queue,
+            instrumentation=self._instrumentation,
+            journal=self._journal,
+            recorder=self._traffic_recorder,
         )
         self._receiver.setup_routes(webapp_mountpoint, webapp_router)
+        if metrics_mountpoint is not None:
+            metrics.setup_metrics_route(
+                metrics_mountpoint, webapp_router,
+                self._instrumentation.registry)
+
+    async def start_shard_worker(self, socket_path, *, loop):
+        """
+        Start as a shard worker process of a sharded deployment,
+        handling the events a :class:`fbemissary.sharding.ShardFrontend`
+        forwards over the Unix socket at ``socket_path``, instead of
+        receiving webhooks directly.
+        """
+        await self._start_pipeline(loop)
+        self._shard_server = sharding.ShardWorkerServer(
+            socket_path, self._webhook_wrangler, loop=loop)
+        await self._shard_server.start()
+
+    async def _start_pipeline(self, loop):
+        if self._started:
+            # TODO: Change this to a custom exception
+            raise RuntimeError('Cannot start more than once')
         self._started = True
+        self._loop = loop
+        self._session = self._connection_pool_config.make_session()
+        await self._message_demuxer.start(self._session, loop=loop)
+        self._webhook_wrangler = webhook.WebhookWrangler(
+            self._message_demuxer.add_messaging_events,
+            deduplicator=self._deduplicator,
+            event_filter=self._message_demuxer.wants_event,
+            instrumentation=self._instrumentation,
+        )
+        if self._journal_directory is not None:
+            self._journal = journal.IngestJournal(
+                self._journal_directory,
+                loop=loop,
+                segment_size=self._journal_segment_size,
+            )
+            await self._replay_journal(await self._journal.open())
+
+    async def _replay_journal(self, entries):
+        for seq, content in entries:
+            pending = self._journal.pending(seq)
+            try:
+                structure = jsoncodec.loads(content)
+                await self._webhook_wrangler.handle_webhook_structure(
+                    structure, pending=pending)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    'Failed to replay journal entry %d', seq)
+            pending.release()
+
+    async def stop(self, timeout=30):
+        """
+        Stop the bot without losing work where possible: stop
+        accepting webhook requests (they're answered with a 503 so
+        Facebook redelivers them), or as a shard worker, frames from
+        the shard router, then wait up to ``timeout`` seconds in total
+        for queued webhooks or frames already sent, every
+        conversation's queued events and outbound messages in flight.
+        Whatever is left is cancelled, every conversation and the HTTP
+        session are closed, and a :class:`ShutdownReport` describing
+        what was dropped is returned.
+        """
+        if not self._started:
+            raise RuntimeError('Cannot stop before start')
+        started = self._loop.time()
+        deadline = started + timeout
+        report = ShutdownReport()
+        if self._receiver is not None:
+            self._receiver.stop_accepting()
+        if self._shard_server is not None:
+            # Frames the router already sent are handled before the
+            # conversations are drained
+            self._shard_server.stop_accepting()
+            await self._wait_until(
+                self._shard_server.join(), deadline,
+                'frames from the shard router', report)
+            await self._shard_server.close()
+        if self._ingest_queue is not None:
+            await self._wait_until(
+                self._ingest_queue.join(), deadline,
+                'processing of queued webhooks', report)
+            stats = self._ingest_queue.stats()
+            report.dropped_webhooks = stats.depth + stats.busy_workers
+            await self._ingest_queue.close()
+        demuxer = self._message_demuxer
+        await self._wait_until(
+            demuxer.drain_conversations(), deadline,
+            'conversations to handle their queued events', report)
+        await self._wait_until(
+            demuxer.drain_sends(), deadline,
+            'outbound messages in flight', report)
+        report.dropped_events = demuxer.queued_events()
+        report.interrupted_handlers = demuxer.busy_conversations()
+        report.unsent_messages = demuxer.in_flight_sends()
+        await demuxer.close()
+        if self._journal is not None:
+            await self._journal.close()
+        if self._traffic_recorder is not None:
+            await self._traffic_recorder.close()
+        await self._session.close()
+        report.elapsed = self._loop.time() - started
+        if report.clean:
+            logger.info('Stopped cleanly in %.2fs', report.elapsed)
+        else:
+            logger.warning('Stopped with work left unfinished: %r', report)
+        return report
+
+    async def _wait_until(self, coro, deadline, description, report):
+        # Unlike wait_for, this lets a coroutine that has nothing to
+        # wait for finish even once the deadline has passed.
+        task = self._loop.create_task(coro)
+        await asyncio.wait(
+            [task], timeout=max(0, deadline - self._loop.time()))
+        if task.done():
+            task.result()
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        logger.warning('Timed out waiting for %s', description)
+        report.timed_out.append(description)
+
+    def connection_pool_stats(self):
+        """
+        Return a :class:`fbemissary.client.ConnectionPoolStats` for the
+        outbound HTTP connection pool.
+        """
+        return client.connection_pool_stats(self._session.connector)
+
+    def ingest_queue_stats(self):
+        """
+        Return a :class:`fbemissary.webhook.IngestQueueStats` for the
+        webhook ingest queue, or ``None`` if it is not enabled.
+        """
+        if self._ingest_queue is None:
+            return None
+        return self._ingest_queue.stats()
+
+    def conversation_table_stats(self):
+        """
+        Return a :class:`fbemissary.conversation.ConversationTableStats`
+        describing the in-memory conversation table.
+        """
+        return self._message_demuxer.conversation_table_stats()
+
+    def receipt_stats(self):
+        """
+        Return a :class:`fbemissary.receipts.ReceiptAggregatorStats`, or
+        ``None`` if receipt aggregation is not enabled.
+        """
+        if self._receipt_aggregator is None:
+            return None
+        return self._receipt_aggregator.stats()
+
+    def dedupe_stats(self):
+        """
+        Return a :class:`fbemissary.dedupe.DeduplicatorStats`, or
+        ``None`` if deduplication is not enabled.
+        """
+        if self._deduplicator is None:
+            return None
+        return self._deduplicator.stats()
@@ -0,0 +1,86 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Detection of webhook events Facebook delivered more than once
+"""
+import time
+
+import attr
+
+
+@attr.s
+class DeduplicatorStats:
+    checked = attr.ib()
+    duplicates = attr.ib()
+    size = attr.ib()
+    rotations = attr.ib()
+
+    @property
+    def hit_rate(self):
+        if not self.checked:
+            return 0.0
+        return self.duplicates / self.checked
+
+
+class MessageDeduplicator:
+    """
+    Remembers recently seen message IDs in two rotating generations.
+
+    IDs are added to the current generation; when it is older than
+    ``window`` seconds or holds ``max_entries`` IDs, it becomes the
+    previous generation and the old previous one is dropped. An ID is
+    therefore remembered for at least ``window`` seconds unless
+    traffic exceeds ``max_entries`` IDs per window, and memory stays
+    bounded by twice ``max_entries`` IDs.
+    """
+    def __init__(self, *, window=600, max_entries=1000000,
+                 clock=time.monotonic):
+        self._window = window
+        self._max_entries = max_entries
+        self._clock = clock
+        self._current = set()
+        self._previous = set()
+        self._rotated_at = clock()
+        self._checked = 0
+        self._duplicates = 0
+        self._rotations = 0
+
+    def seen(self, message_id):
+        """
+        Return whether ``message_id`` was seen recently, and remember
+        it if not.
+        """
+        self._checked += 1
+        if message_id in self._current or message_id in self._previous:
+            self._duplicates += 1
+            return True
+        if (
+                len(self._current) >= self._max_entries
+                or self._clock() - self._rotated_at >= self._window
+            ):
+            self._rotate()
+        self._current.add(message_id)
+        return False
+
+    def forget(self, message_id):
+        """
+        Stop remembering ``message_id``, so its next delivery isn't a
+        duplicate. Used when the message couldn't be handled.
+        """
+        self._current.discard(message_id)
+        self._previous.discard(message_id)
+
+    def stats(self):
+        return DeduplicatorStats(
+            checked=self._checked,
+            duplicates=self._duplicates,
+            size=len(self._current) + len(self._previous),
+            rotations=self._rotations,
+        )
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = set()
+        self._rotated_at = self._clock()
+        self._rotations += 1
@@ -0,0 +1,321 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Durable local journal of received webhook bodies
+
+Verified webhook bodies are appended to the journal, and made durable
+with fsync, before the request is acknowledged. Once a body has been
+handled a "processed" marker is appended for it. On startup, bodies
+without a marker are handed back for replay, so a crash between
+acknowledging a webhook and handling it loses nothing.
+
+The journal is a directory of append-only segment files. Each record
+is a header (kind, sequence number, length, CRC32) followed by the
+body. Segments are rotated at about ``segment_size`` bytes and deleted
+once every body in them, and in every older segment, has been
+processed. Deleting strictly oldest first keeps the processed markers a
+segment holds for bodies in older segments until those are gone too.
+
+Appends arriving while an fsync is running are written and synced
+together by the next one, so under load the cost of an fsync is shared
+by every webhook in a burst.
+"""
+import os
+import zlib
+import struct
+import asyncio
+import logging
+import concurrent.futures
+
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!BQII')
+_BODY = 1
+_PROCESSED = 2
+_SEGMENT_PREFIX = 'journal-'
+_SEGMENT_SUFFIX = '.seg'
+
+
+def _encode_record(kind, seq, payload=b''):
+    return _HEADER.pack(kind, seq, len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_segment(path):
+    """
+    Yield ``(kind, seq, payload)`` for every intact record in the
+    segment at ``path``, stopping at a torn or corrupt record.
+    """
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        kind, seq, length, crc = _HEADER.unpack_from(data, offset)
+        start = offset + _HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.warning(
+                'Ignoring torn journal record at offset %d of %s',
+                offset, path)
+            return
+        yield kind, seq, payload
+        offset = start + length
+
+
+class IngestJournal:
+    """
+    Append-only journal of webhook bodies in ``directory``.
+
+    Call :meth:`open` before use; it returns the bodies that were
+    never marked processed.
+
+    Arguments:
+        directory (str):
+            Where the segment files are kept. Created if missing.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        segment_size (int):
+            The size in bytes past which a new segment is started.
+    """
+    def __init__(self, directory, *, loop, segment_size=64 * 1024 * 1024):
+        self._directory = directory
+        self._loop = loop
+        self._segment_size = segment_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._next_seq = 0
+        # Map of segment first sequence number -> unprocessed body count
+        self._segments = {}
+        # Map of unprocessed sequence number -> segment
+        self._unprocessed = {}
+        self._current_segment = None
+        self._current_size = 0
+        # Operations waiting for the next commit: ('write', bytes),
+        # ('open', path) or ('delete', path)
+        self._pending = []
+        self._next_commit = None
+        self._committer = None
+        self._file = None
+
+    async def open(self):
+        """
+        Read the existing segments, delete those fully processed, and
+        return a list of ``(seq, body)`` pairs for the unprocessed
+        bodies, in the order they were received.
+        """
+        segments, bodies, last_seq = await self._run(self._open_sync)
+        for first_seq, seqs in segments.items():
+            self._segments[first_seq] = len(seqs)
+            for seq in seqs:
+                self._unprocessed[seq] = first_seq
+        self._next_seq = last_seq + 1
+        self._rotate()
+        await self._commit()
+        if bodies:
+            logger.info(
+                'Found %d unprocessed journal entries', len(bodies))
+        return sorted(bodies.items())
+
+    async def append(self, body):
+        """
+        Add a webhook body to the journal, returning its sequence
+        number once it is on disk.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        record = _encode_record(_BODY, seq, body)
+        if self._current_size + len(record) > self._segment_size:
+            self._rotate()
+        self._pending.append(('write', record))
+        self._current_size += len(record)
+        self._unprocessed[seq] = self._current_segment
+        self._segments[self._current_segment] += 1
+        await self._commit()
+        return seq
+
+    def mark_processed(self, seq):
+        """
+        Record that the body with sequence number ``seq`` has been
+        handled. The marker is written with the next commit.
+        """
+        segment = self._unprocessed.pop(seq, None)
+        if segment is None:
+            return
+        record = _encode_record(_PROCESSED, seq)
+        self._pending.append(('write', record))
+        self._current_size += len(record)
+        self._segments[segment] -= 1
+        self._delete_drained_segments()
+        self._request_commit()
+
+    def pending(self, seq):
+        """
+        Return a :class:`PendingBody` that marks the body with
+        sequence number ``seq`` processed once it is released by
+        everything handling the body.
+        """
+        return PendingBody(self, seq)
+
+    @property
+    def unprocessed(self):
+        return len(self._unprocessed)
+
+    async def close(self):
+        """
+        Write outstanding markers and close the current segment.
+        """
+        if self._pending:
+            await self._commit()
+        if self._committer is not None:
+            await self._committer
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=False)
+
+    def _rotate(self):
+        self._current_segment = self._next_seq
+        self._segments[self._current_segment] = 0
+        self._current_size = 0
+        self._pending.append(
+            ('open', self._segment_path(self._current_segment)))
+        self._delete_drained_segments()
+
+    def _delete_drained_segments(self):
+        # Oldest first, stopping at the first segment still needed: a
+        # drained segment may hold the markers of bodies in an older
+        # live one.
+        for first_seq in sorted(self._segments):
+            if (first_seq == self._current_segment
+                    or self._segments[first_seq]):
+                return
+            del self._segments[first_seq]
+            self._pending.append(('delete', self._segment_path(first_seq)))
+
+    def _segment_path(self, first_seq):
+        return os.path.join(
+            self._directory,
+            '{0}{1:020d}{2}'.format(
+                _SEGMENT_PREFIX, first_seq, _SEGMENT_SUFFIX))
+
+    async def _commit(self):
+        # Shielded so a cancelled request doesn't cancel the commit
+        # other requests are waiting for.
+        await asyncio.shield(self._request_commit())
+
+    def _request_commit(self):
+        if self._next_commit is None:
+            self._next_commit = self._loop.create_future()
+            self._next_commit.add_done_callback(_retrieve_exception)
+            if self._committer is None:
+                self._committer = self._loop.create_task(self._commit_all())
+        return self._next_commit
+
+    async def _commit_all(self):
+        try:
+            while self._next_commit is not None:
+                operations, self._pending = self._pending, []
+                future, self._next_commit = self._next_commit, None
+                try:
+                    await self._run(self._apply_sync, operations)
+                except Exception as exc:
+                    logger.exception('Failed to write to ingest journal')
+                    future.set_exception(exc)
+                else:
+                    future.set_result(None)
+        finally:
+            self._committer = None
+
+    async def _run(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self):
+        os.makedirs(self._directory, exist_ok=True)
+        names = sorted(
+            name for name in os.listdir(self._directory)
+            if name.startswith(_SEGMENT_PREFIX)
+            and name.endswith(_SEGMENT_SUFFIX)
+        )
+        # Map of segment first sequence number -> unprocessed seqs
+        segments = {}
+        bodies = {}
+        last_seq = -1
+        for name in names:
+            first_seq = int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)])
+            last_seq = max(last_seq, first_seq)
+            seqs = segments[first_seq] = set()
+            for kind, seq, payload in _read_segment(
+                    os.path.join(self._directory, name)):
+                last_seq = max(last_seq, seq)
+                if kind == _BODY:
+                    bodies[seq] = payload
+                    seqs.add(seq)
+                elif kind == _PROCESSED:
+                    bodies.pop(seq, None)
+                    for owner in segments.values():
+                        owner.discard(seq)
+        return segments, bodies, last_seq
+
+    def _apply_sync(self, operations):
+        for operation, argument in operations:
+            if operation == 'write':
+                self._file.write(argument)
+            elif operation == 'open':
+                self._close_sync()
+                self._file = open(argument, 'ab')
+                self._fsync_directory()
+            elif operation == 'delete':
+                try:
+                    os.unlink(argument)
+                except FileNotFoundError:
+                    pass
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _fsync_directory(self):
+        fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _close_sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class PendingBody:
+    """
+    A journaled body that is still being handled, counting the holds
+    on it. It starts with one hold, for whoever received the body;
+    each queued event parsed from it takes another until its handler
+    returns. When the last hold is released the body is marked
+    processed.
+
+    Bodies that are never fully released, because handling was
+    cancelled or their events were discarded on shutdown, stay
+    unprocessed and are replayed after a restart.
+    """
+    __slots__ = ('_journal', '_seq', '_holds')
+
+    def __init__(self, journal, seq):
+        self._journal = journal
+        self._seq = seq
+        self._holds = 1
+
+    def hold(self):
+        self._holds += 1
+
+    def release(self):
+        self._holds -= 1
+        if self._holds == 0:
+            self._journal.mark_processed(self._seq)
+
+
+def _retrieve_exception(future):
+    # Commits for markers have nobody awaiting them; failures are
+    # already logged.
+    if not future.cancelled():
+        future.exception()
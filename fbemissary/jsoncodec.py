@@ -0,0 +1,34 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+JSON encoding and decoding for the hot paths
+
+:func:`loads` takes bytes and :func:`dumps` returns bytes. They use
+orjson if it is installed, and the standard library :mod:`json`
+otherwise. Components that decode or encode JSON accept their own
+``json_loads``/``json_dumps`` callables with the same signatures to
+override these.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def stdlib_loads(content):
+    return json.loads(content.decode('utf-8'))
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:  # pragma: no cover
+    loads = stdlib_loads
+    dumps = stdlib_dumps
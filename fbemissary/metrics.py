@@ -0,0 +1,293 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Metrics and tracing hooks for the messaging pipeline
+
+Pass an :class:`Instrumentation` to
+:class:`fbemissary.FacebookPageMessengerBot` to collect Prometheus
+style metrics, optionally served on a ``/metrics`` route, and to
+report spans to a :class:`Tracer`. Without one, the pipeline skips
+all measurement.
+"""
+import time
+import logging
+import contextlib
+
+import aiohttp.web
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds, suitable for everything from parsing to Send API calls
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, _escape_label_value(value))
+        for name, value in pairs
+    ) + '}'
+
+
+def _escape_label_value(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help),
+            '# TYPE {0} {1}'.format(self.name, self.type_name),
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def _render_samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield '{0}{1} {2}'.format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value))
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # Map of labels -> [per-bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        try:
+            state = self._values[labels]
+        except KeyError:
+            state = self._values[labels] = [0] * (len(self._buckets) + 2)
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                state[index] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def count(self, labels=()):
+        state = self._values.get(labels)
+        return 0 if state is None else state[-1]
+
+    def _render_samples(self):
+        for labels, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, state):
+                cumulative += bucket_count
+                yield '{0}_bucket{1} {2}'.format(
+                    self.name,
+                    _format_labels(
+                        self.labelnames, labels,
+                        [('le', _format_value(bound))]),
+                    cumulative)
+            yield '{0}_bucket{1} {2}'.format(
+                self.name,
+                _format_labels(self.labelnames, labels, [('le', '+Inf')]),
+                state[-1])
+            label_text = _format_labels(self.labelnames, labels)
+            yield '{0}_sum{1} {2}'.format(
+                self.name, label_text, _format_value(state[-2]))
+            yield '{0}_count{1} {2}'.format(
+                self.name, label_text, state[-1])
+
+
+class MetricsRegistry:
+    """
+    A collection of metrics, rendered together in the Prometheus text
+    exposition format.
+
+    Collectors are callables run before rendering, for metrics that
+    are cheaper to read on demand than to keep up to date, like queue
+    depths.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception('Error in metrics collector %r', collector)
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+class Tracer:
+    """
+    Interface for attaching a tracing system, such as OpenTelemetry.
+
+    :meth:`start_span` is called at each traced point in the pipeline
+    and must return an object with an ``end()`` method, called when
+    the traced operation finishes. The base implementation does
+    nothing.
+    """
+    def start_span(self, name, attributes):
+        return _NULL_SPAN
+
+
+class _NullSpan:
+    def end(self):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation:
+    """
+    The metrics and tracer used throughout the pipeline.
+
+    Arguments:
+        registry (:class:`MetricsRegistry` or None):
+            The registry to create the pipeline's metrics in. A new
+            one is made if ``None``.
+        tracer (:class:`Tracer` or None):
+            Receives spans for webhook handling, conversationalist
+            creation, event handling, Send API calls and attachment
+            uploads.
+    """
+    def __init__(self, registry=None, tracer=None):
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.tracer = tracer or Tracer()
+        self.clock = time.perf_counter
+        self.webhook_requests = registry.counter(
+            'fbemissary_webhook_requests_total',
+            'Webhook requests received, by outcome',
+            ['outcome'])
+        self.signature_seconds = registry.histogram(
+            'fbemissary_webhook_signature_seconds',
+            'Time spent verifying webhook signatures')
+        self.decode_seconds = registry.histogram(
+            'fbemissary_webhook_decode_seconds',
+            'Time spent decoding webhook bodies')
+        self.parse_seconds = registry.histogram(
+            'fbemissary_event_parse_seconds',
+            'Time spent building models from messaging event structures')
+        self.events = registry.counter(
+            'fbemissary_events_total',
+            'Messaging events received, by outcome',
+            ['outcome'])
+        self.demux_lookup_seconds = registry.histogram(
+            'fbemissary_demux_lookup_seconds',
+            'Time spent looking up the conversation for an event')
+        self.conversationalist_create_seconds = registry.histogram(
+            'fbemissary_conversationalist_create_seconds',
+            'Time spent in make_conversationalist')
+        self.conversation_queue_depth = registry.histogram(
+            'fbemissary_conversation_queue_depth',
+            'Events queued in a conversation when a new one is added',
+            buckets=QUEUE_DEPTH_BUCKETS)
+        self.conversation_queue_overflows = registry.counter(
+            'fbemissary_conversation_queue_overflows_total',
+            'Events arriving at a full conversation queue, by policy',
+            ['policy'])
+        self.handler_seconds = registry.histogram(
+            'fbemissary_handler_seconds',
+            'Time spent in conversationalist event handlers')
+        self.send_seconds = registry.histogram(
+            'fbemissary_send_seconds',
+            'Send API request latency, by HTTP status',
+            ['status'])
+        self.upload_seconds = registry.histogram(
+            'fbemissary_upload_seconds',
+            'Attachment Upload API request latency, by HTTP status',
+            ['status'])
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = self.tracer.start_span(name, attributes)
+        try:
+            yield span
+        finally:
+            span.end()
+
+
+def setup_metrics_route(mountpoint, router, registry):
+    """
+    Add a GET route at ``mountpoint`` serving the ``registry`` in the
+    Prometheus text exposition format.
+    """
+    async def serve_metrics(request):
+        return aiohttp.web.Response(
+            body=registry.render().encode('utf-8'),
+            headers={'Content-Type': PROMETHEUS_CONTENT_TYPE},
+        )
+    router.add_get(mountpoint, serve_metrics)
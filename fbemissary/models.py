@@ -6,16 +6,71 @@ import enum
 import attr
 
 
-def model_from_entry_structure(entry):
-    if 'message' in entry:
-        return ReceivedMessage.from_message_structure(entry)
-    else:
-        raise ValueError(
-            'Unsupported entry type in entry {0!r}'.format(entry)
-        )
+class EventKind(enum.Enum):
+    message = 'message'
+    echo = 'echo'
+    postback = 'postback'
+    delivery = 'delivery'
+    read = 'read'
+    optin = 'optin'
+    referral = 'referral'
+
+
+class UnsupportedEventType(ValueError):
+    """
+    The messaging event structure is not of any known kind.
+    """
+
+
+# Map of the key identifying each kind of messaging event structure
+# -> kind. Messages and echoes share a key.
+_KIND_KEYS = {
+    'message': EventKind.message,
+    'postback': EventKind.postback,
+    'delivery': EventKind.delivery,
+    'read': EventKind.read,
+    'optin': EventKind.optin,
+    'referral': EventKind.referral,
+}
+
+
+def event_kind(entry):
+    """
+    Return the :class:`EventKind` of the messaging event structure, or
+    ``None`` if it isn't a known kind. No model is built.
+    """
+    for key in entry:
+        kind = _KIND_KEYS.get(key)
+        if kind is None:
+            continue
+        if kind is EventKind.message and entry[key].get('is_echo'):
+            return EventKind.echo
+        return kind
+    return None
+
+
+def model_from_entry_structure(entry, kind=None):
+    """
+    Build the model for a messaging event structure. Pass the ``kind``
+    if it's already known from :func:`event_kind`.
 
+    Raises :class:`UnsupportedEventType` for unknown kinds.
+    """
+    if kind is None:
+        kind = event_kind(entry)
+        if kind is None:
+            raise UnsupportedEventType(
+                'Unsupported entry type in entry {0!r}'.format(entry)
+            )
+    return _MODEL_BUILDERS[kind](entry)
 
-@attr.s
+
+def _sender_id(structure):
+    sender = structure.get('sender')
+    return None if sender is None else sender['id']
+
+
+@attr.s(slots=True, frozen=True)
 class ReceivedMessage:
     sender_id = attr.ib()
     recipient_id = attr.ib()
@@ -28,20 +83,192 @@ class ReceivedMessage:
     @classmethod
     def from_message_structure(cls, structure):
         mstruct = structure['message']
-        quick_reply = mstruct.get('quick_reply', {'payload': None})['payload']
+        quick_reply = mstruct.get('quick_reply')
+        attachment_structures = mstruct.get('attachments')
+        return cls(
+            structure['sender']['id'],
+            structure['recipient']['id'],
+            structure['timestamp'],
+            mstruct['mid'],
+            mstruct.get('text'),
+            [_attachment_from_structure(s) for s in attachment_structures]
+            if attachment_structures else [],
+            None if quick_reply is None else quick_reply['payload'],
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.sender_id
+
+
+@attr.s(slots=True, frozen=True)
+class Echo:
+    """
+    A message sent by the page, echoed back.
+    """
+    sender_id = attr.ib()
+    recipient_id = attr.ib()
+    timestamp = attr.ib()
+    id = attr.ib()
+    text = attr.ib()
+    attachments = attr.ib()
+    app_id = attr.ib()  # The app that sent it, None if sent by a person
+    metadata = attr.ib()  # Optional custom data from the sending app
+
+    @classmethod
+    def from_echo_structure(cls, structure):
+        mstruct = structure['message']
+        attachment_structures = mstruct.get('attachments')
+        return cls(
+            structure['sender']['id'],
+            structure['recipient']['id'],
+            structure['timestamp'],
+            mstruct['mid'],
+            mstruct.get('text'),
+            [_attachment_from_structure(s) for s in attachment_structures]
+            if attachment_structures else [],
+            mstruct.get('app_id'),
+            mstruct.get('metadata'),
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.recipient_id
+
+
+@attr.s(slots=True, frozen=True)
+class Postback:
+    sender_id = attr.ib()
+    recipient_id = attr.ib()
+    timestamp = attr.ib()
+    title = attr.ib()
+    payload = attr.ib()
+    referral = attr.ib()  # A Referral if the user came from a m.me link
+
+    @classmethod
+    def from_postback_structure(cls, structure):
+        pstruct = structure['postback']
+        referral = pstruct.get('referral')
+        return cls(
+            structure['sender']['id'],
+            structure['recipient']['id'],
+            structure['timestamp'],
+            pstruct.get('title'),
+            pstruct.get('payload'),
+            None if referral is None else Referral.from_referral_fields(
+                structure, referral),
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.sender_id
+
+
+@attr.s(slots=True, frozen=True)
+class DeliveryReceipt:
+    """
+    Messages sent by the page up to ``watermark`` were delivered.
+    """
+    sender_id = attr.ib()
+    recipient_id = attr.ib()
+    timestamp = attr.ib()  # Not always present
+    watermark = attr.ib()
+    message_ids = attr.ib()  # Not always present
+
+    @classmethod
+    def from_delivery_structure(cls, structure):
+        dstruct = structure['delivery']
+        return cls(
+            structure['sender']['id'],
+            structure['recipient']['id'],
+            structure.get('timestamp'),
+            dstruct['watermark'],
+            dstruct.get('mids', []),
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.sender_id
+
+
+@attr.s(slots=True, frozen=True)
+class ReadReceipt:
+    """
+    Messages sent by the page up to ``watermark`` were read.
+    """
+    sender_id = attr.ib()
+    recipient_id = attr.ib()
+    timestamp = attr.ib()
+    watermark = attr.ib()
+
+    @classmethod
+    def from_read_structure(cls, structure):
+        return cls(
+            structure['sender']['id'],
+            structure['recipient']['id'],
+            structure['timestamp'],
+            structure['read']['watermark'],
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.sender_id
+
+
+@attr.s(slots=True, frozen=True)
+class Optin:
+    sender_id = attr.ib()  # None for the checkbox plugin
+    recipient_id = attr.ib()
+    timestamp = attr.ib()
+    ref = attr.ib()  # The data-ref of the plugin
+    user_ref = attr.ib()  # Set by the checkbox plugin instead of sender
+
+    @classmethod
+    def from_optin_structure(cls, structure):
+        ostruct = structure['optin']
+        return cls(
+            _sender_id(structure),
+            structure['recipient']['id'],
+            structure['timestamp'],
+            ostruct.get('ref'),
+            ostruct.get('user_ref'),
+        )
+
+    @property
+    def counterpart_id(self):
+        return self.sender_id if self.sender_id is not None else self.user_ref
+
+
+@attr.s(slots=True, frozen=True)
+class Referral:
+    sender_id = attr.ib()
+    recipient_id = attr.ib()
+    timestamp = attr.ib()
+    ref = attr.ib()
+    source = attr.ib()  # e.g. 'SHORTLINK' or 'ADS'
+    type = attr.ib()
+    ad_id = attr.ib()
+
+    @classmethod
+    def from_referral_structure(cls, structure):
+        return cls.from_referral_fields(structure, structure['referral'])
+
+    @classmethod
+    def from_referral_fields(cls, structure, rstruct):
         return cls(
-            sender_id=structure['sender']['id'],
-            recipient_id=structure['recipient']['id'],
-            timestamp=structure['timestamp'],
-            id=mstruct['mid'],
-            text=mstruct.get('text'),
-            attachments=[
-                _attachment_from_structure(s)
-                for s in mstruct.get('attachments', [])
-            ],
-            quick_reply=quick_reply,
+            _sender_id(structure),
+            structure['recipient']['id'],
+            structure.get('timestamp'),
+            rstruct.get('ref'),
+            rstruct.get('source'),
+            rstruct.get('type'),
+            rstruct.get('ad_id'),
         )
 
+    @property
+    def counterpart_id(self):
+        return self.sender_id
+
 
 class AttachmentType(enum.Enum):
     audio = 'audio'
@@ -57,7 +284,8 @@ def _attachment_from_structure(structure):
     else:
         return MediaAttachment.from_structure(structure)
 
-@attr.s
+
+@attr.s(slots=True, frozen=True)
 class MediaAttachment:
     type = attr.ib()
     url = attr.ib()
@@ -75,7 +303,7 @@ class MediaAttachment:
         return cls(type, url)
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class LocationAttachment:
     type = attr.ib()
     latitude = attr.ib()
@@ -86,9 +314,20 @@ class LocationAttachment:
         if structure['type'] != 'location':
             fmt = "Expected 'location' for type key but got {0!r}"
             raise ValueError(fmt.format(structure['type']))
-        payload = structure['payload']
+        coordinates = structure['payload']['coordinates']
         return cls(
             AttachmentType.location,
-            payload['coordinates']['lat'],
-            payload['coordinates']['long'],
+            coordinates['lat'],
+            coordinates['long'],
         )
+
+
+_MODEL_BUILDERS = {
+    EventKind.message: ReceivedMessage.from_message_structure,
+    EventKind.echo: Echo.from_echo_structure,
+    EventKind.postback: Postback.from_postback_structure,
+    EventKind.delivery: DeliveryReceipt.from_delivery_structure,
+    EventKind.read: ReadReceipt.from_read_structure,
+    EventKind.optin: Optin.from_optin_structure,
+    EventKind.referral: Referral.from_referral_structure,
+}
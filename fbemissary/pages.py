@@ -0,0 +1,111 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+The set of pages a bot handles
+
+A :class:`PageRegistry` holds each page's access token and
+conversationalist factory. Pages can be added, removed and have their
+token rotated while the bot runs. The
+:class:`fbemissary.client.PageMessagingAPIClient` of a page is only
+created when one of its conversations first needs it, so a bot hosting
+many pages doesn't pay for the clients of pages that are quiet.
+"""
+import attr
+
+
+@attr.s(slots=True)
+class Page:
+    """
+    Attributes:
+        page_id (str):
+            The Facebook Page ID.
+        access_token (str):
+            The current page access token.
+        conversationalist_factory:
+            Makes the conversationalists for the page's conversations.
+        consumed_event_kinds
+                (frozenset of :class:`fbemissary.models.EventKind`):
+            The event kinds the conversationalists receive.
+        client
+                (:class:`fbemissary.client.PageMessagingAPIClient` or None):
+            The page's client, once it has been created.
+    """
+    page_id = attr.ib()
+    access_token = attr.ib()
+    conversationalist_factory = attr.ib()
+    consumed_event_kinds = attr.ib()
+    client = attr.ib(default=None)
+
+
+class PageRegistry:
+    """
+    Mapping of page ID to :class:`Page`.
+
+    Page clients are made by the callable given to :meth:`bind`, with
+    the page ID and access token as arguments.
+    """
+    def __init__(self):
+        self._pages = {}
+        self._make_client = None
+
+    def __contains__(self, page_id):
+        return page_id in self._pages
+
+    def __iter__(self):
+        return iter(list(self._pages.values()))
+
+    def __len__(self):
+        return len(self._pages)
+
+    def bind(self, make_client):
+        self._make_client = make_client
+
+    def get(self, page_id):
+        return self._pages.get(page_id)
+
+    def add(self, page_id, access_token, conversationalist_factory,
+            consumed_event_kinds):
+        if page_id in self._pages:
+            raise ValueError(
+                'Page ID {0!r} already assigned factory'.format(page_id))
+        page = Page(
+            page_id, access_token, conversationalist_factory,
+            consumed_event_kinds)
+        self._pages[page_id] = page
+        return page
+
+    def remove(self, page_id):
+        """
+        Remove and return the :class:`Page`. Raises :class:`KeyError`
+        if there is none with ``page_id``.
+        """
+        return self._pages.pop(page_id)
+
+    def rotate_token(self, page_id, access_token):
+        """
+        Replace the page's access token. Sends made after this,
+        including retries of sends already in flight, use the new
+        token.
+        """
+        page = self._pages[page_id]
+        page.access_token = access_token
+        if page.client is not None:
+            page.client.rotate_access_token(access_token)
+
+    def client_for(self, page):
+        """
+        Return the page's client, creating it on first use.
+        """
+        if page.client is None:
+            page.client = self._make_client(page.page_id, page.access_token)
+        return page.client
+
+    def clients(self):
+        """
+        Return a list of the page clients created so far.
+        """
+        return [
+            page.client for page in self._pages.values()
+            if page.client is not None
+        ]
@@ -0,0 +1,175 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Delivery and read receipt aggregation
+
+Facebook sends a delivery and a read watermark for nearly every
+message a page sends. Rather than queueing each one for the
+conversationalist as an event, a :class:`ReceiptAggregator` keeps only
+the latest watermarks per conversation, which conversationalists read
+through their ``receipts`` attribute, a :class:`ConversationReceipts`.
+"""
+import asyncio
+import logging
+import collections
+
+import attr
+
+from fbemissary import models
+
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_KINDS = frozenset({models.EventKind.delivery, models.EventKind.read})
+
+
+@attr.s
+class ReceiptAggregatorStats:
+    received = attr.ib()
+    pending = attr.ib()
+    conversations = attr.ib()
+    max_conversations = attr.ib()
+
+
+class ConversationReceipts:
+    """
+    The latest receipt watermarks of a single conversation: every
+    message the page sent up to the watermark timestamp has been
+    delivered or read. A watermark is ``None`` until a receipt has
+    been seen.
+    """
+    __slots__ = ('_aggregator', '_key')
+
+    def __init__(self, aggregator, key):
+        self._aggregator = aggregator
+        self._key = key
+
+    @property
+    def delivered_watermark(self):
+        return self._aggregator.watermarks(self._key)[0]
+
+    @property
+    def read_watermark(self):
+        return self._aggregator.watermarks(self._key)[1]
+
+    def delivered(self, timestamp):
+        """
+        Whether a message sent at ``timestamp`` has been delivered.
+        Messages that have been read have been delivered too.
+        """
+        delivered, read = self._aggregator.watermarks(self._key)
+        return any(
+            watermark is not None and timestamp <= watermark
+            for watermark in (delivered, read))
+
+    def read(self, timestamp):
+        """
+        Whether a message sent at ``timestamp`` has been read.
+        """
+        read = self._aggregator.watermarks(self._key)[1]
+        return read is not None and timestamp <= read
+
+
+class ReceiptAggregator:
+    """
+    Folds delivery and read receipts into the latest watermark per
+    ``(page_id, counterpart_id)``.
+
+    Receipts received within ``window`` seconds of each other are
+    folded into a plain dict, which is merged into the longer lived
+    table once per window, so a burst of receipts costs one update of
+    the table per conversation. The table keeps the watermarks of the
+    ``max_conversations`` most recently updated conversations.
+    """
+    def __init__(self, *, window=1.0, max_conversations=100000):
+        self._window = window
+        self._max_conversations = max_conversations
+        # Map of key -> [delivered watermark, read watermark]
+        self._pending = {}
+        self._watermarks = collections.OrderedDict()
+        self._received = 0
+        self._flusher = None
+
+    def start(self, *, loop):
+        self._flusher = loop.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        self.flush()
+
+    def fold(self, page_id, events):
+        """
+        Fold the receipts among ``events`` and return a list of the
+        other events, in order.
+        """
+        others = []
+        pending = self._pending
+        for event in events:
+            if isinstance(event, models.DeliveryReceipt):
+                index = 0
+            elif isinstance(event, models.ReadReceipt):
+                index = 1
+            else:
+                others.append(event)
+                continue
+            self._received += 1
+            key = (page_id, event.counterpart_id)
+            marks = pending.get(key)
+            if marks is None:
+                marks = pending[key] = [None, None]
+            if marks[index] is None or event.watermark > marks[index]:
+                marks[index] = event.watermark
+        return others
+
+    def receipts_for(self, page_id, counterpart_id):
+        return ConversationReceipts(self, (page_id, counterpart_id))
+
+    def watermarks(self, key):
+        """
+        Return the ``(delivered, read)`` watermarks for ``key``,
+        including receipts not yet flushed.
+        """
+        published = self._watermarks.get(key, (None, None))
+        pending = self._pending.get(key)
+        if pending is None:
+            return published
+        return tuple(
+            _latest(old, new) for old, new in zip(published, pending))
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        table = self._watermarks
+        for key, marks in pending.items():
+            published = table.pop(key, (None, None))
+            table[key] = tuple(
+                _latest(old, new) for old, new in zip(published, marks))
+        while len(table) > self._max_conversations:
+            table.popitem(last=False)
+
+    def stats(self):
+        return ReceiptAggregatorStats(
+            received=self._received,
+            pending=len(self._pending),
+            conversations=len(self._watermarks),
+            max_conversations=self._max_conversations,
+        )
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._window)
+            self.flush()
+
+
+def _latest(old, new):
+    if new is None:
+        return old
+    if old is None:
+        return new
+    return max(old, new)
@@ -0,0 +1,337 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Recording webhook traffic and replaying it
+
+A :class:`TrafficRecorder` given to the bot writes every webhook body
+it acknowledges to a file, one JSON object per line with the seconds
+since the first one, optionally scrubbing personal data first.
+
+A :class:`TrafficReplayer` feeds such a file back through a
+:class:`fbemissary.webhook.WebhookWrangler` at the recorded pace, a
+multiple of it, or as fast as possible. To replay without talking to
+Facebook, have the demuxer use :class:`StubPageMessagingAPIClient`::
+
+    demuxer = conversation.MessagingEventDemuxer(
+        page_client_class=replay.StubPageMessagingAPIClient)
+    demuxer.add_conversationalist_factory(
+        page_id, 'TOKEN', factory, ())
+    await demuxer.start(None, loop=loop)
+    wrangler = webhook.WebhookWrangler(
+        demuxer.add_messaging_events, event_filter=demuxer.wants_event)
+    stats = await replay.TrafficReplayer(
+        wrangler, loop=loop, speed=10).run('traffic.jsonl')
+    await demuxer.drain_conversations()
+"""
+import os
+import copy
+import asyncio
+import hashlib
+import logging
+import concurrent.futures
+
+import attr
+
+from fbemissary import client
+from fbemissary import jsoncodec
+
+
+logger = logging.getLogger(__name__)
+
+_SCRUBBED_URL = 'https://scrubbed.invalid/'
+
+
+def scrub_structure(structure, salt):
+    """
+    Return a copy of a webhook structure with personal data replaced:
+    sender IDs and user refs by stable pseudonyms (so conversations
+    stay together), message and postback texts by as many ``x``
+    characters, and attachment URLs and coordinates by placeholders.
+    Page IDs, timestamps and the shape of the structure are kept.
+
+    The pseudonyms are derived from ``salt``, a non-empty string that
+    must be kept secret: anyone who has it can map known IDs to their
+    pseudonyms.
+    """
+    if not salt:
+        raise ValueError('A salt is required to scrub structures')
+    scrubbed = copy.deepcopy(structure)
+    for entry in scrubbed.get('entry', ()):
+        for event in entry.get('messaging', ()):
+            _scrub_event(event, salt)
+    return scrubbed
+
+
+def _pseudonym(value, salt):
+    digest = hashlib.sha256((salt + value).encode('utf-8')).hexdigest()
+    return 'anon-' + digest[:16]
+
+
+def _blank(text):
+    return 'x' * len(text)
+
+
+def _scrub_event(event, salt):
+    message = event.get('message')
+    # Echoes are sent by the page to the user
+    if message is not None and message.get('is_echo'):
+        user = event.get('recipient')
+    else:
+        user = event.get('sender')
+    if user is not None and 'id' in user:
+        user['id'] = _pseudonym(user['id'], salt)
+    if message is not None:
+        if isinstance(message.get('text'), str):
+            message['text'] = _blank(message['text'])
+        for attachment in message.get('attachments') or ():
+            payload = attachment.get('payload') or {}
+            if 'url' in payload:
+                payload['url'] = _SCRUBBED_URL
+            if 'coordinates' in payload:
+                payload['coordinates'] = {'lat': 0.0, 'long': 0.0}
+    postback = event.get('postback')
+    if postback is not None and isinstance(postback.get('title'), str):
+        postback['title'] = _blank(postback['title'])
+    optin = event.get('optin')
+    if optin is not None and 'user_ref' in optin:
+        optin['user_ref'] = _pseudonym(optin['user_ref'], salt)
+
+
+class TrafficRecorder:
+    """
+    Appends verified webhook bodies to the file at ``path``, one line
+    per body: ``{"t": <seconds since the first body>, "body": ...}``.
+
+    Lines are buffered and written every ``flush_interval`` seconds
+    in a background thread, so recording adds little to the request
+    path.
+
+    Arguments:
+        path (str):
+            The file to append to.
+        scrub (bool):
+            Whether to pass bodies through :func:`scrub_structure`.
+        salt (str or None):
+            Mixed into the pseudonyms, so they can't be reversed by
+            hashing known IDs. If ``None``, a random salt is used,
+            so pseudonyms are only stable within one recorder; give
+            the same secret salt to keep them stable across
+            recordings.
+        flush_interval (float):
+            Seconds between writes.
+    """
+    def __init__(self, path, *, scrub=True, salt=None, flush_interval=1.0):
+        if salt is None:
+            salt = os.urandom(16).hex()
+        elif scrub and not salt:
+            raise ValueError('salt must not be empty')
+        self._path = path
+        self._scrub = scrub
+        self._salt = salt
+        self._flush_interval = flush_interval
+        self._loop = None
+        self._started = None
+        self._lines = []
+        self._file = None
+        self._executor = None
+        self._flusher = None
+        self.recorded = 0
+
+    def start(self, *, loop):
+        self._loop = loop
+        self._file = open(self._path, 'ab')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._flusher = loop.create_task(self._flush_periodically())
+
+    def record(self, content):
+        """
+        Record the raw webhook body ``content``. Bodies that aren't
+        valid JSON are skipped.
+        """
+        try:
+            structure = jsoncodec.loads(content)
+        except ValueError:
+            logger.warning('Not recording undecodable webhook body')
+            return
+        if self._scrub:
+            structure = scrub_structure(structure, self._salt)
+        if self._started is None:
+            self._started = self._loop.time()
+        line = jsoncodec.dumps({
+            't': round(self._loop.time() - self._started, 6),
+            'body': structure,
+        })
+        self._lines.append(line + b'\n')
+        self.recorded += 1
+
+    async def flush(self):
+        lines, self._lines = self._lines, []
+        if lines:
+            await self._loop.run_in_executor(
+                self._executor, self._write_sync, lines)
+
+    async def close(self):
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        await self.flush()
+        await self._loop.run_in_executor(self._executor, self._file.close)
+        self._executor.shutdown(wait=False)
+
+    def _write_sync(self, lines):
+        self._file.writelines(lines)
+        self._file.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to write recorded traffic')
+
+
+def read_recording(path):
+    """
+    Yield ``(offset, structure)`` for each body recorded in the file
+    at ``path``.
+    """
+    with open(path, 'rb') as lines:
+        for line in lines:
+            if line.strip():
+                record = jsoncodec.loads(line)
+                yield record['t'], record['body']
+
+
+@attr.s
+class ReplayStats:
+    bodies = attr.ib(default=0)
+    #: Bodies whose handling raised
+    errors = attr.ib(default=0)
+    elapsed = attr.ib(default=0.0)
+    #: The most seconds a body was handed over after it was due
+    max_lag = attr.ib(default=0.0)
+
+
+class TrafficReplayer:
+    """
+    Feeds recorded webhook bodies to a
+    :class:`fbemissary.webhook.WebhookWrangler` (or anything with a
+    ``handle_webhook_structure`` coroutine method).
+
+    Each body is handled in its own task, as it would be by the
+    webhook receiver, at most ``concurrency`` at a time.
+
+    Arguments:
+        webhook_structure_handler:
+            Where the bodies are replayed to.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        speed (float or None):
+            How many times faster than recorded to replay, or ``None``
+            to replay as fast as possible.
+        concurrency (int):
+            The most bodies being handled at once.
+    """
+    def __init__(self, webhook_structure_handler, *, loop, speed=1.0,
+                 concurrency=100):
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive')
+        self._handler = webhook_structure_handler
+        self._loop = loop
+        self._speed = speed
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def run(self, path):
+        """
+        Replay every body recorded in the file at ``path`` and return
+        a :class:`ReplayStats` once all of them have been handled.
+        """
+        stats = ReplayStats()
+        started = self._loop.time()
+        handling = set()
+        try:
+            for offset, structure in read_recording(path):
+                if self._speed is not None:
+                    due = started + offset / self._speed
+                    delay = due - self._loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    stats.max_lag = max(
+                        stats.max_lag, self._loop.time() - due)
+                await self._slots.acquire()
+                task = self._loop.create_task(
+                    self._handle(structure, stats))
+                handling.add(task)
+                task.add_done_callback(handling.discard)
+                stats.bodies += 1
+            if handling:
+                await asyncio.wait(list(handling))
+        finally:
+            for task in handling:
+                task.cancel()
+        stats.elapsed = self._loop.time() - started
+        logger.info(
+            'Replayed %d bodies (%d errors) in %.2fs, max lag %.3fs',
+            stats.bodies, stats.errors, stats.elapsed, stats.max_lag)
+        return stats
+
+    async def _handle(self, structure, stats):
+        try:
+            await self._handler.handle_webhook_structure(structure)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.errors += 1
+            logger.exception('Error handling replayed webhook body')
+        finally:
+            self._slots.release()
+
+
+class StubPageMessagingAPIClient(client.PageMessagingAPIClient):
+    """
+    A :class:`fbemissary.client.PageMessagingAPIClient` that encodes
+    requests as usual but answers them itself after ``latency``
+    seconds instead of sending them to Facebook. Batching, rate
+    limiting and retries work as with the real client.
+
+    Subclass to set a different ``latency``.
+    """
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+
+    async def _post_message(self, payload):
+        return (await self._post_messages([payload]))[0]
+
+    async def _post_messages(self, payloads):
+        for payload in payloads:
+            self._json_dumps(payload)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        results = []
+        for payload in payloads:
+            self.sent += 1
+            results.append({
+                'recipient_id': payload['recipient']['id'],
+                'message_id': 'stub-{0}'.format(self.sent),
+            })
+        return results
+
+    async def upload_attachment(self, attachment_type, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 'stub-attachment-{0}'.format(attachment_type)
+
+    async def fetch_user_profiles(self, user_ids, fields):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {user_id: {'id': user_id} for user_id in user_ids}
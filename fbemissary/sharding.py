@@ -0,0 +1,437 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Multi-process webhook ingestion with sender-affine sharding
+
+A front process receives and verifies webhook requests, then forwards
+every messaging event to one of several worker processes over a Unix
+socket. The worker is chosen by hashing the page ID and the
+conversation counterpart's ID, so each conversation is always handled
+by the same process and keeps its serial ordering.
+
+The front process runs a :class:`ShardFrontend`. Each worker process
+runs a :class:`fbemissary.FacebookPageMessengerBot`, configured as
+usual, started with
+:meth:`~fbemissary.FacebookPageMessengerBot.start_shard_worker`
+instead of ``start``. :func:`spawn_shard_workers` starts the worker
+processes.
+"""
+import os
+import zlib
+import signal
+import struct
+import asyncio
+import logging
+import multiprocessing
+
+from fbemissary import webhook
+from fbemissary import jsoncodec
+
+
+logger = logging.getLogger(__name__)
+
+_FRAME_HEADER = struct.Struct('!I')
+
+
+def shard_for(page_id, counterpart_id, shard_count):
+    """
+    Return the index of the shard that handles the conversation
+    between ``page_id`` and ``counterpart_id``.
+
+    Uses CRC32 rather than :func:`hash` so every process agrees on the
+    result regardless of hash randomization.
+    """
+    key = '{0}:{1}'.format(page_id, counterpart_id).encode('utf-8')
+    return zlib.crc32(key) % shard_count
+
+
+def shard_socket_paths(directory, shard_count):
+    """
+    Return a list of ``shard_count`` Unix socket paths in ``directory``.
+    """
+    return [
+        os.path.join(directory, 'fbemissary-shard-{0}.sock'.format(n))
+        for n in range(shard_count)
+    ]
+
+
+def _event_counterpart_id(event_structure):
+    message = event_structure.get('message')
+    if message is not None and message.get('is_echo'):
+        return event_structure['recipient']['id']
+    sender = event_structure.get('sender')
+    if sender is None:
+        return event_structure.get('recipient', {}).get('id')
+    return sender['id']
+
+
+def split_webhook_structure(structure, shard_count):
+    """
+    Split a webhook structure into one per shard, returning a dict of
+    shard index to structure. Shards without events are left out.
+
+    Messaging events keep their relative order within each shard.
+    Anything that isn't a page messaging entry goes to shard 0.
+    """
+    if structure.get('object') != 'page' or 'entry' not in structure:
+        return {0: structure}
+    shard_entries = {}
+    for entry in structure['entry']:
+        if 'messaging' not in entry:
+            shard_entries.setdefault(0, []).append(entry)
+            continue
+        page_id = entry['id']
+        per_shard_events = {}
+        for event_structure in entry['messaging']:
+            try:
+                counterpart_id = _event_counterpart_id(event_structure)
+            except (KeyError, TypeError):
+                counterpart_id = None
+            shard = shard_for(page_id, counterpart_id, shard_count)
+            per_shard_events.setdefault(shard, []).append(event_structure)
+        for shard, events in per_shard_events.items():
+            shard_entry = dict(entry, messaging=events)
+            shard_entries.setdefault(shard, []).append(shard_entry)
+    return {
+        shard: dict(structure, entry=entries)
+        for shard, entries in shard_entries.items()
+    }
+
+
+def encode_frame(structure):
+    body = jsoncodec.dumps(structure)
+    return _FRAME_HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Read one frame from the :class:`asyncio.StreamReader` and return
+    the decoded structure, or ``None`` at end of stream.
+    """
+    try:
+        header = await reader.readexactly(_FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = _FRAME_HEADER.unpack(header)
+    body = await reader.readexactly(length)
+    return jsoncodec.loads(body)
+
+
+class ShardUnavailable(webhook.HandlerUnavailable):
+    """
+    A shard worker that a webhook structure has events for is not
+    connected.
+    """
+
+
+class ShardRouter:
+    """
+    Webhook structure handler that forwards events to the shard worker
+    processes listening on ``socket_paths``, one per shard.
+
+    When the connection to a worker is lost, for example because it
+    died or is restarting, the router reconnects in the background,
+    waiting ``reconnect_delay`` seconds after the first failed attempt
+    and twice as long after each following one, up to
+    ``max_reconnect_delay``. Until then structures with events for the
+    worker are refused with :class:`ShardUnavailable`, and
+    :attr:`available` is false.
+    """
+    def __init__(self, socket_paths, *, loop, reconnect_delay=0.1,
+                 max_reconnect_delay=5.0):
+        self._socket_paths = list(socket_paths)
+        self._loop = loop
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        # The writer of each shard's connection, None while it's down
+        self._writers = [None] * len(self._socket_paths)
+        # Map of shard -> connection watcher or reconnect task
+        self._tasks = {}
+
+    @property
+    def shard_count(self):
+        return len(self._socket_paths)
+
+    @property
+    def available(self):
+        """
+        Whether every shard worker is connected.
+        """
+        return all(writer is not None for writer in self._writers)
+
+    async def connect(self, timeout=30):
+        """
+        Connect to every worker, waiting up to ``timeout`` seconds for
+        their sockets to appear.
+        """
+        deadline = self._loop.time() + timeout
+        for shard, path in enumerate(self._socket_paths):
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if self._loop.time() > deadline:
+                        raise
+                    await asyncio.sleep(0.1)
+                else:
+                    self._connected(shard, reader, writer)
+                    break
+
+    async def handle_webhook_structure(self, structure):
+        parts = split_webhook_structure(structure, self.shard_count)
+        # Refuse the whole structure rather than deliver part of it
+        for shard in parts:
+            writer = self._writers[shard]
+            if writer is None or writer.transport.is_closing():
+                raise ShardUnavailable(
+                    'Shard {0} is not connected'.format(shard))
+        writers = {}
+        for shard, part in parts.items():
+            writer = writers[shard] = self._writers[shard]
+            # A frame is written in one call so frames from concurrent
+            # webhooks never interleave.
+            writer.write(encode_frame(part))
+        for shard, writer in writers.items():
+            try:
+                await writer.drain()
+            except ConnectionError as exc:
+                self._connection_lost(shard, writer)
+                raise ShardUnavailable(
+                    'Lost connection to shard {0}'.format(shard)) from exc
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        self._tasks = {}
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+        self._writers = [None] * len(self._socket_paths)
+
+    def _connected(self, shard, reader, writer):
+        self._writers[shard] = writer
+        self._tasks[shard] = self._loop.create_task(
+            self._watch(shard, reader, writer))
+
+    def _connection_lost(self, shard, writer):
+        if self._writers[shard] is not writer:
+            # Already handled
+            return
+        self._writers[shard] = None
+        writer.close()
+        logger.warning('Lost connection to shard %d, reconnecting', shard)
+        self._tasks[shard] = self._loop.create_task(self._reconnect(shard))
+
+    async def _watch(self, shard, reader, writer):
+        # Workers never send anything, so this returns when the
+        # connection is closed.
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        self._connection_lost(shard, writer)
+
+    async def _reconnect(self, shard):
+        path = self._socket_paths[shard]
+        delay = self._reconnect_delay
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except OSError as exc:
+                logger.debug(
+                    'Failed to reconnect to shard %d (%s), retrying '
+                    'in %.2fs', shard, exc, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self._max_reconnect_delay)
+            else:
+                logger.info('Reconnected to shard %d', shard)
+                self._connected(shard, reader, writer)
+                return
+
+
+class ShardWorkerServer:
+    """
+    Listens on a Unix socket for frames from a :class:`ShardRouter` and
+    passes each structure to the ``webhook_structure_handler`` in the
+    order received.
+
+    To stop without losing frames already sent, call
+    :meth:`stop_accepting`, await :meth:`join`, then :meth:`close`.
+    """
+    def __init__(self, socket_path, webhook_structure_handler, *, loop):
+        self._socket_path = socket_path
+        self._handler = webhook_structure_handler
+        self._loop = loop
+        self._server = None
+        # Map of connection task -> writer
+        self._connections = {}
+
+    async def start(self):
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._server = await asyncio.start_unix_server(
+            self._accept_connection, self._socket_path)
+
+    def stop_accepting(self):
+        """
+        Stop accepting connections, and tell the connected routers
+        to stop sending by closing the write side of each connection.
+        They close the connection once they have seen that, and the
+        frames they sent before are still handled.
+        """
+        if self._server is None:
+            return
+        self._server.close()
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        for writer in self._connections.values():
+            if writer.can_write_eof():
+                writer.write_eof()
+
+    async def join(self):
+        """
+        Wait until every connection has been closed by its router and
+        the frames read from it have been handled.
+        """
+        if self._connections:
+            await asyncio.wait(list(self._connections))
+
+    async def close(self):
+        """
+        Stop accepting connections and cancel the handling of those
+        still open, even in the middle of a frame.
+        """
+        if self._server is None:
+            return
+        self.stop_accepting()
+        for task in self._connections:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(list(self._connections))
+        await self._server.wait_closed()
+        self._server = None
+
+    def _accept_connection(self, reader, writer):
+        task = self._loop.create_task(self._serve(reader, writer))
+        self._connections[task] = writer
+        task.add_done_callback(self._connection_done)
+
+    def _connection_done(self, task):
+        del self._connections[task]
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                structure = await read_frame(reader)
+                if structure is None:
+                    break
+                try:
+                    await self._handler.handle_webhook_structure(structure)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception(
+                        'Error handling webhook structure from shard router')
+        finally:
+            writer.close()
+
+
+class ShardFrontend:
+    """
+    The front process of a sharded deployment: verifies webhook
+    requests and routes their events to the shard workers.
+
+    Arguments:
+        app_secret (str):
+            The Facebook "app secret".
+        verify_token (str):
+            The webhook subscription verify token.
+        socket_paths (list of str):
+            The Unix socket path of each shard worker, in shard
+            order. Every front process must use the same order.
+        ingest_queue_size (int or None):
+            As for :class:`fbemissary.FacebookPageMessengerBot`.
+        ingest_workers (int):
+            As for :class:`fbemissary.FacebookPageMessengerBot`.
+            Kept at 1 by default, since several ingest workers may
+            reorder consecutive webhooks for the same conversation.
+
+    While a shard worker is disconnected, webhook requests are
+    answered with a 503 so Facebook redelivers them later. Bodies
+    already on the ingest queue with events for that worker are
+    dropped and logged.
+    """
+    def __init__(self, app_secret, verify_token, socket_paths, *,
+                 ingest_queue_size=None, ingest_workers=1):
+        self._app_secret = app_secret
+        self._verify_token = verify_token
+        self._socket_paths = socket_paths
+        self._ingest_queue_size = ingest_queue_size
+        self._ingest_workers = ingest_workers
+        self._router = None
+        self._ingest_queue = None
+
+    async def start(self, webapp_mountpoint, webapp_router, *, loop):
+        self._router = ShardRouter(self._socket_paths, loop=loop)
+        await self._router.connect()
+        if self._ingest_queue_size is not None:
+            self._ingest_queue = webhook.WebhookIngestQueue(
+                self._router,
+                maxsize=self._ingest_queue_size,
+                workers=self._ingest_workers,
+                loop=loop,
+            )
+            self._ingest_queue.start()
+        receiver = webhook.WebhookReceiver(
+            self._app_secret,
+            self._verify_token,
+            self._router,
+            loop=loop,
+            ingest_queue=self._ingest_queue,
+        )
+        receiver.setup_routes(webapp_mountpoint, webapp_router)
+
+    async def stop(self):
+        if self._ingest_queue is not None:
+            await self._ingest_queue.join()
+            await self._ingest_queue.close()
+        await self._router.close()
+
+
+def spawn_shard_workers(bot_factory, socket_paths):
+    """
+    Start one worker process per socket path and return the list of
+    :class:`multiprocessing.Process` objects.
+
+    ``bot_factory`` is called without arguments in each worker process
+    and must return a configured, not yet started
+    :class:`fbemissary.FacebookPageMessengerBot`. It must be picklable,
+    for example a module level function. Workers stop the bot and exit
+    on SIGTERM.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for path in socket_paths:
+        process = context.Process(
+            target=_shard_worker_main, args=(bot_factory, path),
+            name='fbemissary-shard-{0}'.format(len(processes)))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def _shard_worker_main(bot_factory, socket_path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = bot_factory()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_until_complete(bot.start_shard_worker(socket_path, loop=loop))
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(bot.stop())
+        loop.close()
@@ -0,0 +1,259 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Persistent conversation state
+
+Each conversation gets a :class:`ConversationState`, a JSON-compatible
+dict that is loaded from a :class:`StateStore` when the conversation
+handles its first event, and written back in batches some time after
+being marked dirty.
+"""
+import json
+import asyncio
+import logging
+import sqlite3
+import concurrent.futures
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Interface for conversation state storage backends.
+
+    Keys are ``(page_id, counterpart_id)`` tuples and values are
+    JSON-compatible dicts.
+    """
+    async def load(self, key):
+        """
+        Return the stored state for ``key``, or ``None`` if there is
+        none.
+        """
+        raise NotImplementedError
+
+    async def save_many(self, items):
+        """
+        Store every ``(key, data)`` pair in the list ``items``.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """
+    Keeps state in memory, serialized so stored values don't change
+    with the live dicts. Useful for tests, and for keeping state across
+    conversation evictions within a single process.
+    """
+    def __init__(self):
+        self._states = {}
+
+    async def load(self, key):
+        serialized = self._states.get(key)
+        if serialized is None:
+            return None
+        return json.loads(serialized)
+
+    async def save_many(self, items):
+        for key, data in items:
+            self._states[key] = json.dumps(data)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Keeps state in an SQLite database at ``path``.
+
+    All database access happens on a dedicated thread, so the event
+    loop never blocks on disk I/O.
+    """
+    def __init__(self, path, *, loop):
+        self._path = path
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._connection = None
+
+    async def load(self, key):
+        serialized = await self._run(self._load_sync, key)
+        if serialized is None:
+            return None
+        return json.loads(serialized)
+
+    async def save_many(self, items):
+        # Serialize here, as the dicts may change while the write runs.
+        rows = [
+            (page_id, counterpart_id, json.dumps(data))
+            for (page_id, counterpart_id), data in items
+        ]
+        await self._run(self._save_many_sync, rows)
+
+    async def close(self):
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    def _connect_sync(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS conversation_state ('
+                ' page_id TEXT NOT NULL,'
+                ' counterpart_id TEXT NOT NULL,'
+                ' data TEXT NOT NULL,'
+                ' PRIMARY KEY (page_id, counterpart_id))'
+            )
+        return self._connection
+
+    def _load_sync(self, key):
+        connection = self._connect_sync()
+        row = connection.execute(
+            'SELECT data FROM conversation_state '
+            'WHERE page_id = ? AND counterpart_id = ?',
+            key,
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _save_many_sync(self, rows):
+        connection = self._connect_sync()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO conversation_state '
+                '(page_id, counterpart_id, data) VALUES (?, ?, ?)',
+                rows,
+            )
+
+    def _close_sync(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class ConversationState:
+    """
+    The state of a single conversation, given to conversationalists
+    as their ``state`` attribute.
+
+    The state must be loaded with :meth:`load` before :attr:`data` is
+    used; :class:`fbemissary.SerialConversationalist` does this before
+    handling the first event. After changing :attr:`data`, call
+    :meth:`mark_dirty` to have it saved.
+    """
+    __slots__ = ('_manager', '_key', '_data')
+
+    def __init__(self, manager, key):
+        self._manager = manager
+        self._key = key
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        """
+        The state dict, empty for a conversation without stored state.
+        """
+        if self._data is None:
+            raise RuntimeError('Conversation state has not been loaded')
+        return self._data
+
+    async def load(self):
+        if self._data is None:
+            self._data = await self._manager.load(self._key)
+        return self._data
+
+    def mark_dirty(self):
+        """
+        Schedule the state to be written on the next flush.
+        """
+        self._manager.mark_dirty(self._key, self.data)
+
+
+class StateManager:
+    """
+    Loads conversation state from a :class:`StateStore` on demand and
+    writes changed state back every ``flush_interval`` seconds, in a
+    single batch.
+    """
+    def __init__(self, store, *, flush_interval=1.0, loop):
+        self._store = store
+        self._flush_interval = flush_interval
+        self._loop = loop
+        self._dirty = {}
+        self._flushing = {}
+        self._loading = {}
+        self._flusher = None
+        self._stopping = asyncio.Event()
+
+    def start(self):
+        self._flusher = self._loop.create_task(self._flush_periodically())
+
+    def state_for(self, page_id, counterpart_id):
+        return ConversationState(self, (page_id, counterpart_id))
+
+    async def load(self, key):
+        # State not yet written belongs to a conversation that was
+        # evicted and has come back; it's newer than the store's.
+        for pending in (self._dirty, self._flushing):
+            if key in pending:
+                return pending[key]
+        future = self._loading.get(key)
+        if future is None:
+            future = self._loop.create_task(self._load_from_store(key))
+            self._loading[key] = future
+        return await asyncio.shield(future)
+
+    def mark_dirty(self, key, data):
+        self._dirty[key] = data
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            await self._store.save_many(list(self._flushing.items()))
+        except Exception:
+            logger.exception(
+                'Failed to save %d conversation states, will retry',
+                len(self._flushing))
+            for key, data in self._flushing.items():
+                self._dirty.setdefault(key, data)
+        finally:
+            self._flushing = {}
+
+    async def close(self):
+        """
+        Stop flushing periodically, letting a flush in progress finish,
+        then write the state still dirty and close the store.
+        """
+        if self._flusher is not None:
+            self._stopping.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+        await self._store.close()
+
+    async def _load_from_store(self, key):
+        try:
+            data = await self._store.load(key)
+        finally:
+            del self._loading[key]
+        # The conversation may have been marked dirty meanwhile by
+        # another handle for the same key.
+        if key in self._dirty:
+            return self._dirty[key]
+        return {} if data is None else data
+
+    async def _flush_periodically(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
@@ -0,0 +1,174 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import os
+import asyncio
+import hashlib
+
+import attr
+import pytest
+
+from fbemissary import models
+from fbemissary import attachments
+from fbemissary.tests.test_conversation import (
+    make_demuxer, make_message, conversationalist_for)
+
+
+class FakeContent:
+    def __init__(self, body):
+        self._body = body
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self._body), size):
+            await asyncio.sleep(0)
+            yield self._body[start:start + size]
+
+
+class FakeMediaResponse:
+    def __init__(self, body, status=200):
+        self.status = status
+        self.content_length = len(body)
+        self.content_type = 'application/octet-stream'
+        self.content = FakeContent(body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeMediaSession:
+    """
+    Stand-in for :class:`aiohttp.ClientSession` serving media bodies by
+    URL and counting the requests.
+    """
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.requests = []
+
+    def get(self, url):
+        self.requests.append(url)
+        if url not in self.bodies:
+            return FakeMediaResponse(b'', status=404)
+        return FakeMediaResponse(self.bodies[url])
+
+
+def media(url, type=models.AttachmentType.image):
+    return models.MediaAttachment(type, url)
+
+
+def test_concurrent_fetches_download_once(loop):
+    session = FakeMediaSession({'http://x/a': b'a' * 100000})
+    service = attachments.AttachmentService(session, loop=loop)
+
+    async def scenario():
+        return await asyncio.gather(
+            service.fetch(media('http://x/a')),
+            service.fetch(media('http://x/a')))
+
+    first, second = loop.run_until_complete(scenario())
+    assert first.data == second.data == b'a' * 100000
+    assert first.digest == hashlib.sha256(first.data).hexdigest()
+    assert session.requests == ['http://x/a']
+    loop.run_until_complete(service.fetch(media('http://x/a')))
+    assert session.requests == ['http://x/a']
+    loop.run_until_complete(service.close())
+
+
+def test_memory_cache_shares_content_and_evicts_lru():
+    cache = attachments.MemoryAttachmentCache(max_bytes=10)
+
+    def downloaded(url, data):
+        return attachments.DownloadedAttachment(
+            url, hashlib.sha256(data).hexdigest(), len(data), None, data)
+
+    cache.put(downloaded('a', b'12345'))
+    cache.put(downloaded('a2', b'12345'))
+    assert cache.size == 5
+    assert cache.get('a2').url == 'a2'
+    cache.put(downloaded('b', b'67890'))
+    cache.get('a')
+    cache.put(downloaded('c', b'abcde'))
+    assert cache.get('b') is None
+    assert cache.get('a').data == b'12345'
+    assert cache.size == 10
+
+
+def test_size_limit_and_errors(loop):
+    session = FakeMediaSession({'http://x/big': b'b' * 2000})
+    service = attachments.AttachmentService(
+        session, loop=loop, max_size=1000)
+    with pytest.raises(attachments.AttachmentTooLarge):
+        loop.run_until_complete(service.fetch(media('http://x/big')))
+    with pytest.raises(attachments.AttachmentError):
+        loop.run_until_complete(service.fetch(media('http://x/missing')))
+    loop.run_until_complete(service.close())
+
+
+def test_streams_video_to_disk_cache(loop, tmpdir):
+    body = os.urandom(300000)
+    session = FakeMediaSession({'http://x/v': body})
+    disk_cache = attachments.DiskAttachmentCache(
+        str(tmpdir), max_bytes=400000)
+    service = attachments.AttachmentService(
+        session, loop=loop, disk_cache=disk_cache)
+    downloaded = loop.run_until_complete(
+        service.fetch(media('http://x/v', models.AttachmentType.video)))
+    assert downloaded.data is None
+    with open(downloaded.path, 'rb') as f:
+        assert f.read() == body
+    assert os.listdir(str(tmpdir)) == [os.path.basename(downloaded.path)]
+    loop.run_until_complete(service.close())
+
+
+def test_disk_cache_keeps_shared_file_for_duplicate_content(loop, tmpdir):
+    body = os.urandom(1000)
+    session = FakeMediaSession({'http://x/v1': body, 'http://x/v2': body})
+    service = attachments.AttachmentService(
+        session, loop=loop,
+        disk_cache=attachments.DiskAttachmentCache(str(tmpdir)))
+
+    async def scenario():
+        first = await service.fetch(
+            media('http://x/v1', models.AttachmentType.video))
+        second = await service.fetch(
+            media('http://x/v2', models.AttachmentType.video))
+        return first, second
+
+    first, second = loop.run_until_complete(scenario())
+    assert second.url == 'http://x/v2'
+    assert second.path == first.path
+    with open(second.path, 'rb') as f:
+        assert f.read() == body
+    loop.run_until_complete(service.close())
+
+
+def test_disk_cache_only_removes_its_own_files(tmpdir):
+    tmpdir.join('att-stale').write('old')
+    tmpdir.join('.download-abc').write('partial')
+    tmpdir.join('notes.txt').write('keep')
+    tmpdir.mkdir('subdir')
+    attachments.DiskAttachmentCache(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == ['notes.txt', 'subdir']
+
+
+def test_demuxer_prefetches_and_attaches_service(loop):
+    session = FakeMediaSession({'http://x/a': b'image'})
+    demuxer = make_demuxer(
+        loop, attachment_config=attachments.AttachmentConfig())
+    demuxer._attachments._session = session
+    message = attr.evolve(
+        make_message('A', None), attachments=[media('http://x/a')])
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [message])
+        # Prefetch started during dispatch, before any handler ran
+        assert session.requests == ['http://x/a']
+        a = conversationalist_for(demuxer, 'A')
+        downloaded = await a.attachments.fetch(a.received[0].attachments[0])
+        assert downloaded.data == b'image'
+
+    loop.run_until_complete(scenario())
+    assert session.requests == ['http://x/a']
+    loop.run_until_complete(demuxer.close())
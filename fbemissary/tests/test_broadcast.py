@@ -0,0 +1,126 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+import pytest
+
+from fbemissary import broadcast
+from fbemissary import client
+from fbemissary.tests.test_client import FakeGraphSession
+
+
+class Interrupted(Exception):
+    pass
+
+
+def make_client(session):
+    return client.PageMessagingAPIClient(session, 'TOKEN', retry_policy=None)
+
+
+def test_broadcast_sends_to_every_recipient(loop, tmp_path):
+    path = tmp_path / 'recipients.txt'
+    path.write_text('\n'.join(str(n) for n in range(30)) + '\n\n')
+    session = FakeGraphSession()
+    results = []
+    broadcaster = broadcast.Broadcaster(
+        make_client(session),
+        lambda recipient_id: {'text': 'hi ' + recipient_id},
+        loop=loop, concurrency=4, result_sink=results.append)
+    stats = loop.run_until_complete(
+        broadcaster.run(broadcast.recipients_from_file(str(path))))
+    assert stats.sent == 30
+    assert stats.failed == 0
+    assert sorted(r.index for r in results) == list(range(30))
+    assert all(r.ok for r in results)
+    payloads = [payload for _, payload, _ in session.requests]
+    assert {p['message']['text'] for p in payloads} == {
+        'hi {0}'.format(n) for n in range(30)}
+
+
+def test_broadcast_resumes_from_checkpoint(loop, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    recipients = [str(n) for n in range(40)]
+    session = FakeGraphSession()
+
+    results = []
+
+    def interrupting_sink(result):
+        results.append(result)
+        if len(results) == 15:
+            raise Interrupted()
+
+    broadcaster = broadcast.Broadcaster(
+        make_client(session), {'text': 'hi'}, loop=loop, concurrency=3,
+        checkpoint_path=checkpoint, checkpoint_interval=0,
+        result_sink=interrupting_sink)
+    with pytest.raises(Interrupted):
+        loop.run_until_complete(broadcaster.run(iter(recipients)))
+    session.requests = []
+
+    broadcaster = broadcast.Broadcaster(
+        make_client(session), {'text': 'hi'}, loop=loop, concurrency=3,
+        checkpoint_path=checkpoint)
+    stats = loop.run_until_complete(broadcaster.run(iter(recipients)))
+    # Everything before the interrupted recipient was checkpointed
+    assert stats.skipped == 14
+    assert stats.sent == 26
+    sent_to = [
+        payload['recipient']['id'] for _, payload, _ in session.requests]
+    assert sorted(sent_to, key=int) == recipients[14:]
+
+
+def test_broadcasts_from_one_page_share_a_rate_limit(loop):
+    page_client = make_client(FakeGraphSession())
+    first = broadcast.Broadcaster(
+        page_client, lambda recipient_id: {'text': 'hi'},
+        loop=loop, rate=10, burst=2)
+    second = broadcast.Broadcaster(
+        page_client, lambda recipient_id: {'text': 'hi'},
+        loop=loop, rate=20, burst=5)
+    assert first._bucket is second._bucket
+    other_page = broadcast.Broadcaster(
+        make_client(FakeGraphSession()), lambda recipient_id: {'text': 'hi'},
+        loop=loop, rate=10, burst=2)
+    assert other_page._bucket is not first._bucket
+
+
+class StuckFirstClient:
+    """
+    Sends to every recipient at once, except the first, whose send
+    waits for ``release``.
+    """
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def send_message(self, recipient_id, message_payload):
+        if recipient_id == '0':
+            await self.release.wait()
+        return {'recipient_id': recipient_id, 'message_id': 'm'}
+
+
+def test_progress_behind_a_stuck_send_stays_small(loop, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    page_client = StuckFirstClient()
+    broadcaster = broadcast.Broadcaster(
+        page_client, {'text': 'hi'}, loop=loop, concurrency=4,
+        checkpoint_path=checkpoint, checkpoint_interval=0)
+
+    async def scenario():
+        run = loop.create_task(broadcaster.run(
+            str(n) for n in range(200)))
+        # The checkpoint is loaded on another thread first
+        for _ in range(1000):
+            if broadcaster._stats and broadcaster._stats.sent == 199:
+                break
+            await asyncio.sleep(0.001)
+        assert broadcaster._watermark == 0
+        assert broadcaster._done_starts == {1: 200}
+        page_client.release.set()
+        return await run
+
+    stats = loop.run_until_complete(scenario())
+    assert stats.sent == 200
+    assert broadcaster._done_starts == {}
+    with open(checkpoint, encoding='utf-8') as f:
+        assert f.read() == '{"completed": 200}'
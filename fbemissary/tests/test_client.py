@@ -0,0 +1,386 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+import json
+import urllib.parse
+
+import pytest
+import attr
+
+from fbemissary import client
+from fbemissary import state
+
+
+class FakeResponse:
+    def __init__(self, structure, status=200):
+        self._structure = structure
+        self.status = status
+
+    async def json(self):
+        return self._structure
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeGraphSession:
+    """
+    Stand-in for :class:`aiohttp.ClientSession` answering Send API and
+    batch requests with a message ID derived from the recipient.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, **kwargs):
+        data = kwargs.get('data')
+        if isinstance(data, bytes):
+            payload = json.loads(data.decode('utf-8'))
+            self.requests.append((url, payload, None))
+            return FakeResponse(self._reply(payload))
+        self.requests.append((url, None, data))
+        batch = json.loads(data['batch'])
+        items = []
+        for request in batch:
+            body = urllib.parse.parse_qs(request['body'])
+            payload = {k: json.loads(v[0]) for k, v in body.items()}
+            items.append(
+                {'code': 200, 'body': json.dumps(self._reply(payload))})
+        return FakeResponse(items)
+
+    def _reply(self, payload):
+        recipient_id = payload['recipient']['id']
+        return {
+            'recipient_id': recipient_id,
+            'message_id': 'm-' + recipient_id,
+        }
+
+
+def test_send_message_without_dispatcher_posts_directly(loop):
+    session = FakeGraphSession()
+    page_client = client.PageMessagingAPIClient(session, 'TOKEN')
+    result = loop.run_until_complete(
+        page_client.send_message('USER', {'text': 'hi'}))
+    assert result == {'recipient_id': 'USER', 'message_id': 'm-USER'}
+    url, payload, _ = session.requests[0]
+    assert url.endswith('/me/messages?access_token=TOKEN')
+    assert payload == {'recipient': {'id': 'USER'}, 'message': {'text': 'hi'}}
+
+
+def test_dispatcher_coalesces_into_batches(loop):
+    session = FakeGraphSession()
+    config = client.SendDispatchConfig(max_batch_size=3, batch_window=0.01)
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', dispatch_config=config, loop=loop)
+
+    async def scenario():
+        results = await asyncio.gather(*[
+            page_client.send_message(str(n), {'text': 'hi'})
+            for n in range(7)
+        ])
+        await page_client.close()
+        return results
+
+    results = loop.run_until_complete(scenario())
+    assert [r['message_id'] for r in results] == [
+        'm-{0}'.format(n) for n in range(7)]
+    batch_sizes = [
+        len(json.loads(data['batch'])) if data is not None else 1
+        for _, _, data in session.requests
+    ]
+    assert batch_sizes == [3, 3, 1]
+
+
+def test_dispatcher_needs_the_loop():
+    with pytest.raises(ValueError):
+        client.PageMessagingAPIClient(
+            FakeGraphSession(), 'TOKEN',
+            dispatch_config=client.SendDispatchConfig())
+
+
+def test_batch_responses_are_decoded_with_the_json_codec(loop):
+    decoded = []
+
+    def json_loads(content):
+        decoded.append(content)
+        return json.loads(content.decode('utf-8'))
+
+    session = FakeGraphSession()
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', json_loads=json_loads, loop=loop,
+        dispatch_config=client.SendDispatchConfig(max_batch_size=2))
+
+    async def scenario():
+        results = await asyncio.gather(*[
+            page_client.send_message(str(n), {'text': 'hi'})
+            for n in range(2)
+        ])
+        await page_client.close()
+        return results
+
+    results = loop.run_until_complete(scenario())
+    assert [r['message_id'] for r in results] == ['m-0', 'm-1']
+    assert len(decoded) == 2
+
+
+def test_token_bucket_paces_after_burst(loop):
+    bucket = client.TokenBucket(100, 2, loop=loop)
+
+    async def scenario():
+        start = loop.time()
+        for _ in range(6):
+            await bucket.acquire()
+        return loop.time() - start
+
+    elapsed = loop.run_until_complete(scenario())
+    # Two tokens come from the burst, the other four take 10ms each.
+    assert 0.03 <= elapsed < 0.2
+
+
+class ScriptedSession:
+    """
+    Stand-in for :class:`aiohttp.ClientSession` answering each request
+    with the next ``(status, structure)`` pair.
+    """
+    def __init__(self, responses):
+        self._responses = list(responses)
+        self.request_count = 0
+
+    def post(self, url, **kwargs):
+        self.request_count += 1
+        status, structure = self._responses.pop(0)
+        return FakeResponse(structure, status=status)
+
+
+FAST_RETRIES = client.RetryPolicy(
+    max_attempts=3, base_delay=0.001, throttled_base_delay=0.001,
+    failure_threshold=2, reset_timeout=60)
+OK = (200, {'recipient_id': 'USER', 'message_id': 'mid'})
+
+
+def test_classify_error():
+    classify = client.classify_error
+    assert classify(200, OK[1]) is None
+    assert classify(500, None) is client.ErrorKind.transient
+    assert classify(429, None) is client.ErrorKind.throttled
+    assert classify(400, {'error': {'code': 613}}) is (
+        client.ErrorKind.throttled)
+    assert classify(400, {'error': {'code': 1200}}) is (
+        client.ErrorKind.transient)
+    assert classify(400, {'error': {'code': 100}}) is (
+        client.ErrorKind.permanent)
+
+
+def test_transient_errors_are_retried(loop):
+    session = ScriptedSession([
+        (500, None),
+        (400, {'error': {'code': 2, 'message': 'Service'}}),
+        OK,
+    ])
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN',
+        retry_policy=attr.evolve(FAST_RETRIES, failure_threshold=10))
+    result = loop.run_until_complete(
+        page_client.send_message('USER', {'text': 'hi'}))
+    assert result == OK[1]
+    assert session.request_count == 3
+
+
+def test_permanent_errors_are_raised_immediately(loop):
+    session = ScriptedSession([
+        (400, {'error': {'code': 100, 'message': 'Invalid parameter'}}),
+    ])
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', retry_policy=FAST_RETRIES)
+    with pytest.raises(client.SendAPIError) as excinfo:
+        loop.run_until_complete(
+            page_client.send_message('USER', {'text': 'hi'}))
+    assert excinfo.value.code == 100
+    assert excinfo.value.kind is client.ErrorKind.permanent
+    assert session.request_count == 1
+
+
+def test_circuit_breaker_opens_and_fails_fast(loop):
+    session = ScriptedSession([(503, None)] * 3 + [OK])
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', retry_policy=FAST_RETRIES)
+    with pytest.raises(client.CircuitOpenError):
+        loop.run_until_complete(
+            page_client.send_message('USER', {'text': 'hi'}))
+    assert session.request_count == 2
+    assert page_client.circuit_breaker.state == client.CircuitBreaker.open
+
+
+def test_failed_batch_counts_once_towards_the_circuit_breaker(loop):
+    session = ScriptedSession([(503, None)])
+    config = client.SendDispatchConfig(max_batch_size=20, batch_window=0.01)
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', dispatch_config=config, loop=loop,
+        retry_policy=attr.evolve(FAST_RETRIES, max_attempts=1))
+
+    async def scenario():
+        results = await asyncio.gather(*[
+            page_client.send_message(str(n), {'text': 'hi'})
+            for n in range(20)
+        ], return_exceptions=True)
+        await page_client.close()
+        return results
+
+    results = loop.run_until_complete(scenario())
+    assert session.request_count == 1
+    assert all(type(r) is client.SendAPIError for r in results)
+    assert page_client.circuit_breaker.state == client.CircuitBreaker.closed
+
+
+def test_circuit_breaker_half_open_trial():
+    now = [0.0]
+    breaker = client.CircuitBreaker(1, 10, clock=lambda: now[0])
+    breaker.before_request()
+    breaker.record_failure()
+    with pytest.raises(client.CircuitOpenError):
+        breaker.before_request()
+    now[0] = 11.0
+    assert breaker.state == client.CircuitBreaker.half_open
+    breaker.before_request()
+    with pytest.raises(client.CircuitOpenError):
+        # Only a single trial request is let through
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == client.CircuitBreaker.closed
+
+
+def test_uploads_are_retried_through_the_circuit_breaker(loop):
+    session = ScriptedSession([
+        (500, None),
+        (200, {'attachment_id': 'ATT'}),
+        (503, None),
+        (503, None),
+    ])
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', retry_policy=FAST_RETRIES)
+    attachment_id = loop.run_until_complete(page_client.upload_attachment(
+        'image', data=b'PNG', filename='a.png', content_type='image/png'))
+    assert attachment_id == 'ATT'
+    assert session.request_count == 2
+    with pytest.raises(client.CircuitOpenError):
+        loop.run_until_complete(page_client.upload_attachment(
+            'image', url='https://example.com/a.png'))
+    assert page_client.circuit_breaker.state == client.CircuitBreaker.open
+
+
+class HangingResponse(FakeResponse):
+    async def __aenter__(self):
+        await asyncio.sleep(60)
+
+
+def test_cancelled_trial_lets_the_next_send_through(loop):
+    session = ScriptedSession([OK])
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', retry_policy=attr.evolve(
+            FAST_RETRIES, failure_threshold=1, reset_timeout=0))
+    page_client.circuit_breaker.record_failure()
+    assert page_client.circuit_breaker.state == (
+        client.CircuitBreaker.half_open)
+    original_post = session.post
+    session.post = lambda url, **kwargs: HangingResponse(None)
+
+    async def scenario():
+        trial = loop.create_task(
+            page_client.send_message('USER', {'text': 'hi'}))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        session.post = original_post
+        return await page_client.send_message('USER', {'text': 'hi'})
+
+    assert loop.run_until_complete(scenario()) == OK[1]
+    assert page_client.circuit_breaker.state == client.CircuitBreaker.closed
+
+
+def test_quick_replies_are_built_once_per_label_set(loop):
+    session = FakeGraphSession()
+    page_client = client.PageMessagingAPIClient(
+        session, 'TOKEN', retry_policy=None)
+    replier = client.ConversationReplierAPIClient(page_client, 'USER')
+    for _ in range(2):
+        loop.run_until_complete(replier.send_text_message_with_quickreplies(
+            'Pick one', ['Yes', 'No']))
+    assert client.quick_replies(('Yes', 'No')) is client.quick_replies(
+        ('Yes', 'No'))
+    _, payload, _ = session.requests[-1]
+    assert payload['message']['quick_replies'] == [
+        {'content_type': 'text', 'title': 'Yes', 'payload': 'Yes'},
+        {'content_type': 'text', 'title': 'No', 'payload': 'No'},
+    ]
+
+
+class FakeProfileClient:
+    """
+    Stand-in for :class:`fbemissary.client.PageMessagingAPIClient`
+    answering profile requests and recording the IDs asked for.
+    """
+    page_id = 'PAGE_ID'
+
+    def __init__(self):
+        self.requests = []
+
+    async def fetch_user_profiles(self, user_ids, fields):
+        self.requests.append(list(user_ids))
+        if 'BAD' in user_ids:
+            raise client.SendAPIError('Bad ID', client.ErrorKind.permanent)
+        return {
+            user_id: {'id': user_id, 'first_name': 'Name ' + user_id}
+            for user_id in user_ids
+        }
+
+
+def test_profile_lookups_are_coalesced_and_batched(loop):
+    page_client = FakeProfileClient()
+    service = client.UserProfileService(loop=loop)
+
+    async def scenario():
+        service.prefetch(page_client, 'A')
+        return await asyncio.gather(
+            service.get_profile(page_client, 'A'),
+            service.get_profile(page_client, 'A'),
+            service.get_profile(page_client, 'B'),
+        )
+
+    a1, a2, b = loop.run_until_complete(scenario())
+    assert a1 is a2
+    assert (a1.first_name, b.first_name) == ('Name A', 'Name B')
+    assert page_client.requests == [['A', 'B']]
+    loop.run_until_complete(service.get_profile(page_client, 'B'))
+    assert len(page_client.requests) == 1
+    loop.run_until_complete(service.close())
+
+
+def test_bad_profile_id_does_not_fail_the_batch(loop):
+    page_client = FakeProfileClient()
+    service = client.UserProfileService(loop=loop)
+
+    async def scenario():
+        return await asyncio.gather(
+            service.get_profile(page_client, 'A'),
+            service.get_profile(page_client, 'BAD'),
+            return_exceptions=True)
+
+    a, bad = loop.run_until_complete(scenario())
+    assert a.first_name == 'Name A'
+    assert isinstance(bad, client.SendAPIError)
+    assert page_client.requests == [['A', 'BAD'], ['A'], ['BAD']]
+
+
+def test_profiles_are_kept_in_the_store(loop):
+    store = state.MemoryStateStore()
+    page_client = FakeProfileClient()
+    service = client.UserProfileService(loop=loop, store=store)
+    loop.run_until_complete(service.get_profile(page_client, 'A'))
+    restarted = client.UserProfileService(loop=loop, store=store)
+    profile = loop.run_until_complete(restarted.get_profile(page_client, 'A'))
+    assert profile.first_name == 'Name A'
+    assert page_client.requests == [['A']]
@@ -0,0 +1,431 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+import pytest
+
+from fbemissary import conversation
+from fbemissary import models
+
+
+class RecordingConversationalist(conversation.SerialConversationalist):
+    closed = False
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.received = []
+
+    async def event_received(self, event):
+        self.received.append(event)
+
+    async def aclose(self):
+        self.closed = True
+        await super().aclose()
+
+
+def make_message(sender_id, text, mid=None):
+    return models.ReceivedMessage(
+        sender_id=sender_id,
+        recipient_id='PAGE_ID',
+        timestamp=1458692752478,
+        id=mid or 'mid.{0}.{1}'.format(sender_id, text),
+        text=text,
+        attachments=[],
+        quick_reply=None,
+    )
+
+
+def make_demuxer(loop, **kwargs):
+    demuxer = conversation.MessagingEventDemuxer(**kwargs)
+    factory = conversation.ConversationalistFactory(
+        RecordingConversationalist)
+    demuxer.add_conversationalist_factory('PAGE_ID', 'TOKEN', factory, ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+    return demuxer
+
+
+def conversationalist_for(demuxer, counterpart_id):
+    convo = demuxer._convos._convos[('PAGE_ID', counterpart_id)]
+    return convo._conversationalist
+
+
+def test_events_are_routed_by_sender(loop):
+    demuxer = make_demuxer(loop)
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'one'),
+            make_message('B', 'two'),
+            make_message('A', 'three'),
+        ])
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    a = conversationalist_for(demuxer, 'A')
+    b = conversationalist_for(demuxer, 'B')
+    assert [e.text for e in a.received] == ['one', 'three']
+    assert [e.text for e in b.received] == ['two']
+    loop.run_until_complete(demuxer.close())
+
+
+def test_unhandled_page_raises(loop):
+    demuxer = make_demuxer(loop)
+    with pytest.raises(conversation.UnhandledPage):
+        loop.run_until_complete(demuxer.add_messaging_events(
+            'OTHER_PAGE', [make_message('A', 'one')]))
+    loop.run_until_complete(demuxer.close())
+
+
+
+def test_pages_can_be_added_removed_and_rotated_at_runtime(loop):
+    demuxer = make_demuxer(loop)
+    factory = conversation.ConversationalistFactory(
+        RecordingConversationalist)
+
+    async def scenario():
+        demuxer.add_conversationalist_factory(
+            'NEW_PAGE', 'OLD_TOKEN', factory, ['P'])
+        await demuxer.add_messaging_events(
+            'NEW_PAGE', [make_message('A', 'hello')])
+        # Preinit conversations are created in the background
+        await asyncio.sleep(0)
+        page = demuxer._pages.get('NEW_PAGE')
+        page_client = page.client
+        # The client is created lazily, once per page
+        assert demuxer._pages.get('PAGE_ID').client is None
+        demuxer.rotate_page_token('NEW_PAGE', 'NEW_TOKEN')
+        assert 'NEW_TOKEN' in page_client._endpoints.messages_url
+        convo = demuxer._convos._convos[('NEW_PAGE', 'A')]
+        await demuxer.remove_page('NEW_PAGE')
+        assert convo._conversationalist.closed
+        assert len(demuxer._convos) == 0
+        with pytest.raises(conversation.UnhandledPage):
+            await demuxer.add_messaging_events(
+                'NEW_PAGE', [make_message('A', 'again')])
+
+    loop.run_until_complete(scenario())
+    loop.run_until_complete(demuxer.close())
+
+
+def test_table_evicts_least_recently_used(loop):
+    demuxer = make_demuxer(loop, max_conversations=2)
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'one'),
+            make_message('B', 'two'),
+        ])
+        first = conversationalist_for(demuxer, 'A')
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'three'),
+            make_message('C', 'four'),
+        ])
+        await asyncio.sleep(0)
+        return first
+
+    first = loop.run_until_complete(scenario())
+    stats = demuxer.conversation_table_stats()
+    assert stats.size == 2
+    assert stats.evictions == 1
+    assert stats.hits == 1
+    assert ('PAGE_ID', 'B') not in demuxer._convos._convos
+    assert not first.closed
+    loop.run_until_complete(demuxer.close())
+    assert first.closed
+
+
+class FakeConversation:
+    def __init__(self, busy):
+        self.busy = busy
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def test_table_skips_busy_conversations_when_evicting(loop):
+    table = conversation.ConversationTable(max_size=2, loop=loop)
+    busy = FakeConversation(busy=True)
+    idle = FakeConversation(busy=False)
+    table.add('busy', busy)
+    table.add('idle', idle)
+    table.add('new', FakeConversation(busy=False))
+    assert table.get('busy') is busy
+    assert table.get('idle') is None
+    # Everything else is busy, so the table grows past max_size
+    table.get('new').busy = True
+    table.add('newer', FakeConversation(busy=False))
+    stats = table.stats()
+    assert stats.size == 3
+    assert stats.evictions == 1
+    assert stats.overshoots == 1
+    # And shrinks back once they have gone quiet
+    busy.busy = False
+    table.add('newest', FakeConversation(busy=False))
+    assert len(table) == 2
+    assert table.get('busy') is None
+    loop.run_until_complete(table.close())
+    assert idle.closed and busy.closed
+
+
+def test_table_evicts_idle_conversations(loop):
+    demuxer = make_demuxer(loop, conversation_idle_timeout=0.02)
+
+    async def scenario():
+        await demuxer.add_messaging_events(
+            'PAGE_ID', [make_message('A', 'one')])
+        convo = conversationalist_for(demuxer, 'A')
+        await asyncio.sleep(0.1)
+        return convo
+
+    convo = loop.run_until_complete(scenario())
+    assert convo.closed
+    assert convo.received[0].text == 'one'
+    stats = demuxer.conversation_table_stats()
+    assert stats.size == 0
+    assert stats.idle_evictions == 1
+    loop.run_until_complete(demuxer.close())
+
+
+class GatedFactory:
+    """
+    Factory whose ``make_conversationalist`` waits on a per-counterpart
+    event, counting calls.
+    """
+    def __init__(self):
+        self.gates = {}
+        self.calls = []
+
+    async def make_conversationalist(
+            self, replier, page_id, counterpart_id, loop):
+        self.calls.append(counterpart_id)
+        gate = self.gates.get(counterpart_id)
+        if gate is not None:
+            await gate.wait()
+        return RecordingConversationalist(
+            replier, page_id, counterpart_id, loop)
+
+
+def test_slow_creation_does_not_block_other_senders(loop):
+    factory = GatedFactory()
+    demuxer = conversation.MessagingEventDemuxer()
+    demuxer.add_conversationalist_factory('PAGE_ID', 'TOKEN', factory, ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+
+    async def scenario():
+        factory.gates['A'] = asyncio.Event()
+        first = loop.create_task(demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'one'),
+            make_message('B', 'two'),
+        ]))
+        await asyncio.sleep(0.01)
+        # B is served while A's creation is still pending
+        b = conversationalist_for(demuxer, 'B')
+        assert [e.text for e in b.received] == ['two']
+        second = loop.create_task(demuxer.add_messaging_events(
+            'PAGE_ID', [make_message('A', 'three')]))
+        await asyncio.sleep(0.01)
+        assert second.done()
+        assert not first.done()
+        factory.gates['A'].set()
+        await first
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    assert factory.calls == ['A', 'B']
+    a = conversationalist_for(demuxer, 'A')
+    assert [e.text for e in a.received] == ['one', 'three']
+    loop.run_until_complete(demuxer.close())
+
+
+class BlockedConversationalist(RecordingConversationalist):
+    """
+    Holds its first event until ``release`` is set, so later events
+    pile up in the queue.
+    """
+    max_queue_length = 2
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.release = asyncio.Event()
+
+    async def event_received(self, event):
+        await self.release.wait()
+        await super().event_received(event)
+
+
+def run_overflow(loop, policy, texts):
+    cls = type('Convo', (BlockedConversationalist,), {
+        'overflow_policy': policy})
+    convo = cls(None, 'PAGE_ID', 'A', loop)
+
+    async def scenario():
+        for text in texts:
+            convo.handle_messaging_event(make_message('A', text))
+            await asyncio.sleep(0)
+        convo.release.set()
+        await asyncio.sleep(0.01)
+
+    loop.run_until_complete(scenario())
+    loop.run_until_complete(convo.aclose())
+    return convo
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (conversation.OverflowPolicy.drop_oldest, ['one', 'three', 'four']),
+    (conversation.OverflowPolicy.drop_newest, ['one', 'two', 'three']),
+    (conversation.OverflowPolicy.coalesce, ['one', 'two', 'three\nfour']),
+])
+def test_queue_overflow_policies(loop, policy, expected):
+    convo = run_overflow(loop, policy, ['one', 'two', 'three', 'four'])
+    assert [e.text for e in convo.received] == expected
+    assert convo.overflowed == 1
+
+
+def test_queue_overflow_reject_raises(loop):
+    cls = type('Convo', (BlockedConversationalist,), {
+        'overflow_policy': conversation.OverflowPolicy.reject})
+    convo = cls(None, 'PAGE_ID', 'A', loop)
+    for text in ['one', 'two']:
+        convo.handle_messaging_event(make_message('A', text))
+    with pytest.raises(conversation.ConversationQueueFull):
+        convo.handle_messaging_event(make_message('A', 'three'))
+    loop.run_until_complete(convo.aclose())
+
+
+class BatchConversationalist(conversation.SerialConversationalist):
+    batch_mode = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.batches = []
+
+    async def events_received(self, events):
+        self.batches.append([e.text for e in events])
+        await asyncio.sleep(0.01)
+
+
+def test_batch_mode_hands_over_pending_events_together(loop):
+    convo = BatchConversationalist(None, 'PAGE_ID', 'A', loop)
+
+    async def scenario():
+        convo.handle_messaging_event(make_message('A', 'one'))
+        await asyncio.sleep(0)
+        for text in ['two', 'three']:
+            convo.handle_messaging_event(make_message('A', text))
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(scenario())
+    loop.run_until_complete(convo.aclose())
+    assert convo.batches == [['one'], ['two', 'three']]
+
+
+class RecordingPooledConversationalist(conversation.PooledConversationalist):
+    __slots__ = ('received',)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.received = []
+
+    async def event_received(self, event):
+        await asyncio.sleep(0)
+        self.received.append(event.text)
+
+
+def test_pooled_conversationalists_handle_events_serially(loop):
+    demuxer = conversation.MessagingEventDemuxer()
+    factory = conversation.PooledConversationalistFactory(
+        RecordingPooledConversationalist, workers=2)
+    demuxer.add_conversationalist_factory('PAGE_ID', 'TOKEN', factory, ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message(sender, str(n))
+            for n in range(5) for sender in 'ABC'
+        ])
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    for sender in 'ABC':
+        convo = conversationalist_for(demuxer, sender)
+        assert convo.received == ['0', '1', '2', '3', '4']
+        assert not convo.busy
+        assert convo._events is None
+    assert len(factory._pool._workers) == 2
+    loop.run_until_complete(demuxer.close())
+    assert factory._pool._workers == []
+
+
+def test_factory_shared_by_pages_outlives_removing_one(loop):
+    demuxer = conversation.MessagingEventDemuxer()
+    factory = conversation.PooledConversationalistFactory(
+        RecordingPooledConversationalist, workers=1)
+    for page_id in ['PAGE_1', 'PAGE_2']:
+        demuxer.add_conversationalist_factory(page_id, 'TOKEN', factory, ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+
+    async def scenario():
+        await demuxer.add_messaging_events(
+            'PAGE_1', [make_message('A', 'one')])
+        await demuxer.remove_page('PAGE_1')
+        await demuxer.add_messaging_events(
+            'PAGE_2', [make_message('A', 'two')])
+        await demuxer.drain_conversations(poll_interval=0.001)
+        return demuxer._convos._convos[('PAGE_2', 'A')]._conversationalist
+
+    convo = loop.run_until_complete(asyncio.wait_for(scenario(), 1))
+    assert convo.received == ['two']
+    loop.run_until_complete(demuxer.close())
+    with pytest.raises(RuntimeError):
+        factory._pool.schedule(convo)
+
+
+class FakeProfileService:
+    def __init__(self):
+        self.prefetched = []
+        self.closes = 0
+
+    def prefetch(self, page_messaging_client, user_id):
+        self.prefetched.append((page_messaging_client.page_id, user_id))
+
+    async def get_profile(self, page_messaging_client, user_id):
+        return 'profile of ' + user_id
+
+    async def close(self):
+        self.closes += 1
+
+
+def test_factory_gives_conversationalists_the_profile_service(loop):
+    service = FakeProfileService()
+    demuxer = conversation.MessagingEventDemuxer()
+    demuxer.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        conversation.ConversationalistFactory(
+            RecordingConversationalist, profile_service=service),
+        ['A'])
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+    assert service.prefetched == [('PAGE_ID', 'A')]
+    a = conversationalist_for(demuxer, 'A')
+    profile = loop.run_until_complete(a.counterpart_profile())
+    assert profile == 'profile of A'
+    loop.run_until_complete(demuxer.close())
+    assert service.closes == 1
+
+
+def test_shared_profile_service_is_closed_once_by_the_demuxer(loop):
+    service = FakeProfileService()
+    demuxer = conversation.MessagingEventDemuxer()
+    for page_id in ['PAGE_1', 'PAGE_2']:
+        demuxer.add_conversationalist_factory(
+            page_id, 'TOKEN',
+            conversation.ConversationalistFactory(
+                RecordingConversationalist, profile_service=service),
+            ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+    loop.run_until_complete(demuxer.remove_page('PAGE_1'))
+    assert service.closes == 0
+    loop.run_until_complete(demuxer.close())
+    assert service.closes == 1
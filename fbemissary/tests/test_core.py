@@ -0,0 +1,91 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+import aiohttp.web
+
+import fbemissary
+from fbemissary import client
+from fbemissary.tests.test_conversation import make_message
+
+
+class SilentConversationalist(fbemissary.SerialConversationalist):
+    pass
+
+
+def make_bot(**kwargs):
+    bot = fbemissary.FacebookPageMessengerBot('secret', 'verify', **kwargs)
+    bot.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        fbemissary.ConversationalistFactory(SilentConversationalist),
+        preinit_conversations=['USER'],
+    )
+    return bot
+
+
+def test_start_and_stop(loop):
+    pool_config = client.ConnectionPoolConfig(limit=7, limit_per_host=3)
+    bot = make_bot(connection_pool_config=pool_config, ingest_queue_size=5)
+    webapp = aiohttp.web.Application()
+
+    async def scenario():
+        await bot.start('/webhook', webapp.router, loop=loop)
+        stats = bot.connection_pool_stats()
+        assert bot.conversation_table_stats().size == 1
+        await bot.stop(timeout=1)
+        return stats
+
+    stats = loop.run_until_complete(scenario())
+    assert stats.limit == 7
+    assert stats.limit_per_host == 3
+    assert stats.acquired == 0
+    assert bot._session.closed
+    assert bot.conversation_table_stats().size == 0
+
+
+class SlowConversationalist(fbemissary.SerialConversationalist):
+    delay = 0.01
+    handled = 0
+
+    async def event_received(self, event):
+        await asyncio.sleep(self.delay)
+        SlowConversationalist.handled += 1
+
+
+def start_slow_bot(loop, delay):
+    SlowConversationalist.delay = delay
+    SlowConversationalist.handled = 0
+    bot = fbemissary.FacebookPageMessengerBot('secret', 'verify')
+    bot.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        fbemissary.ConversationalistFactory(SlowConversationalist))
+    webapp = aiohttp.web.Application()
+
+    async def scenario():
+        await bot.start('/webhook', webapp.router, loop=loop)
+        await bot._message_demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', str(n)) for n in range(3)])
+
+    loop.run_until_complete(scenario())
+    return bot
+
+
+def test_stop_drains_conversation_queues(loop):
+    bot = start_slow_bot(loop, 0.01)
+    report = loop.run_until_complete(bot.stop(timeout=1))
+    assert report.clean
+    assert SlowConversationalist.handled == 3
+    response = loop.run_until_complete(bot._receiver.receive_update(None))
+    assert response.status == 503
+
+
+def test_stop_reports_dropped_work_at_deadline(loop):
+    bot = start_slow_bot(loop, 10)
+    report = loop.run_until_complete(bot.stop(timeout=0.05))
+    assert not report.clean
+    assert report.timed_out == [
+        'conversations to handle their queued events']
+    assert report.dropped_events == 2
+    assert report.interrupted_handlers == 1
+    assert SlowConversationalist.handled == 0
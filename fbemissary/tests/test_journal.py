@@ -0,0 +1,173 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import os
+import json
+import asyncio
+
+import aiohttp.web
+
+import fbemissary
+from fbemissary import journal
+from fbemissary import replay
+from fbemissary import webhook
+from fbemissary import conversation
+
+
+def open_journal(loop, directory, **kwargs):
+    ingest_journal = journal.IngestJournal(str(directory), loop=loop, **kwargs)
+    entries = loop.run_until_complete(ingest_journal.open())
+    return ingest_journal, entries
+
+
+def test_unprocessed_entries_survive_reopen(loop, tmp_path):
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert entries == []
+
+    async def scenario():
+        seqs = await asyncio.gather(*[
+            ingest_journal.append(body) for body in [b'a', b'b', b'c']])
+        ingest_journal.mark_processed(seqs[1])
+        await ingest_journal.close()
+
+    loop.run_until_complete(scenario())
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert [body for _, body in entries] == [b'a', b'c']
+    loop.run_until_complete(ingest_journal.close())
+
+
+def test_processed_segments_are_deleted(loop, tmp_path):
+    ingest_journal, _ = open_journal(loop, tmp_path, segment_size=64)
+
+    async def scenario():
+        for n in range(6):
+            seq = await ingest_journal.append(b'x' * 40)
+            ingest_journal.mark_processed(seq)
+        last = await ingest_journal.append(b'keep')
+        await ingest_journal.close()
+        return last
+
+    last = loop.run_until_complete(scenario())
+    assert len(os.listdir(str(tmp_path))) == 1
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert entries == [(last, b'keep')]
+    loop.run_until_complete(ingest_journal.close())
+
+
+
+def test_markers_for_older_segments_survive_rotation(loop, tmp_path):
+    ingest_journal, _ = open_journal(loop, tmp_path, segment_size=250)
+
+    async def scenario():
+        # a1 and a2 fill one segment, c1 starts the next
+        a1 = await ingest_journal.append(b'a' * 100)
+        a2 = await ingest_journal.append(b'b' * 100)
+        c1 = await ingest_journal.append(b'c' * 100)
+        # Both markers land in c1's segment, which is then drained
+        ingest_journal.mark_processed(a1)
+        ingest_journal.mark_processed(c1)
+        e1 = await ingest_journal.append(b'e' * 100)
+        await ingest_journal.close()
+        return a2, e1
+
+    a2, e1 = loop.run_until_complete(scenario())
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert [seq for seq, _ in entries] == [a2, e1]
+    loop.run_until_complete(ingest_journal.close())
+
+
+def test_torn_record_is_ignored(loop, tmp_path):
+    ingest_journal, _ = open_journal(loop, tmp_path)
+
+    async def scenario():
+        await ingest_journal.append(b'whole')
+        await ingest_journal.append(b'torn')
+        await ingest_journal.close()
+
+    loop.run_until_complete(scenario())
+    [name] = os.listdir(str(tmp_path))
+    path = os.path.join(str(tmp_path), name)
+    with open(path, 'r+b') as segment:
+        segment.truncate(os.path.getsize(path) - 2)
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert [body for _, body in entries] == [b'whole']
+    loop.run_until_complete(ingest_journal.close())
+
+
+class RecordingConversationalist(fbemissary.SerialConversationalist):
+    received = []
+
+    async def event_received(self, event):
+        RecordingConversationalist.received.append(event.text)
+
+
+def make_structure(*texts):
+    return {'object': 'page', 'entry': [{
+        'id': 'PAGE_ID',
+        'time': 1,
+        'messaging': [{
+            'sender': {'id': 'USER'},
+            'recipient': {'id': 'PAGE_ID'},
+            'timestamp': 1,
+            'message': {'mid': 'mid.{0}'.format(n), 'text': text},
+        } for n, text in enumerate(texts)],
+    }]}
+
+
+class BlockingConversationalist(fbemissary.SerialConversationalist):
+    release = None
+
+    async def event_received(self, event):
+        await BlockingConversationalist.release.wait()
+
+
+def test_body_is_processed_once_its_events_are_handled(loop, tmp_path):
+    ingest_journal, _ = open_journal(loop, tmp_path)
+    demuxer = conversation.MessagingEventDemuxer(
+        page_client_class=replay.StubPageMessagingAPIClient)
+    demuxer.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        conversation.ConversationalistFactory(BlockingConversationalist),
+        ())
+    wrangler = webhook.WebhookWrangler(demuxer.add_messaging_events)
+
+    async def scenario():
+        BlockingConversationalist.release = asyncio.Event()
+        await demuxer.start(None, loop=loop)
+        pending = ingest_journal.pending(await ingest_journal.append(b'{}'))
+        await wrangler.handle_webhook_structure(
+            make_structure('one', 'two'), pending=pending)
+        pending.release()
+        await asyncio.sleep(0)
+        # Handed to the conversation, but not handled yet
+        assert ingest_journal.unprocessed == 1
+        BlockingConversationalist.release.set()
+        await demuxer.drain_conversations(poll_interval=0.001)
+        assert ingest_journal.unprocessed == 0
+        await demuxer.close()
+        await ingest_journal.close()
+
+    loop.run_until_complete(scenario())
+
+
+def test_bot_replays_unprocessed_entries_on_start(loop, tmp_path):
+    body = json.dumps(make_structure('hello')).encode('utf-8')
+    ingest_journal, _ = open_journal(loop, tmp_path)
+    loop.run_until_complete(ingest_journal.append(body))
+    loop.run_until_complete(ingest_journal.close())
+
+    RecordingConversationalist.received = []
+    bot = fbemissary.FacebookPageMessengerBot(
+        'secret', 'verify', journal_directory=str(tmp_path))
+    bot.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        fbemissary.ConversationalistFactory(RecordingConversationalist))
+    webapp = aiohttp.web.Application()
+    loop.run_until_complete(bot.start('/webhook', webapp.router, loop=loop))
+    report = loop.run_until_complete(bot.stop(timeout=1))
+    assert report.clean
+    assert RecordingConversationalist.received == ['hello']
+
+    ingest_journal, entries = open_journal(loop, tmp_path)
+    assert entries == []
+    loop.run_until_complete(ingest_journal.close())
@@ -0,0 +1,100 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+from fbemissary import client
+from fbemissary import metrics
+from fbemissary import webhook
+from fbemissary.tests.test_webhook import (
+    APP_SECRET, FakeRequest, RecordingHandler, make_body)
+from fbemissary.tests.test_conversation import make_demuxer, make_message
+from fbemissary.tests.test_client import FakeGraphSession
+
+
+def test_registry_renders_prometheus_text():
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter('things_total', 'Things', ['kind'])
+    histogram = registry.histogram('wait_seconds', 'Waits', buckets=(1, 5))
+    counter.inc(labels=('a"b',))
+    histogram.observe(0.5)
+    histogram.observe(3)
+    text = registry.render()
+    assert '# TYPE things_total counter' in text
+    assert 'things_total{kind="a\\"b"} 1.0' in text
+    assert 'wait_seconds_bucket{le="1.0"} 1' in text
+    assert 'wait_seconds_bucket{le="5.0"} 2' in text
+    assert 'wait_seconds_bucket{le="+Inf"} 2' in text
+    assert 'wait_seconds_count 2' in text
+
+
+class RecordingTracer(metrics.Tracer):
+    def __init__(self):
+        self.ended = []
+
+    def start_span(self, name, attributes):
+        tracer = self
+
+        class Span:
+            def end(self):
+                tracer.ended.append(name)
+        return Span()
+
+
+def test_receiver_counts_and_traces_requests(loop):
+    tracer = RecordingTracer()
+    instr = metrics.Instrumentation(tracer=tracer)
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', RecordingHandler(), loop=loop,
+        instrumentation=instr)
+    loop.run_until_complete(receiver.receive_update(FakeRequest(make_body(0))))
+    loop.run_until_complete(receiver.receive_update(
+        FakeRequest(make_body(1), secret='wrong')))
+    assert instr.webhook_requests.value(('handled',)) == 1
+    assert instr.webhook_requests.value(('forbidden',)) == 1
+    assert instr.signature_seconds.count() == 2
+    assert instr.decode_seconds.count() == 1
+    assert tracer.ended == ['fbemissary.receive_update'] * 2
+
+
+def test_page_client_times_and_traces_sends(loop):
+    tracer = RecordingTracer()
+    instr = metrics.Instrumentation(tracer=tracer)
+    page_client = client.PageMessagingAPIClient(
+        FakeGraphSession(), 'TOKEN', instrumentation=instr,
+        dispatch_config=client.SendDispatchConfig(
+            max_batch_size=2, batch_window=0.01),
+        loop=loop)
+
+    async def scenario():
+        await asyncio.gather(*[
+            page_client.send_message(str(n), {'text': 'hi'})
+            for n in range(3)
+        ])
+        await page_client.close()
+
+    loop.run_until_complete(scenario())
+    assert sorted(tracer.ended) == [
+        'fbemissary.send_batch', 'fbemissary.send_message']
+    assert instr.send_seconds.count(('200',)) == 2
+
+
+def test_demuxer_measures_lookups_creation_and_handlers(loop):
+    instr = metrics.Instrumentation()
+    demuxer = make_demuxer(loop, instrumentation=instr)
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'one'),
+            make_message('A', 'two'),
+        ])
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    assert instr.demux_lookup_seconds.count() == 2
+    assert instr.conversationalist_create_seconds.count() == 1
+    assert instr.conversation_queue_depth.count() == 2
+    assert instr.handler_seconds.count() == 2
+    assert 'fbemissary_conversation_table{measure="size"} 1.0' in (
+        instr.registry.render())
+    loop.run_until_complete(demuxer.close())
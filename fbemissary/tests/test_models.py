@@ -97,6 +97,130 @@ def make_test_params():
             quick_reply=None,
         )
     ))
+    params.append((
+        '''{
+          "sender":{"id":"PAGE_ID"},
+          "recipient":{"id":"USER_ID"},
+          "timestamp":1457764197627,
+          "message":{
+            "is_echo":true,
+            "app_id":1517776481860111,
+            "metadata": "DEVELOPER_DEFINED_METADATA_STRING",
+            "mid":"mid.1457764197618:41d102a3e1ae206a38",
+            "text":"hello, world!"
+          }
+        }''',
+        models.Echo(
+            sender_id='PAGE_ID',
+            recipient_id='USER_ID',
+            timestamp=1457764197627,
+            id='mid.1457764197618:41d102a3e1ae206a38',
+            text='hello, world!',
+            attachments=[],
+            app_id=1517776481860111,
+            metadata='DEVELOPER_DEFINED_METADATA_STRING',
+        )
+    ))
+    params.append((
+        '''{
+          "sender":{"id":"USER_ID"},
+          "recipient":{"id":"PAGE_ID"},
+          "timestamp":1458692752478,
+          "postback":{
+            "title": "Get Started",
+            "payload":"USER_DEFINED_PAYLOAD",
+            "referral": {
+              "ref": "REF_DATA",
+              "source": "SHORTLINK",
+              "type": "OPEN_THREAD"
+            }
+          }
+        }''',
+        models.Postback(
+            sender_id='USER_ID',
+            recipient_id='PAGE_ID',
+            timestamp=1458692752478,
+            title='Get Started',
+            payload='USER_DEFINED_PAYLOAD',
+            referral=models.Referral(
+                sender_id='USER_ID',
+                recipient_id='PAGE_ID',
+                timestamp=1458692752478,
+                ref='REF_DATA',
+                source='SHORTLINK',
+                type='OPEN_THREAD',
+                ad_id=None,
+            ),
+        )
+    ))
+    params.append((
+        '''{
+          "sender":{"id":"USER_ID"},
+          "recipient":{"id":"PAGE_ID"},
+          "delivery":{
+            "mids":["mid.1458668856218:ed81099e15d3f4f233"],
+            "watermark":1458668856253,
+            "seq":37
+          }
+        }''',
+        models.DeliveryReceipt(
+            sender_id='USER_ID',
+            recipient_id='PAGE_ID',
+            timestamp=None,
+            watermark=1458668856253,
+            message_ids=['mid.1458668856218:ed81099e15d3f4f233'],
+        )
+    ))
+    params.append((
+        '''{
+          "sender":{"id":"USER_ID"},
+          "recipient":{"id":"PAGE_ID"},
+          "timestamp":1458668856463,
+          "read":{"watermark":1458668856253, "seq":38}
+        }''',
+        models.ReadReceipt(
+            sender_id='USER_ID',
+            recipient_id='PAGE_ID',
+            timestamp=1458668856463,
+            watermark=1458668856253,
+        )
+    ))
+    params.append((
+        '''{
+          "recipient":{"id":"PAGE_ID"},
+          "timestamp":1234567890,
+          "optin":{"ref":"PASS_THROUGH_PARAM", "user_ref":"UNIQUE_REF_PARAM"}
+        }''',
+        models.Optin(
+            sender_id=None,
+            recipient_id='PAGE_ID',
+            timestamp=1234567890,
+            ref='PASS_THROUGH_PARAM',
+            user_ref='UNIQUE_REF_PARAM',
+        )
+    ))
+    params.append((
+        '''{
+          "sender":{"id":"USER_ID"},
+          "recipient":{"id":"PAGE_ID"},
+          "timestamp":1458692752478,
+          "referral":{
+            "ref":"REF_DATA",
+            "ad_id":"ID_OF_THE_AD",
+            "source":"ADS",
+            "type":"OPEN_THREAD"
+          }
+        }''',
+        models.Referral(
+            sender_id='USER_ID',
+            recipient_id='PAGE_ID',
+            timestamp=1458692752478,
+            ref='REF_DATA',
+            source='ADS',
+            type='OPEN_THREAD',
+            ad_id='ID_OF_THE_AD',
+        )
+    ))
     return 'jsondoc,value', params
 
 
@@ -104,4 +228,28 @@ def make_test_params():
 def test_model_from_entry_structure(jsondoc, value):
     structure = json.loads(jsondoc)
     result = models.model_from_entry_structure(structure)
+    assert type(result) is type(value)
     assert attr.asdict(result) == attr.asdict(value)
+
+
+def test_counterpart_id_is_the_user_for_echoes_and_optins():
+    echo = models.model_from_entry_structure({
+        'sender': {'id': 'PAGE_ID'},
+        'recipient': {'id': 'USER_ID'},
+        'timestamp': 1,
+        'message': {'is_echo': True, 'mid': 'mid.1', 'text': 'hi'},
+    })
+    optin = models.model_from_entry_structure({
+        'recipient': {'id': 'PAGE_ID'},
+        'timestamp': 1,
+        'optin': {'ref': 'REF', 'user_ref': 'USER_REF'},
+    })
+    assert echo.counterpart_id == 'USER_ID'
+    assert optin.counterpart_id == 'USER_REF'
+
+
+def test_unsupported_event_type_raises():
+    structure = {'sender': {'id': 'USER_ID'}, 'account_linking': {}}
+    assert models.event_kind(structure) is None
+    with pytest.raises(models.UnsupportedEventType):
+        models.model_from_entry_structure(structure)
@@ -0,0 +1,64 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+from fbemissary import models
+from fbemissary import receipts
+from fbemissary.tests.test_conversation import (
+    make_demuxer, make_message, conversationalist_for)
+
+
+def delivery(sender_id, watermark):
+    return models.DeliveryReceipt(
+        sender_id, 'PAGE_ID', None, watermark, [])
+
+
+def read(sender_id, watermark):
+    return models.ReadReceipt(sender_id, 'PAGE_ID', watermark, watermark)
+
+
+def test_fold_keeps_latest_watermarks_and_other_events():
+    aggregator = receipts.ReceiptAggregator(window=60)
+    message = make_message('A', 'hi')
+    others = aggregator.fold('PAGE_ID', [
+        delivery('A', 10), read('A', 5), message, delivery('A', 7),
+        read('B', 3),
+    ])
+    assert others == [message]
+    a = aggregator.receipts_for('PAGE_ID', 'A')
+    assert (a.delivered_watermark, a.read_watermark) == (10, 5)
+    aggregator.flush()
+    aggregator.fold('PAGE_ID', [read('A', 8)])
+    assert (a.delivered_watermark, a.read_watermark) == (10, 8)
+    assert a.delivered(9) and not a.read(9)
+    assert aggregator.stats().conversations == 2
+
+
+def test_table_keeps_most_recently_updated_conversations():
+    aggregator = receipts.ReceiptAggregator(window=60, max_conversations=1)
+    aggregator.fold('PAGE_ID', [read('A', 1)])
+    aggregator.flush()
+    aggregator.fold('PAGE_ID', [read('B', 2)])
+    aggregator.flush()
+    assert aggregator.watermarks(('PAGE_ID', 'A')) == (None, None)
+    assert aggregator.watermarks(('PAGE_ID', 'B')) == (None, 2)
+
+
+def test_demuxer_folds_receipts_before_dispatch(loop):
+    aggregator = receipts.ReceiptAggregator(window=60)
+    demuxer = make_demuxer(loop, receipt_aggregator=aggregator)
+    assert demuxer.wants_event('PAGE_ID', models.EventKind.read)
+
+    async def scenario():
+        await demuxer.add_messaging_events('PAGE_ID', [
+            make_message('A', 'one'), read('A', 42), delivery('C', 1)])
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    a = conversationalist_for(demuxer, 'A')
+    assert [e.text for e in a.received] == ['one']
+    assert a.receipts.read_watermark == 42
+    # Receipts alone don't create conversations
+    assert demuxer.conversation_table_stats().size == 1
+    loop.run_until_complete(demuxer.close())
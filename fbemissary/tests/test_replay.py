@@ -0,0 +1,128 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import json
+import asyncio
+
+import pytest
+
+from fbemissary import conversation
+from fbemissary import replay
+from fbemissary import webhook
+from fbemissary.tests.test_webhook import (
+    APP_SECRET, FakeRequest, RecordingHandler)
+
+
+def make_body(sender_id, text):
+    return json.dumps({
+        'object': 'page',
+        'entry': [{
+            'id': 'PAGE_ID',
+            'time': 1458692752478,
+            'messaging': [{
+                'sender': {'id': sender_id},
+                'recipient': {'id': 'PAGE_ID'},
+                'timestamp': 1458692752478,
+                'message': {'mid': 'mid.' + text, 'text': text},
+            }],
+        }],
+    }).encode('utf-8')
+
+
+class EchoConversationalist(conversation.SerialConversationalist):
+    async def event_received(self, event):
+        await self.replier.send_text_message(event.text)
+
+
+def test_recorder_scrubs_and_records_timing(loop, tmpdir):
+    path = str(tmpdir.join('traffic.jsonl'))
+    recorder = replay.TrafficRecorder(path, salt='s')
+    recorder.start(loop=loop)
+    recorder.record(make_body('USER', 'secret'))
+    recorder.record(b'not json')
+    loop.run_until_complete(asyncio.sleep(0.01))
+    recorder.record(make_body('USER', 'again'))
+    loop.run_until_complete(recorder.close())
+    recorded = list(replay.read_recording(path))
+    assert len(recorded) == 2
+    assert recorded[0][0] < 0.01 <= recorded[1][0]
+    first, second = [
+        body['entry'][0]['messaging'][0] for _, body in recorded]
+    assert first['message']['text'] == 'xxxxxx'
+    assert first['recipient']['id'] == 'PAGE_ID'
+    assert first['sender']['id'] != 'USER'
+    assert first['sender']['id'] == second['sender']['id']
+
+
+def test_recorder_requires_a_salt_to_scrub(tmpdir):
+    path = str(tmpdir.join('traffic.jsonl'))
+    with pytest.raises(ValueError):
+        replay.TrafficRecorder(path, salt='')
+    first = replay.TrafficRecorder(path)
+    second = replay.TrafficRecorder(path)
+    # A random salt is generated for each recorder
+    assert first._salt and first._salt != second._salt
+
+
+def test_rejected_webhooks_are_not_recorded(loop, tmpdir):
+    path = str(tmpdir.join('traffic.jsonl'))
+    recorder = replay.TrafficRecorder(path, scrub=False)
+    recorder.start(loop=loop)
+    handler = RecordingHandler()
+    handler.release = asyncio.Event()
+    queue = webhook.WebhookIngestQueue(
+        handler, maxsize=1, workers=1, loop=loop)
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop, ingest_queue=queue,
+        recorder=recorder)
+
+    async def scenario():
+        queue.start()
+        statuses = []
+        for text in ['one', 'two', 'three']:
+            response = await receiver.receive_update(
+                FakeRequest(make_body('USER', text)))
+            statuses.append(response.status)
+            await asyncio.sleep(0)
+        handler.release.set()
+        await queue.join()
+        await queue.close()
+        await recorder.close()
+        return statuses
+
+    assert loop.run_until_complete(scenario()) == [200, 200, 503]
+    texts = [
+        body['entry'][0]['messaging'][0]['message']['text']
+        for _, body in replay.read_recording(path)]
+    assert texts == ['one', 'two']
+
+
+def test_replay_through_stub_client(loop, tmpdir):
+    path = str(tmpdir.join('traffic.jsonl'))
+    with open(path, 'wb') as f:
+        for n, sender_id in enumerate(['A', 'B', 'A']):
+            body = json.loads(make_body(sender_id, 'm{0}'.format(n)))
+            f.write(json.dumps({'t': n * 0.02, 'body': body}).encode())
+            f.write(b'\n')
+    demuxer = conversation.MessagingEventDemuxer(
+        page_client_class=replay.StubPageMessagingAPIClient)
+    demuxer.add_conversationalist_factory(
+        'PAGE_ID', 'TOKEN',
+        conversation.ConversationalistFactory(EchoConversationalist), ())
+    loop.run_until_complete(demuxer.start(None, loop=loop))
+    wrangler = webhook.WebhookWrangler(
+        demuxer.add_messaging_events, event_filter=demuxer.wants_event)
+
+    async def scenario(speed):
+        stats = await replay.TrafficReplayer(
+            wrangler, loop=loop, speed=speed).run(path)
+        await demuxer.drain_conversations(poll_interval=0.001)
+        return stats
+
+    stats = loop.run_until_complete(scenario(1.0))
+    assert (stats.bodies, stats.errors) == (3, 0)
+    assert stats.elapsed >= 0.04
+    stats = loop.run_until_complete(scenario(None))
+    assert stats.elapsed < 0.04
+    assert demuxer._pages.get('PAGE_ID').client.sent == 6
+    loop.run_until_complete(demuxer.close())
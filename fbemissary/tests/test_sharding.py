@@ -0,0 +1,166 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+import pytest
+
+from fbemissary import sharding
+
+
+def make_event(sender_id, n):
+    return {
+        'sender': {'id': sender_id},
+        'recipient': {'id': 'PAGE_ID'},
+        'timestamp': n,
+        'message': {'mid': 'mid.{0}'.format(n), 'text': str(n)},
+    }
+
+
+def make_structure(senders):
+    return {
+        'object': 'page',
+        'entry': [{
+            'id': 'PAGE_ID',
+            'time': 1,
+            'messaging': [
+                make_event(sender_id, n)
+                for n, sender_id in enumerate(senders)
+            ],
+        }],
+    }
+
+
+def test_shard_for_is_stable():
+    assert sharding.shard_for('PAGE_ID', 'USER', 8) == (
+        sharding.shard_for('PAGE_ID', 'USER', 8))
+    shards = {sharding.shard_for('PAGE_ID', str(n), 4) for n in range(100)}
+    assert shards == {0, 1, 2, 3}
+
+
+def test_split_keeps_each_sender_on_one_shard_in_order():
+    senders = [str(n % 10) for n in range(50)]
+    parts = sharding.split_webhook_structure(make_structure(senders), 3)
+    seen = {}
+    for shard, structure in parts.items():
+        assert structure['object'] == 'page'
+        for entry in structure['entry']:
+            for event in entry['messaging']:
+                sender_id = event['sender']['id']
+                assert seen.setdefault(sender_id, shard) == shard
+                assert sharding.shard_for(
+                    'PAGE_ID', sender_id, 3) == shard
+            timestamps = [e['timestamp'] for e in entry['messaging']]
+            assert timestamps == sorted(timestamps)
+    assert len(seen) == 10
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.structures = []
+        self.received = asyncio.Event()
+
+    async def handle_webhook_structure(self, structure):
+        self.structures.append(structure)
+        self.received.set()
+
+
+def test_router_forwards_to_worker_servers(loop, tmp_path):
+    paths = sharding.shard_socket_paths(str(tmp_path), 2)
+    handlers = [RecordingHandler(), RecordingHandler()]
+    servers = [
+        sharding.ShardWorkerServer(path, handler, loop=loop)
+        for path, handler in zip(paths, handlers)
+    ]
+    router = sharding.ShardRouter(paths, loop=loop)
+    senders = [str(n) for n in range(20)]
+
+    async def scenario():
+        for server in servers:
+            await server.start()
+        await router.connect(timeout=1)
+        await router.handle_webhook_structure(make_structure(senders))
+        for handler in handlers:
+            await asyncio.wait_for(handler.received.wait(), 1)
+        await router.close()
+        for server in servers:
+            await server.close()
+
+    loop.run_until_complete(scenario())
+    for shard, handler in enumerate(handlers):
+        [structure] = handler.structures
+        for event in structure['entry'][0]['messaging']:
+            assert sharding.shard_for(
+                'PAGE_ID', event['sender']['id'], 2) == shard
+
+
+def test_router_refuses_then_reconnects_to_restarted_worker(loop, tmp_path):
+    [path] = sharding.shard_socket_paths(str(tmp_path), 1)
+    handler = RecordingHandler()
+    router = sharding.ShardRouter(
+        [path], loop=loop, reconnect_delay=0.01, max_reconnect_delay=0.02)
+
+    async def scenario():
+        server = sharding.ShardWorkerServer(path, handler, loop=loop)
+        await server.start()
+        await router.connect(timeout=1)
+        await router.handle_webhook_structure(make_structure(['A']))
+        await asyncio.wait_for(handler.received.wait(), 1)
+        handler.received.clear()
+        await server.close()
+        for _ in range(100):
+            if not router.available:
+                break
+            await asyncio.sleep(0.01)
+        assert not router.available
+        with pytest.raises(sharding.ShardUnavailable):
+            await router.handle_webhook_structure(make_structure(['C']))
+
+        # The worker comes back
+        server = sharding.ShardWorkerServer(path, handler, loop=loop)
+        await server.start()
+        for _ in range(100):
+            if router.available:
+                break
+            await asyncio.sleep(0.01)
+        await router.handle_webhook_structure(make_structure(['B']))
+        await asyncio.wait_for(handler.received.wait(), 1)
+        await router.close()
+        await server.close()
+
+    loop.run_until_complete(scenario())
+    senders = [
+        structure['entry'][0]['messaging'][0]['sender']['id']
+        for structure in handler.structures
+    ]
+    assert senders == ['A', 'B']
+
+
+class SlowHandler(RecordingHandler):
+    async def handle_webhook_structure(self, structure):
+        await asyncio.sleep(0.01)
+        await super().handle_webhook_structure(structure)
+
+
+def test_stopping_worker_handles_frames_already_sent(loop, tmp_path):
+    [path] = sharding.shard_socket_paths(str(tmp_path), 1)
+    handler = SlowHandler()
+    server = sharding.ShardWorkerServer(path, handler, loop=loop)
+    router = sharding.ShardRouter([path], loop=loop, reconnect_delay=10)
+
+    async def scenario():
+        await server.start()
+        await router.connect(timeout=1)
+        await router.handle_webhook_structure(make_structure(['A']))
+        await asyncio.wait_for(handler.received.wait(), 1)
+        # Still in the socket or being handled when the worker stops
+        for sender_id in 'BC':
+            await router.handle_webhook_structure(make_structure([sender_id]))
+        server.stop_accepting()
+        await asyncio.wait_for(server.join(), 1)
+        await server.close()
+        assert not router.available
+        await router.close()
+
+    loop.run_until_complete(scenario())
+    assert len(handler.structures) == 3
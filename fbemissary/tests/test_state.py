@@ -0,0 +1,133 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+import pytest
+
+from fbemissary import conversation
+from fbemissary import models
+from fbemissary import state
+
+
+class CountingConversationalist(conversation.SerialConversationalist):
+    async def event_received(self, event):
+        self.state.data['count'] = self.state.data.get('count', 0) + 1
+        self.state.mark_dirty()
+
+
+def make_message(n):
+    return models.ReceivedMessage(
+        sender_id='USER',
+        recipient_id='PAGE_ID',
+        timestamp=n,
+        id='mid.{0}'.format(n),
+        text='hello',
+        attachments=[],
+        quick_reply=None,
+    )
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path, loop):
+    if request.param == 'memory':
+        # Closing a memory store keeps its contents, so "restarts" can
+        # share one.
+        store = state.MemoryStateStore()
+        return lambda: store
+    path = str(tmp_path / 'state.sqlite')
+    return lambda: state.SQLiteStateStore(path, loop=loop)
+
+
+def run_demuxer(loop, store, events):
+    demuxer = conversation.MessagingEventDemuxer(
+        state_store=store, state_flush_interval=60)
+    factory = conversation.ConversationalistFactory(
+        CountingConversationalist)
+    demuxer.add_conversationalist_factory('PAGE_ID', 'TOKEN', factory, ())
+
+    async def scenario():
+        await demuxer.start(None, loop=loop)
+        await demuxer.add_messaging_events('PAGE_ID', events)
+        convo = demuxer._convos.get(('PAGE_ID', 'USER'))
+        while convo.busy:
+            await asyncio.sleep(0.001)
+        await demuxer.close()
+
+    loop.run_until_complete(scenario())
+
+
+def test_state_survives_restart(loop, make_store):
+    run_demuxer(loop, make_store(), [make_message(1), make_message(2)])
+    run_demuxer(loop, make_store(), [make_message(3)])
+    store = make_store()
+    data = loop.run_until_complete(store.load(('PAGE_ID', 'USER')))
+    loop.run_until_complete(store.close())
+    assert data == {'count': 3}
+
+
+def test_manager_batches_dirty_writes(loop):
+    class RecordingStore(state.MemoryStateStore):
+        batches = []
+
+        async def save_many(self, items):
+            self.batches.append(sorted(key for key, _ in items))
+            await super().save_many(items)
+
+    store = RecordingStore()
+    manager = state.StateManager(store, flush_interval=60, loop=loop)
+
+    async def scenario():
+        handles = [manager.state_for('PAGE_ID', str(n)) for n in range(3)]
+        for handle in handles:
+            data = await handle.load()
+            data['seen'] = True
+            handle.mark_dirty()
+            handle.mark_dirty()
+        await manager.flush()
+        await manager.flush()
+
+    loop.run_until_complete(scenario())
+    assert store.batches == [[('PAGE_ID', '0'), ('PAGE_ID', '1'),
+                              ('PAGE_ID', '2')]]
+
+
+def test_evicted_state_is_reloaded_before_flush(loop):
+    manager = state.StateManager(
+        state.MemoryStateStore(), flush_interval=60, loop=loop)
+
+    async def scenario():
+        first = manager.state_for('PAGE_ID', 'USER')
+        (await first.load())['n'] = 1
+        first.mark_dirty()
+        second = manager.state_for('PAGE_ID', 'USER')
+        return await second.load()
+
+    assert loop.run_until_complete(scenario()) == {'n': 1}
+
+
+class SlowStore(state.MemoryStateStore):
+    def __init__(self):
+        super().__init__()
+        self.saving = asyncio.Event()
+
+    async def save_many(self, items):
+        self.saving.set()
+        await asyncio.sleep(0.01)
+        await super().save_many(items)
+
+
+def test_close_lets_a_flush_in_progress_finish(loop):
+    store = SlowStore()
+    manager = state.StateManager(store, flush_interval=0.001, loop=loop)
+
+    async def scenario():
+        manager.start()
+        handle = manager.state_for('PAGE_ID', 'USER')
+        (await handle.load())['n'] = 1
+        handle.mark_dirty()
+        await asyncio.wait_for(store.saving.wait(), 1)
+        await manager.close()
+        return await store.load(('PAGE_ID', 'USER'))
+
+    assert loop.run_until_complete(scenario()) == {'n': 1}
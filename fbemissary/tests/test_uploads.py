@@ -0,0 +1,87 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+
+from fbemissary import client
+from fbemissary import uploads
+
+
+class FakeUploadingClient:
+    """
+    Stand-in for :class:`fbemissary.client.PageMessagingAPIClient`
+    recording uploads and sends.
+    """
+    def __init__(self, page_id='PAGE_ID'):
+        self.page_id = page_id
+        self.uploads = []
+        self.sent = []
+
+    async def upload_attachment(self, attachment_type, **kwargs):
+        await asyncio.sleep(0)
+        self.uploads.append((attachment_type, kwargs))
+        return 'att-{0}'.format(len(self.uploads))
+
+    async def send_message(self, recipient_id, message_payload):
+        self.sent.append((recipient_id, message_payload))
+        return {'recipient_id': recipient_id, 'message_id': 'm'}
+
+
+def test_same_content_is_uploaded_once(loop, tmpdir):
+    first = tmpdir.join('a.png')
+    first.write_binary(b'PNG')
+    copy = tmpdir.join('b.png')
+    copy.write_binary(b'PNG')
+    page_client = FakeUploadingClient()
+    registry = uploads.AttachmentIdRegistry(loop=loop)
+
+    async def scenario():
+        return await asyncio.gather(
+            registry.attachment_id(page_client, 'image', path=str(first)),
+            registry.attachment_id(page_client, 'image', path=str(first)),
+            registry.attachment_id(page_client, 'image', path=str(copy)),
+        )
+
+    assert loop.run_until_complete(scenario()) == ['att-1'] * 3
+    assert len(page_client.uploads) == 1
+    _, kwargs = page_client.uploads[0]
+    assert kwargs['data'] == b'PNG'
+    assert kwargs['content_type'] == 'image/png'
+    # IDs are per page
+    other_page = FakeUploadingClient('OTHER_PAGE')
+    loop.run_until_complete(
+        registry.attachment_id(other_page, 'image', path=str(first)))
+    assert len(other_page.uploads) == 1
+
+
+def test_ids_persist_across_restarts(loop, tmpdir):
+    path = str(tmpdir.join('ids.json'))
+    page_client = FakeUploadingClient()
+    registry = uploads.AttachmentIdRegistry(path, loop=loop)
+    loop.run_until_complete(registry.attachment_id(
+        page_client, 'video', url='https://example.com/v.mp4'))
+    loop.run_until_complete(registry.close())
+    restarted = uploads.AttachmentIdRegistry(path, loop=loop)
+    assert len(restarted) == 1
+    attachment_id = loop.run_until_complete(restarted.attachment_id(
+        page_client, 'video', url='https://example.com/v.mp4'))
+    assert attachment_id == 'att-1'
+    assert len(page_client.uploads) == 1
+
+
+def test_replier_sends_by_attachment_id(loop):
+    page_client = FakeUploadingClient()
+    registry = uploads.AttachmentIdRegistry(loop=loop)
+    replier = client.ConversationReplierAPIClient(
+        page_client, 'USER', attachment_ids=registry)
+
+    async def scenario():
+        for _ in range(3):
+            await replier.send_image(url='https://example.com/cat.jpg')
+        await replier.send_file(attachment_id='known')
+
+    loop.run_until_complete(scenario())
+    assert len(page_client.uploads) == 1
+    assert [payload['attachment'] for _, payload in page_client.sent] == [
+        {'type': 'image', 'payload': {'attachment_id': 'att-1'}},
+    ] * 3 + [{'type': 'file', 'payload': {'attachment_id': 'known'}}]
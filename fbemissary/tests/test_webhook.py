@@ -0,0 +1,242 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+import asyncio
+import hmac
+import json
+
+import pytest
+
+from fbemissary import webhook
+from fbemissary import dedupe
+from fbemissary import models
+
+
+APP_SECRET = 'test-app-secret'
+
+
+class FakeRequest:
+    def __init__(self, content, secret=APP_SECRET):
+        self._content = content
+        signature = hmac.new(
+            secret.encode('ascii'), msg=content, digestmod='sha1')
+        self.headers = {
+            'X-Hub-Signature': 'sha1=' + signature.hexdigest(),
+        }
+
+    async def read(self):
+        return self._content
+
+    async def json(self):
+        return json.loads(self._content.decode('utf-8'))
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.structures = []
+        self.release = None
+
+    async def handle_webhook_structure(self, structure):
+        if self.release is not None:
+            await self.release.wait()
+        self.structures.append(structure)
+
+
+def make_body(n):
+    return json.dumps({'object': 'page', 'entry': [], 'n': n}).encode()
+
+
+def test_receive_update_rejects_bad_signature(loop):
+    handler = RecordingHandler()
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop)
+    request = FakeRequest(make_body(0), secret='wrong')
+    response = loop.run_until_complete(receiver.receive_update(request))
+    assert response.status == 403
+    assert handler.structures == []
+
+
+def test_receive_update_handles_inline_without_queue(loop):
+    handler = RecordingHandler()
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop)
+    response = loop.run_until_complete(
+        receiver.receive_update(FakeRequest(make_body(1))))
+    assert response.status == 200
+    assert [s['n'] for s in handler.structures] == [1]
+
+
+class UnavailableHandler(RecordingHandler):
+    available = True
+
+    async def handle_webhook_structure(self, structure):
+        raise webhook.HandlerUnavailable('down')
+
+
+def test_receive_update_replies_503_while_handler_unavailable(loop):
+    handler = UnavailableHandler()
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop)
+    response = loop.run_until_complete(
+        receiver.receive_update(FakeRequest(make_body(1))))
+    assert response.status == 503
+    handler.available = False
+    queue = webhook.WebhookIngestQueue(handler, loop=loop)
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop, ingest_queue=queue)
+    response = loop.run_until_complete(
+        receiver.receive_update(FakeRequest(make_body(2))))
+    assert response.status == 503
+
+
+def test_ingest_queue_acknowledges_then_processes(loop):
+    handler = RecordingHandler()
+    queue = webhook.WebhookIngestQueue(
+        handler, maxsize=10, workers=2, loop=loop)
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop, ingest_queue=queue)
+
+    async def scenario():
+        queue.start()
+        handler.release = asyncio.Event()
+        for n in range(3):
+            response = await receiver.receive_update(
+                FakeRequest(make_body(n)))
+            assert response.status == 200
+        assert handler.structures == []
+        handler.release.set()
+        await queue.join()
+        await queue.close()
+
+    loop.run_until_complete(scenario())
+    assert sorted(s['n'] for s in handler.structures) == [0, 1, 2]
+    stats = queue.stats()
+    assert stats.enqueued == 3
+    assert stats.processed == 3
+    assert stats.rejected == 0
+
+
+def test_ingest_queue_full_replies_503(loop):
+    handler = RecordingHandler()
+    queue = webhook.WebhookIngestQueue(
+        handler, maxsize=1, workers=1, loop=loop)
+    receiver = webhook.WebhookReceiver(
+        APP_SECRET, 'verify', handler, loop=loop, ingest_queue=queue,
+        retry_after=7)
+
+    async def scenario():
+        queue.start()
+        handler.release = asyncio.Event()
+        statuses = []
+        for n in range(3):
+            response = await receiver.receive_update(
+                FakeRequest(make_body(n)))
+            statuses.append(response.status)
+            # Let the worker pick up the first body.
+            await asyncio.sleep(0)
+        handler.release.set()
+        await queue.join()
+        await queue.close()
+        return statuses, response
+
+    statuses, last_response = loop.run_until_complete(scenario())
+    assert statuses == [200, 200, 503]
+    assert last_response.headers['Retry-After'] == '7'
+    assert queue.stats().rejected == 1
+
+
+def make_page_structure(mids):
+    return {
+        'object': 'page',
+        'entry': [{
+            'id': 'PAGE_ID',
+            'time': 1,
+            'messaging': [
+                {
+                    'sender': {'id': 'USER'},
+                    'recipient': {'id': 'PAGE_ID'},
+                    'timestamp': 1,
+                    'message': {'mid': mid, 'text': 'hi'},
+                }
+                for mid in mids
+            ],
+        }],
+    }
+
+
+def test_wrangler_drops_redelivered_messages(loop):
+    received = []
+
+    async def messaging_events_received(page_id, events):
+        received.extend(event.id for event in events)
+
+    deduplicator = dedupe.MessageDeduplicator(window=60)
+    wrangler = webhook.WebhookWrangler(
+        messaging_events_received, deduplicator=deduplicator)
+    loop.run_until_complete(wrangler.handle_webhook_structure(
+        make_page_structure(['m1', 'm2'])))
+    loop.run_until_complete(wrangler.handle_webhook_structure(
+        make_page_structure(['m2', 'm3'])))
+    assert received == ['m1', 'm2', 'm3']
+    stats = deduplicator.stats()
+    assert stats.checked == 4
+    assert stats.duplicates == 1
+    assert stats.hit_rate == 0.25
+
+
+def test_wrangler_handles_redelivery_of_messages_that_failed(loop):
+    received = []
+    failures = [RuntimeError('conversation unavailable')]
+
+    async def messaging_events_received(page_id, events):
+        if failures:
+            raise failures.pop()
+        received.extend(event.id for event in events)
+
+    wrangler = webhook.WebhookWrangler(
+        messaging_events_received,
+        deduplicator=dedupe.MessageDeduplicator(window=60))
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(wrangler.handle_webhook_structure(
+            make_page_structure(['m1', 'm2'])))
+    # Facebook redelivers the body after the error response
+    loop.run_until_complete(wrangler.handle_webhook_structure(
+        make_page_structure(['m1', 'm2'])))
+    loop.run_until_complete(wrangler.handle_webhook_structure(
+        make_page_structure(['m2'])))
+    assert received == ['m1', 'm2']
+
+
+def test_deduplicator_forgets_after_two_rotations():
+    deduplicator = dedupe.MessageDeduplicator(window=60, max_entries=2)
+    for mid in ['a', 'b', 'c', 'd']:
+        assert not deduplicator.seen(mid)
+    # 'a' and 'b' rotated into the previous generation...
+    assert deduplicator.seen('b')
+    assert not deduplicator.seen('e')
+    # ...and were dropped when 'e' caused another rotation.
+    assert not deduplicator.seen('a')
+    assert deduplicator.stats().size <= 4
+
+
+def test_wrangler_filters_event_kinds_before_parsing(loop, caplog):
+    received = []
+
+    async def messaging_events_received(page_id, events):
+        received.extend(type(event).__name__ for event in events)
+
+    wrangler = webhook.WebhookWrangler(
+        messaging_events_received,
+        event_filter=lambda page_id, kind: kind is not models.EventKind.read)
+    sender = {'sender': {'id': 'USER'}, 'recipient': {'id': 'PAGE_ID'},
+              'timestamp': 1}
+    structure = {'object': 'page', 'entry': [{'id': 'PAGE_ID', 'messaging': [
+        dict(sender, read={'watermark': 1}),
+        dict(sender, postback={'payload': 'GO'}),
+        dict(sender, account_linking={'status': 'linked'}),
+    ]}]}
+    loop.run_until_complete(wrangler.handle_webhook_structure(structure))
+    assert received == ['Postback']
+    [record] = caplog.records
+    assert 'unsupported' in record.getMessage()
+    assert record.exc_info is None
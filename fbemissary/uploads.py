@@ -0,0 +1,183 @@
+# Licensed under the Apache License:
+#     http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
+"""
+Reusable attachment IDs for outbound media
+
+Media uploaded with the Attachment Upload API gets an attachment ID
+that can be sent to any number of recipients. An
+:class:`AttachmentIdRegistry` uploads each file or URL once per page
+and remembers its ID, keyed on a hash of the content, optionally in a
+JSON file so the IDs survive restarts.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import functools
+
+
+logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, _HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class AttachmentIdRegistry:
+    """
+    Uploads media once per page and hands out its reusable attachment
+    ID afterwards.
+
+    Local files are keyed on the SHA-256 of their content, so the same
+    content under different names is uploaded once. URLs are keyed on
+    the SHA-256 of the URL itself, since Facebook fetches them and the
+    content is never seen here.
+
+    Arguments:
+        path (str or None):
+            A JSON file the IDs are loaded from and saved to after
+            uploads, in the background. If ``None``, IDs are kept in
+            memory only. Await :meth:`close` to finish saving.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+    """
+    def __init__(self, path=None, *, loop):
+        self._path = path
+        self._loop = loop
+        # Map of 'page_id:type:digest' -> attachment ID
+        self._ids = self._load()
+        # Map of (path, mtime, size) -> content digest, so unchanged
+        # files aren't hashed again
+        self._file_digests = {}
+        # Map of key -> upload task
+        self._uploads = {}
+        # Saves run one at a time in the background; IDs added while
+        # one runs are written by the next
+        self._saver = None
+        self._unsaved = False
+
+    def __len__(self):
+        return len(self._ids)
+
+    async def attachment_id(self, page_messaging_client, attachment_type, *,
+                            path=None, url=None):
+        """
+        Return the attachment ID for the local file ``path`` or the
+        ``url`` on the page of the
+        :class:`fbemissary.client.PageMessagingAPIClient`, uploading
+        it through that client if it hasn't been before. Concurrent
+        calls for the same content share one upload.
+        """
+        if (path is None) == (url is None):
+            raise ValueError('Exactly one of path and url must be given')
+        if path is not None:
+            digest = await self._file_digest(path)
+        else:
+            digest = 'url-' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+        key = '{0}:{1}:{2}'.format(
+            page_messaging_client.page_id, attachment_type, digest)
+        attachment_id = self._ids.get(key)
+        if attachment_id is not None:
+            return attachment_id
+        task = self._uploads.get(key)
+        if task is None:
+            task = self._loop.create_task(self._upload(
+                key, page_messaging_client, attachment_type, path, url))
+            self._uploads[key] = task
+            task.add_done_callback(
+                functools.partial(self._upload_done, key))
+        # Shielded so one cancelled sender doesn't cancel the upload
+        # for the others waiting on it.
+        return await asyncio.shield(task)
+
+    async def close(self):
+        """
+        Wait until every ID uploaded so far has been saved.
+        """
+        if self._saver is not None:
+            await self._saver
+
+    async def _file_digest(self, path):
+        stat = os.stat(path)
+        file_key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._file_digests.get(file_key)
+        if digest is None:
+            digest = await self._loop.run_in_executor(None, _hash_file, path)
+            self._file_digests[file_key] = digest
+        return digest
+
+    async def _upload(self, key, page_messaging_client, attachment_type,
+                      path, url):
+        if path is not None:
+            data = await self._loop.run_in_executor(None, _read_file, path)
+            attachment_id = await page_messaging_client.upload_attachment(
+                attachment_type,
+                data=data,
+                filename=os.path.basename(path),
+                content_type=mimetypes.guess_type(path)[0],
+            )
+        else:
+            attachment_id = await page_messaging_client.upload_attachment(
+                attachment_type, url=url)
+        logger.info(
+            'Uploaded %s attachment %r as ID %r',
+            attachment_type, path or url, attachment_id)
+        self._ids[key] = attachment_id
+        self._request_save()
+        return attachment_id
+
+    def _upload_done(self, key, task):
+        del self._uploads[key]
+        if not task.cancelled():
+            # Retrieved here so failures nobody awaits aren't reported
+            # as unretrieved; the senders get the exception themselves.
+            task.exception()
+
+    def _load(self):
+        if self._path is None:
+            return {}
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _request_save(self):
+        if self._path is None:
+            return
+        self._unsaved = True
+        if self._saver is None:
+            self._saver = self._loop.create_task(self._save_unsaved())
+
+    async def _save_unsaved(self):
+        try:
+            while self._unsaved:
+                self._unsaved = False
+                await self._loop.run_in_executor(
+                    None, self._save_sync, dict(self._ids))
+        except Exception:
+            logger.exception(
+                'Failed to save attachment IDs to %r', self._path)
+        finally:
+            self._saver = None
+
+    def _save_sync(self, ids):
+        # Write then rename, so a crash never leaves a torn file
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(ids, f, indent=0, sort_keys=True)
+        os.replace(temporary_path, self._path)
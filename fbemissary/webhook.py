@@ -2,27 +2,78 @@
 #     http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/cdunklau/fbemissary/blob/master/NOTICE.txt
 import logging
+import asyncio
 import hmac
 
 import aiohttp.web
+import attr
 
 from fbemissary import models
+from fbemissary import jsoncodec
 
 
 logger = logging.getLogger(__name__)
 
 
+class HandlerUnavailable(Exception):
+    """
+    Raised by a webhook structure handler that can't take structures
+    for now. The :class:`WebhookReceiver` answers the request with a
+    503, so Facebook redelivers it later.
+    """
+
+
 class WebhookReceiver:
     """
     Receive Facebook webhooks and dispatch the received structure to
     the ``webhook_structure_handler`` coroutine callable.
+
+    If an ``ingest_queue`` (a :class:`WebhookIngestQueue`) is given,
+    verified request bodies are put on it and acknowledged right away
+    instead of being handled on the request path. When the queue is
+    full the request is answered with a 503 so Facebook retries it
+    later.
+
+    Request bodies are decoded with ``json_loads``, by default
+    :func:`fbemissary.jsoncodec.loads`.
+
+    If an ``instrumentation`` (a
+    :class:`fbemissary.metrics.Instrumentation`) is given, signature
+    verification and decoding are timed and requests counted.
+
+    If a ``journal`` (a :class:`fbemissary.journal.IngestJournal`) is
+    given, each verified body is durably recorded in it before the
+    request is acknowledged, and marked processed once every event
+    parsed from it has been handled. The handler is then called with
+    a :class:`fbemissary.journal.PendingBody` as the ``pending``
+    keyword argument.
+
+    If a ``recorder`` (a :class:`fbemissary.replay.TrafficRecorder`)
+    is given, every verified body that is acknowledged is recorded
+    with it. Bodies answered with an error are left out, since
+    Facebook redelivers them.
+
+    After :meth:`stop_accepting` every update is answered with a 503,
+    so Facebook redelivers it later, presumably to another instance.
+    So is every update while the handler has an ``available``
+    attribute that is false, and every update the handler raises
+    :class:`HandlerUnavailable` for.
     """
     def __init__(self, app_secret, verify_token, webhook_structure_handler,
-                 *, loop):
+                 *, loop, ingest_queue=None, retry_after=5, json_loads=None,
+                 instrumentation=None, journal=None, recorder=None):
         self._loop = loop
+        self._journal = journal
+        self._recorder = recorder
+        self._instrumentation = instrumentation
         self._app_secret = app_secret
+        self._app_secret_key = app_secret.encode('ascii')
+        self._json_loads = json_loads or jsoncodec.loads
         self._verify_token = verify_token
         self._handler = webhook_structure_handler
+        self._ingest_queue = ingest_queue
+        self._retry_after = retry_after
+        self._accepting = True
 
     def setup_routes(self, mountpoint, router):
         router.add_get(mountpoint, self.verify_subscription)
@@ -44,34 +95,303 @@ class WebhookReceiver:
             logger.warning(fmt, request.query_string)
             return aiohttp.web.Response(status=403)
 
+    def stop_accepting(self):
+        self._accepting = False
+
     async def receive_update(self, request):
-        if not await self._has_valid_signature(request):
+        if not self._accepting or not getattr(
+                self._handler, 'available', True):
+            return self._unavailable()
+        instr = self._instrumentation
+        if instr is None:
+            return await self._receive_update(request, None)
+        with instr.span('fbemissary.receive_update'):
+            return await self._receive_update(request, instr)
+
+    async def _receive_update(self, request, instr):
+        # Read the body once; signature verification and decoding both
+        # work on these bytes.
+        content = await request.read()
+        if instr is not None:
+            started = instr.clock()
+        valid = self._has_valid_signature(request, content)
+        if instr is not None:
+            instr.signature_seconds.observe(instr.clock() - started)
+        if not valid:
             logger.warning('Signature mismatch for webhook request')
+            if instr is not None:
+                instr.webhook_requests.inc(labels=('forbidden',))
             return aiohttp.web.Response(status=403)
-        structure = await request.json()
-        logger.debug('Received update %r', await request.read())
-        await self._handler.handle_webhook_structure(structure)
+        logger.debug('Received update %r', content)
+        if self._ingest_queue is not None:
+            response = await self._enqueue_update(content)
+            if response.status == 200:
+                self._record(content)
+            if instr is not None:
+                outcome = 'queued' if response.status == 200 else 'rejected'
+                instr.webhook_requests.inc(labels=(outcome,))
+            return response
+        if self._journal is None:
+            try:
+                await self._handle_update(content, instr, None)
+            except HandlerUnavailable as exc:
+                logger.warning('Rejecting webhook request with 503: %s', exc)
+                if instr is not None:
+                    instr.webhook_requests.inc(labels=('rejected',))
+                return self._unavailable()
+        else:
+            pending = self._journal.pending(
+                await self._journal.append(content))
+            try:
+                await self._handle_update(content, instr, pending)
+            except asyncio.CancelledError:
+                # Left unprocessed, so it's replayed after a restart
+                raise
+            except Exception:
+                # It would fail the same way when replayed
+                pending.release()
+                raise
+            pending.release()
+        self._record(content)
+        if instr is not None:
+            instr.webhook_requests.inc(labels=('handled',))
         return aiohttp.web.Response(status=200)
 
-    async def _has_valid_signature(self, request):
+    async def _handle_update(self, content, instr, pending):
+        if instr is not None:
+            started = instr.clock()
+        structure = self._json_loads(content)
+        if instr is not None:
+            instr.decode_seconds.observe(instr.clock() - started)
+        await _handle_structure(self._handler, structure, pending)
+
+    async def _enqueue_update(self, content):
+        pending = None
+        # Don't journal what the queue would reject anyway
+        if self._journal is not None and not self._ingest_queue.full():
+            pending = self._journal.pending(
+                await self._journal.append(content))
+        if self._ingest_queue.submit(content, pending):
+            return aiohttp.web.Response(status=200)
+        if pending is not None:
+            # Facebook redelivers it after the 503
+            pending.release()
+        logger.warning(
+            'Ingest queue full, rejecting webhook request with 503')
+        return self._unavailable()
+
+    def _record(self, content):
+        if self._recorder is not None:
+            self._recorder.record(content)
+
+    def _unavailable(self):
+        return aiohttp.web.Response(
+            status=503, headers={'Retry-After': str(self._retry_after)})
+
+    def _has_valid_signature(self, request, content):
         sig_header_value = request.headers.get('X-Hub-Signature', 'sha1=')
         _, _, signature = sig_header_value.partition('sha1=')
-        content = await request.read()
-        key = self._app_secret.encode('ascii')
-        verifier = hmac.new(key, msg=content, digestmod='sha1')
+        verifier = hmac.new(
+            self._app_secret_key, msg=content, digestmod='sha1')
         computed_signature = verifier.hexdigest()
         # Reduce timing attack surface
         return hmac.compare_digest(signature, computed_signature)
 
 
+@attr.s
+class IngestQueueStats:
+    depth = attr.ib()
+    maxsize = attr.ib()
+    workers = attr.ib()
+    busy_workers = attr.ib()
+    enqueued = attr.ib()
+    rejected = attr.ib()
+    processed = attr.ib()
+    failed = attr.ib()
+    max_depth = attr.ib()
+
+
+class WebhookIngestQueue:
+    """
+    Bounded queue of verified webhook request bodies, drained by a
+    fixed pool of worker tasks that decode each body and pass the
+    structure to the ``webhook_structure_handler``.
+
+    Arguments:
+        webhook_structure_handler:
+            An object with a ``handle_webhook_structure`` coroutine
+            method, normally a :class:`WebhookWrangler`.
+        maxsize (int):
+            The maximum number of bodies waiting to be processed.
+            :meth:`submit` refuses new bodies past this point.
+        workers (int):
+            The number of worker tasks draining the queue.
+        loop (:class:`asyncio.AbstractEventLoop`):
+            The event loop instance.
+        json_loads:
+            Callable decoding a body from bytes, by default
+            :func:`fbemissary.jsoncodec.loads`.
+        instrumentation
+                (:class:`fbemissary.metrics.Instrumentation` or None):
+            If given, the queue's depth and counters are exported
+            through its registry.
+    """
+    def __init__(self, webhook_structure_handler, *, maxsize=1000,
+                 workers=4, loop, json_loads=None, instrumentation=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self._handler = webhook_structure_handler
+        self._json_loads = json_loads or jsoncodec.loads
+        self._maxsize = maxsize
+        self._worker_count = workers
+        self._loop = loop
+        self._queue = None
+        self._workers = []
+        self._busy_workers = 0
+        self._enqueued = 0
+        self._rejected = 0
+        self._processed = 0
+        self._failed = 0
+        self._max_depth = 0
+        if instrumentation is not None:
+            self._register_metrics(instrumentation.registry)
+
+    def start(self):
+        if self._queue is not None:
+            raise RuntimeError('Ingest queue already started')
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        for _ in range(self._worker_count):
+            self._workers.append(self._loop.create_task(self._work()))
+
+    def full(self):
+        return self._queue.full()
+
+    def submit(self, content, pending=None):
+        """
+        Put a verified webhook request body on the queue.
+
+        Returns ``True`` if the body was accepted, ``False`` if the
+        queue is full. If given, ``pending`` (a
+        :class:`fbemissary.journal.PendingBody`) is passed on to the
+        ``webhook_structure_handler`` and released once the body has
+        been processed, successfully or not.
+        """
+        try:
+            self._queue.put_nowait((content, pending))
+        except asyncio.QueueFull:
+            self._rejected += 1
+            return False
+        self._enqueued += 1
+        depth = self._queue.qsize()
+        if depth > self._max_depth:
+            self._max_depth = depth
+        return True
+
+    async def join(self):
+        """
+        Wait until every body submitted so far has been processed.
+        """
+        await self._queue.join()
+
+    async def close(self):
+        """
+        Cancel the worker tasks. Bodies still on the queue are
+        discarded; await :meth:`join` first to process them.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    def stats(self):
+        return IngestQueueStats(
+            depth=self._queue.qsize() if self._queue is not None else 0,
+            maxsize=self._maxsize,
+            workers=len(self._workers),
+            busy_workers=self._busy_workers,
+            enqueued=self._enqueued,
+            rejected=self._rejected,
+            processed=self._processed,
+            failed=self._failed,
+            max_depth=self._max_depth,
+        )
+
+    def _register_metrics(self, registry):
+        gauge = registry.gauge(
+            'fbemissary_ingest_queue',
+            'Webhook ingest queue depth, size and counters',
+            ['measure'])
+
+        def collect():
+            stats = self.stats()
+            for measure in ('depth', 'maxsize', 'busy_workers', 'enqueued',
+                            'rejected', 'processed', 'failed', 'max_depth'):
+                gauge.set(getattr(stats, measure), labels=(measure,))
+        registry.add_collector(collect)
+
+    async def _work(self):
+        while True:
+            content, pending = await self._queue.get()
+            self._busy_workers += 1
+            try:
+                structure = self._json_loads(content)
+                await _handle_structure(self._handler, structure, pending)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._failed += 1
+                logger.exception('Failed to process queued webhook body')
+            else:
+                self._processed += 1
+            finally:
+                self._busy_workers -= 1
+                self._queue.task_done()
+            if pending is not None:
+                pending.release()
+
+
 class WebhookWrangler:
-    def __init__(self, messaging_events_received):
+    """
+    Parse webhook structures into models and pass the messaging events
+    for each page to the ``messaging_events_received`` coroutine
+    callable.
+
+    If a ``deduplicator`` (a
+    :class:`fbemissary.dedupe.MessageDeduplicator`) is given, messages
+    whose ID it has seen recently are dropped before being parsed. If
+    ``messaging_events_received`` raises, the IDs of the entry's
+    messages are forgotten again, so Facebook's redelivery of them is
+    handled.
+
+    If an ``event_filter`` is given, it is called with the page ID and
+    the :class:`fbemissary.models.EventKind` of each event, and events
+    it returns false for are dropped before being parsed.
+
+    If an ``instrumentation`` (a
+    :class:`fbemissary.metrics.Instrumentation`) is given, events are
+    counted and their parsing timed.
+
+    A ``pending`` :class:`fbemissary.journal.PendingBody` given with a
+    structure is passed on to ``messaging_events_received`` as a
+    keyword argument.
+    """
+    def __init__(self, messaging_events_received, *, deduplicator=None,
+                 event_filter=None, instrumentation=None):
         self._object_handlers = {
             'page': self._handle_page_structure,
         }
         self._messaging_events_received = messaging_events_received
+        self._deduplicator = deduplicator
+        self._event_filter = event_filter
+        self._instrumentation = instrumentation
 
-    async def handle_webhook_structure(self, structure):
+    async def handle_webhook_structure(self, structure, pending=None):
         try:
             objtype = structure['object']
         except KeyError:
@@ -82,9 +402,9 @@ class WebhookWrangler:
         if handler is None:
             logger.warning('No handler for webhook object type %r', objtype)
             return
-        await handler(structure)
+        await handler(structure, pending)
 
-    async def _handle_page_structure(self, structure):
+    async def _handle_page_structure(self, structure, pending):
         assert structure['object'] == 'page'
         extra_keys = structure.keys() - {'object', 'entry'} 
         if extra_keys:
@@ -97,28 +417,91 @@ class WebhookWrangler:
                 "No 'entry' key in webhook structure: %r", structure)
             return
         logger.debug('Got %d page webhook entries', len(entry_structures))
-        await self._handle_page_entries(entry_structures)
+        await self._handle_page_entries(entry_structures, pending)
 
-    async def _handle_page_entries(self, entry_structures):
+    async def _handle_page_entries(self, entry_structures, pending):
+        instr = self._instrumentation
+        debug = logger.isEnabledFor(logging.DEBUG)
         for entry in entry_structures:
             if 'messaging' not in entry:
                 logger.warning('Ignoring non-messaging entry: %r', entry)
                 continue
             page_id = entry['id']
-            logger.debug('Received messaging entry for page ID %r', page_id)
             event_structures = entry['messaging']
-            logger.debug(
-                'Processing %d messaging event structures',
-                len(event_structures))
+            if debug:
+                logger.debug(
+                    'Processing %d messaging event structures for '
+                    'page ID %r', len(event_structures), page_id)
+            if instr is not None:
+                started = instr.clock()
             events = []
+            # IDs remembered by the deduplicator for this entry
+            message_ids = []
             for event_structure in event_structures:
+                if self._is_duplicate(event_structure, message_ids):
+                    if debug:
+                        logger.debug(
+                            'Dropping redelivered message %r',
+                            event_structure['message']['mid'])
+                    if instr is not None:
+                        instr.events.inc(labels=('duplicate',))
+                    continue
+                kind = models.event_kind(event_structure)
+                if kind is None:
+                    logger.warning(
+                        'Ignoring unsupported messaging event with keys %r',
+                        sorted(event_structure))
+                    if instr is not None:
+                        instr.events.inc(labels=('unsupported',))
+                    continue
+                if (self._event_filter is not None
+                        and not self._event_filter(page_id, kind)):
+                    if instr is not None:
+                        instr.events.inc(labels=('unsubscribed',))
+                    continue
                 try:
                     event = models.model_from_entry_structure(
-                        event_structure)
+                        event_structure, kind)
                 except Exception:  # FIXME: Too broad
                     logger.exception(
                         'Failed to parse event structure %r',
                         event_structure)
+                    if instr is not None:
+                        instr.events.inc(labels=('unparseable',))
                 else:
                     events.append(event)
-            await self._messaging_events_received(page_id, events)
+            if instr is not None:
+                if event_structures:
+                    instr.parse_seconds.observe(
+                        (instr.clock() - started) / len(event_structures))
+                instr.events.inc(len(events), labels=('parsed',))
+            try:
+                if pending is None:
+                    await self._messaging_events_received(page_id, events)
+                else:
+                    await self._messaging_events_received(
+                        page_id, events, pending=pending)
+            except BaseException:
+                for message_id in message_ids:
+                    self._deduplicator.forget(message_id)
+                raise
+
+    def _is_duplicate(self, event_structure, message_ids):
+        if self._deduplicator is None:
+            return False
+        try:
+            message_id = event_structure['message']['mid']
+        except (KeyError, TypeError):
+            return False
+        if self._deduplicator.seen(message_id):
+            return True
+        message_ids.append(message_id)
+        return False
+
+
+async def _handle_structure(handler, structure, pending):
+    # Handlers that aren't used with a journal needn't take ``pending``
+    if pending is None:
+        await handler.handle_webhook_structure(structure)
+    else:
+        await handler.handle_webhook_structure(structure, pending=pending)